@@ -0,0 +1,243 @@
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import struct
+import time
+from typing import Optional
+
+# ioctl to query the logical sector size of a block device, from linux/fs.h
+BLKSSZGET = 0x1268
+
+CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_ALIGNMENT = 4096
+
+Extent = tuple[int, int]
+
+
+class CopyStats:
+    size: int
+    copied: int
+    seconds: float
+
+    def __init__(self, size: int = 0, copied: int = 0, seconds: float = 0):
+        self.size = size
+        self.copied = copied
+        self.seconds = seconds
+
+    def throughput(self) -> float:
+        """bytes per second of actually transferred data"""
+        return self.copied / self.seconds if self.seconds else 0
+
+    def __repr__(self):
+        mib = 1024 * 1024
+        return (f'copied {self.copied / mib:.1f} MiB of {self.size / mib:.1f} MiB in {self.seconds:.1f}s '
+                f'({self.throughput() / mib:.1f} MiB/s)')
+
+
+def is_block_device(path: str) -> bool:
+    return os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode)
+
+
+def get_fd_size(fd: int) -> int:
+    """Returns the size of a regular file or block device"""
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def get_sector_size(fd: int) -> int:
+    """Returns the logical sector size of a block device or `DEFAULT_ALIGNMENT` for regular files"""
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return DEFAULT_ALIGNMENT
+    buf = fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0))
+    return max(struct.unpack('i', buf)[0], 512)
+
+
+def get_data_extents(fd: int, start: int = 0, end: Optional[int] = None) -> list[Extent]:
+    """
+    Returns a list of `(offset, length)` tuples describing the regions of `fd` between `start` and `end` that contain data.
+    Holes are skipped using SEEK_DATA/SEEK_HOLE. If the file system doesn't support that, one extent spanning the whole range is returned.
+    """
+    if end is None:
+        end = get_fd_size(fd)
+    extents = list[Extent]()
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return [(start, end - start)] if end > start else extents
+    offset = start
+    try:
+        while offset < end:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as ex:
+                if ex.errno == errno.ENXIO:
+                    # no more data after offset
+                    break
+                raise
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            extents.append((data, hole - data))
+            offset = hole
+    except OSError as ex:
+        if ex.errno not in [errno.EINVAL, errno.EOPNOTSUPP]:
+            raise
+        logging.debug(f'SEEK_DATA not supported ({ex}), treating the whole file as data')
+        extents = [(start, end - start)]
+    return extents
+
+
+def align_extents(extents: list[Extent], alignment: int, limit: Optional[int] = None) -> list[Extent]:
+    """Widens `extents` to multiples of `alignment`, merging overlapping ones. Extents are clamped to `limit` if passed."""
+    results = list[Extent]()
+    for offset, length in extents:
+        start = offset - (offset % alignment)
+        end = offset + length
+        end += (-end) % alignment
+        if limit is not None:
+            end = min(end, limit)
+        if results and results[-1][0] + results[-1][1] >= start:
+            last_start, last_length = results.pop()
+            start = last_start
+            end = max(end, last_start + last_length)
+        results.append((start, end - start))
+    return results
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, length: int, dst_offset: int) -> int:
+    """copy a range between regular files in the kernel, falling back to sendfile and finally read/write"""
+    copied = 0
+    while copied < length:
+        count = min(length - copied, CHUNK_SIZE * 16)
+        try:
+            written = os.copy_file_range(src_fd, dst_fd, count, offset + copied, dst_offset + copied)
+        except (OSError, AttributeError) as ex:
+            if isinstance(ex, OSError) and ex.errno not in [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP]:
+                raise
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            try:
+                written = os.sendfile(dst_fd, src_fd, offset + copied, count)
+            except OSError as ex:
+                if ex.errno not in [errno.EINVAL, errno.ENOSYS]:
+                    raise
+                data = os.pread(src_fd, count, offset + copied)
+                written = os.pwrite(dst_fd, data, dst_offset + copied)
+        if written == 0:
+            raise Exception(f'Unexpected end of file while copying at offset {offset + copied}')
+        copied += written
+    return copied
+
+
+def _copy_range_aligned(src_fd: int, dst_fd: int, offset: int, length: int, dst_offset: int, buffer: mmap.mmap, alignment: int) -> int:
+    """copy a range to a block device using large aligned writes, zero-padding a short read at the end"""
+    view = memoryview(buffer)
+    copied = 0
+    try:
+        while copied < length:
+            count = min(length - copied, len(buffer))
+            read = os.preadv(src_fd, [view[:count]], offset + copied)
+            padded = read + ((-read) % alignment)
+            if read < padded:
+                view[read:padded] = bytes(padded - read)
+            if padded == 0:
+                break
+            written = os.pwritev(dst_fd, [view[:padded]], dst_offset + copied)
+            if written != padded:
+                raise Exception(f'Short write at offset {dst_offset + copied}: {written} of {padded} bytes')
+            copied += read
+            if read < count:
+                break
+    finally:
+        view.release()
+    return copied
+
+
+def open_target(path: str, block_device: bool) -> int:
+    flags = os.O_WRONLY
+    if not block_device:
+        return os.open(path, flags | os.O_CREAT, 0o644)
+    try:
+        return os.open(path, flags | os.O_DIRECT)
+    except OSError as ex:
+        if ex.errno != errno.EINVAL:
+            raise
+        logging.debug(f'O_DIRECT not supported for {path}, using buffered writes')
+        return os.open(path, flags)
+
+
+def copy_extents(
+    src_fd: int,
+    dst_fd: int,
+    extents: list[Extent],
+    src_offset: int = 0,
+    dst_offset: int = 0,
+) -> int:
+    """
+    Copies `extents` (relative to `src_offset`) from `src_fd` to `dst_fd` at `dst_offset` + the extent's offset.
+    Block device targets get aligned large writes, regular files get in-kernel copies.
+    Returns the number of bytes copied.
+    """
+    block_device = stat.S_ISBLK(os.fstat(dst_fd).st_mode)
+    copied = 0
+    if not block_device:
+        for offset, length in extents:
+            copied += _copy_file_range(src_fd, dst_fd, src_offset + offset, length, dst_offset + offset)
+        return copied
+    alignment = get_sector_size(dst_fd)
+    if dst_offset % alignment:
+        raise Exception(f'Target offset {dst_offset} is not aligned to the sector size {alignment}')
+    buffer = mmap.mmap(-1, CHUNK_SIZE)
+    try:
+        for offset, length in extents:
+            copied += _copy_range_aligned(src_fd, dst_fd, src_offset + offset, length, dst_offset + offset, buffer, alignment)
+    finally:
+        buffer.close()
+    return copied
+
+
+def copy_image(
+    input: str,
+    output: str,
+    length: Optional[int] = None,
+    input_offset: int = 0,
+    output_offset: int = 0,
+    extents: Optional[list[Extent]] = None,
+) -> CopyStats:
+    """
+    Copies `length` bytes (default: all) of `input` starting at `input_offset` to `output` at `output_offset`,
+    skipping holes in `input`. Pass `extents` (relative to `input_offset`) to copy only those.
+    Regular file targets are truncated/extended to the copied size and stay sparse.
+    With an `output_offset`, they are only extended, and the ranges skipped in them keep their previous contents.
+    Block devices are written with large aligned writes; their holes are left untouched, like bmaptool does.
+    """
+    block_device = is_block_device(output)
+    start = time.monotonic()
+    src_fd = os.open(input, os.O_RDONLY)
+    try:
+        if length is None:
+            length = get_fd_size(src_fd) - input_offset
+        if extents is None:
+            extents = [(offset - input_offset, size) for offset, size in get_data_extents(src_fd, input_offset, input_offset + length)]
+        if block_device:
+            extents = align_extents(extents, DEFAULT_ALIGNMENT, limit=length)
+        dst_fd = open_target(output, block_device)
+        try:
+            if block_device:
+                target_size = get_fd_size(dst_fd)
+                if output_offset + length > target_size:
+                    raise Exception(f'{output} is too small: {target_size} bytes, need {output_offset + length}')
+            else:
+                if output_offset == 0:
+                    # drop stale contents so the target's holes match the input's
+                    os.ftruncate(dst_fd, 0)
+                if os.fstat(dst_fd).st_size < output_offset + length:
+                    os.ftruncate(dst_fd, output_offset + length)
+            copied = copy_extents(src_fd, dst_fd, extents, src_offset=input_offset, dst_offset=output_offset)
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    stats = CopyStats(size=length, copied=copied, seconds=time.monotonic() - start)
+    logging.info(f'{input} -> {output}: {stats}')
+    return stats
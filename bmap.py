@@ -0,0 +1,256 @@
+import hashlib
+import logging
+import mmap
+import os
+import subprocess
+import time
+from typing import IO, Optional
+from xml.etree import ElementTree
+
+from blockcopy import CHUNK_SIZE, CopyStats, align_extents, get_data_extents, get_fd_size, get_sector_size, is_block_device, open_target
+
+BMAP_VERSION = '2.0'
+BMAP_BLOCK_SIZE = 4096
+BMAP_CHECKSUM_TYPE = 'sha256'
+
+COMPRESSIONS: dict[str, dict[str, list[str]]] = {
+    'zstd': {
+        'compress': ['zstd', '-T0', '-q', '-c', '-'],
+        'decompress': ['zstd', '-d', '-q', '-c'],
+    },
+    'xz': {
+        'compress': ['xz', '-T0', '-c', '-z', '-'],
+        'decompress': ['xz', '-T0', '-d', '-c'],
+    },
+}
+COMPRESSION_EXTENSIONS = {
+    'zstd': '.zst',
+    'xz': '.xz',
+}
+
+BlockRange = tuple[int, int, str]
+
+
+class Bmap:
+    image_size: int
+    block_size: int
+    ranges: list[BlockRange]
+
+    def __init__(self, image_size: int, block_size: int = BMAP_BLOCK_SIZE, ranges: list[BlockRange] = []):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = list(ranges)
+
+    def blocks_count(self) -> int:
+        return (self.image_size + self.block_size - 1) // self.block_size
+
+    def mapped_blocks_count(self) -> int:
+        return sum(last - first + 1 for first, last, _ in self.ranges)
+
+    def to_xml(self) -> str:
+        """Renders the bmap in the bmaptool 2.0 XML format, including the file checksum"""
+
+        def render(file_checksum: str) -> str:
+            ranges = '\n'.join(
+                f'        <Range chksum="{chksum}"> {first if first == last else f"{first}-{last}"} </Range>' for first, last, chksum in self.ranges)
+            return f'''<?xml version="1.0" ?>
+<!-- This file contains the block map for an image file, generated by kupferbootstrap -->
+<bmap version="{BMAP_VERSION}">
+    <ImageSize> {self.image_size} </ImageSize>
+    <BlockSize> {self.block_size} </BlockSize>
+    <BlocksCount> {self.blocks_count()} </BlocksCount>
+    <MappedBlocksCount> {self.mapped_blocks_count()} </MappedBlocksCount>
+    <ChecksumType> {BMAP_CHECKSUM_TYPE} </ChecksumType>
+    <BmapFileChecksum> {file_checksum} </BmapFileChecksum>
+    <BlockMap>
+{ranges}
+    </BlockMap>
+</bmap>
+'''
+
+        # the file checksum is calculated with the checksum field set to all zeroes
+        placeholder = '0' * hashlib.new(BMAP_CHECKSUM_TYPE).digest_size * 2
+        checksum = hashlib.new(BMAP_CHECKSUM_TYPE, render(placeholder).encode()).hexdigest()
+        return render(checksum)
+
+    @staticmethod
+    def parse(xml: str) -> 'Bmap':
+        root = ElementTree.fromstring(xml)
+        if not root.get('version', '').startswith('2.'):
+            raise Exception(f'Unsupported bmap version: {root.get("version")}')
+
+        def get_text(tag: str) -> str:
+            node = root.find(tag)
+            if node is None or node.text is None:
+                raise Exception(f'bmap is missing <{tag}>')
+            return node.text.strip()
+
+        checksum_type = get_text('ChecksumType')
+        if checksum_type != BMAP_CHECKSUM_TYPE:
+            raise Exception(f'Unsupported bmap checksum type: {checksum_type}')
+        file_checksum = get_text('BmapFileChecksum')
+        placeholder = '0' * len(file_checksum)
+        if hashlib.new(checksum_type, xml.replace(file_checksum, placeholder, 1).encode()).hexdigest() != file_checksum:
+            raise Exception('bmap file checksum mismatch, the bmap is corrupt')
+        ranges = list[BlockRange]()
+        for node in root.iter('Range'):
+            assert node.text
+            first, _, last = node.text.strip().partition('-')
+            ranges.append((int(first), int(last or first), node.get('chksum', '')))
+        return Bmap(int(get_text('ImageSize')), int(get_text('BlockSize')), ranges)
+
+
+def get_bmap_path(image_path: str) -> str:
+    """Returns the bmap path belonging to a (possibly compressed) image"""
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if image_path.endswith(extension):
+            image_path = image_path[:-len(extension)]
+    return image_path + '.bmap'
+
+
+def get_compression(image_path: str) -> Optional[str]:
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if image_path.endswith(extension):
+            return compression
+    return None
+
+
+def _write_zeroes(output: IO[bytes], length: int, zeroes: bytes):
+    while length > 0:
+        count = min(length, len(zeroes))
+        output.write(zeroes[:count])
+        length -= count
+
+
+def compress_image(image_path: str, compression: str, output_path: Optional[str] = None, bmap_path: Optional[str] = None) -> Bmap:
+    """
+    Streams the sparse `image_path` through a multi-threaded `compression` program into `output_path`
+    (default: `image_path` + extension) and writes the bmap of its data blocks to `bmap_path` (default: `get_bmap_path()`).
+    Holes aren't read from disk, zeroes are fed to the compressor instead.
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception(f'Unknown compression "{compression}". Choices: {", ".join(COMPRESSIONS)}')
+    output_path = output_path or image_path + COMPRESSION_EXTENSIONS[compression]
+    bmap_path = bmap_path or get_bmap_path(output_path)
+    start = time.monotonic()
+    zeroes = bytes(CHUNK_SIZE)
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        size = get_fd_size(fd)
+        bmap = Bmap(size)
+        extents = align_extents(get_data_extents(fd), bmap.block_size, limit=size)
+        logging.info(f'Compressing {image_path} to {output_path} with {compression}')
+        with open(output_path, 'wb') as output:
+            process = subprocess.Popen(COMPRESSIONS[compression]['compress'], stdin=subprocess.PIPE, stdout=output)
+            assert process.stdin
+            position = 0
+            try:
+                for offset, length in extents:
+                    _write_zeroes(process.stdin, offset - position, zeroes)
+                    checksum = hashlib.new(BMAP_CHECKSUM_TYPE)
+                    done = 0
+                    while done < length:
+                        data = os.pread(fd, min(CHUNK_SIZE, length - done), offset + done)
+                        if not data:
+                            raise Exception(f'Unexpected end of {image_path} at offset {offset + done}')
+                        checksum.update(data)
+                        process.stdin.write(data)
+                        done += len(data)
+                    first = offset // bmap.block_size
+                    bmap.ranges.append((first, first + (length + bmap.block_size - 1) // bmap.block_size - 1, checksum.hexdigest()))
+                    position = offset + length
+                _write_zeroes(process.stdin, size - position, zeroes)
+            finally:
+                process.stdin.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise Exception(f'Failed to compress {image_path} with {compression}: exit code {returncode}')
+    finally:
+        os.close(fd)
+    with open(bmap_path, 'w') as file:
+        file.write(bmap.to_xml())
+    stats = CopyStats(size=size, copied=os.path.getsize(output_path), seconds=time.monotonic() - start)
+    logging.info(f'Wrote {output_path} and {bmap_path}: {bmap.mapped_blocks_count()} of {bmap.blocks_count()} blocks mapped, {stats}')
+    return bmap
+
+
+def _read_into(stream: IO[bytes], view: memoryview) -> int:
+    done = 0
+    while done < len(view):
+        count = stream.readinto(view[done:])  # type: ignore[attr-defined]
+        if not count:
+            break
+        done += count
+    return done
+
+
+def flash_bmap_image(image_path: str, target: str, bmap_path: Optional[str] = None, verify: bool = True) -> CopyStats:
+    """
+    Writes the blocks mapped in the bmap of `image_path` to `target`, decompressing `image_path` on the fly if needed.
+    Unmapped blocks are skipped, so they keep whatever content `target` had before.
+    """
+    bmap_path = bmap_path or get_bmap_path(image_path)
+    if not os.path.exists(bmap_path):
+        raise Exception(f'No bmap found for {image_path} at {bmap_path}')
+    with open(bmap_path, 'r') as file:
+        bmap = Bmap.parse(file.read())
+    compression = get_compression(image_path)
+    start = time.monotonic()
+    process = None
+    if compression:
+        process = subprocess.Popen(COMPRESSIONS[compression]['decompress'] + [image_path], stdout=subprocess.PIPE)
+        assert process.stdout
+        stream: IO[bytes] = process.stdout
+    else:
+        stream = open(image_path, 'rb')
+    block_device = is_block_device(target)
+    dst_fd = open_target(target, block_device)
+    buffer = mmap.mmap(-1, CHUNK_SIZE)
+    view = memoryview(buffer)
+    copied = 0
+    try:
+        if block_device and get_fd_size(dst_fd) < bmap.image_size:
+            raise Exception(f'{target} is too small for {image_path}: {get_fd_size(dst_fd)} < {bmap.image_size} bytes')
+        if not block_device:
+            os.ftruncate(dst_fd, 0)
+            os.ftruncate(dst_fd, bmap.image_size)
+        alignment = get_sector_size(dst_fd)
+        position = 0
+        logging.info(f'Writing {bmap.mapped_blocks_count()} mapped blocks of {image_path} to {target}')
+        for first, last, chksum in bmap.ranges:
+            offset = first * bmap.block_size
+            length = min((last + 1) * bmap.block_size, bmap.image_size) - offset
+            # skip unmapped data in the stream
+            while position < offset:
+                count = _read_into(stream, view[:min(CHUNK_SIZE, offset - position)])
+                if not count:
+                    raise Exception(f'Unexpected end of {image_path} at offset {position}')
+                position += count
+            checksum = hashlib.new(BMAP_CHECKSUM_TYPE)
+            done = 0
+            while done < length:
+                count = _read_into(stream, view[:min(CHUNK_SIZE, length - done)])
+                if not count:
+                    raise Exception(f'Unexpected end of {image_path} at offset {position}')
+                if verify:
+                    checksum.update(view[:count])
+                padded = count + ((-count) % alignment)
+                view[count:padded] = bytes(padded - count)
+                os.pwritev(dst_fd, [view[:padded]], offset + done)
+                done += count
+                position += count
+            if verify and chksum and checksum.hexdigest() != chksum:
+                raise Exception(f'Checksum mismatch for blocks {first}-{last} of {image_path}')
+            copied += length
+        os.fsync(dst_fd)
+    finally:
+        view.release()
+        buffer.close()
+        os.close(dst_fd)
+        stream.close()
+        if process:
+            process.kill()
+            process.wait()
+    stats = CopyStats(size=bmap.image_size, copied=copied, seconds=time.monotonic() - start)
+    logging.info(f'{image_path} -> {target}: {stats}')
+    return stats
@@ -5,7 +5,7 @@ import click
 from config import config
 from constants import BOOT_STRATEGIES, FLASH_PARTS, FASTBOOT, JUMPDRIVE, JUMPDRIVE_VERSION
 from fastboot import fastboot_boot, fastboot_erase_dtbo
-from image import get_device_and_flavour, losetup_rootfs_image, get_image_path, dump_aboot, dump_lk2nd
+from image import get_device_and_flavour, get_image_path, dump_aboot, dump_lk2nd
 from wrapper import enforce_wrap
 
 LK2ND = FLASH_PARTS['LK2ND']
@@ -33,11 +33,10 @@ def cmd_boot(type):
             if not os.path.exists(path):
                 urllib.request.urlretrieve(f'https://github.com/dreemurrs-embedded/Jumpdrive/releases/download/{JUMPDRIVE_VERSION}/{file}', path)
         else:
-            loop_device = losetup_rootfs_image(image_path, sector_size)
             if type == LK2ND:
-                path = dump_lk2nd(loop_device + 'p1')
+                path = dump_lk2nd(image_path, sector_size)
             elif type == ABOOT:
-                path = dump_aboot(loop_device + 'p1')
+                path = dump_aboot(image_path, sector_size)
             else:
                 raise Exception(f'Unknown boot image type {type}')
         fastboot_erase_dtbo()
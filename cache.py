@@ -5,7 +5,7 @@ from config import config
 from wrapper import enforce_wrap
 import logging
 
-PATHS = ['chroots', 'pacman', 'jumpdrive', 'packages', 'images']
+PATHS = ['chroots', 'pacman', 'jumpdrive', 'packages', 'images', 'rootfs', 'binary_cache', 'ccache', 'sources', 'build_dirs']
 
 
 @click.group(name='cache')
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Callable
+
+
+class Phase:
+    """
+    A step of a pipeline. `inputs` must be JSON-serializable and capture everything the phase's result depends on
+    besides the phases before it. `outputs` are files that have to still be unmodified for the phase to be skipped.
+    Phases that aren't `idempotent` modify the results of the previous phase in place,
+    so the previous phase has to rerun before they can.
+    """
+    name: str
+    inputs: Any
+    run: Callable[[], None]
+    outputs: list[str]
+    idempotent: bool
+
+    def __init__(self, name: str, inputs: Any, run: Callable[[], None], outputs: list[str] = [], idempotent: bool = True):
+        self.name = name
+        self.inputs = inputs
+        self.run = run
+        self.outputs = list(outputs)
+        self.idempotent = idempotent
+
+
+class Checkpoints:
+    """
+    Completed phases of a pipeline, persisted as JSON at `path`.
+    Each phase's key hashes its inputs together with the previous phase's key,
+    so changing a phase's inputs invalidates all phases after it as well.
+    """
+    path: str
+    phases: dict[str, dict]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.phases = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as file:
+                    self.phases = json.load(file)
+            except json.JSONDecodeError as ex:
+                logging.warning(f'Ignoring corrupt checkpoints file {path}: {ex}')
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as file:
+            json.dump(self.phases, file, indent=2)
+        os.rename(f'{self.path}.tmp', self.path)
+
+    @staticmethod
+    def get_key(parent_key: str, inputs: Any) -> str:
+        return hashlib.sha256(json.dumps([parent_key, inputs], sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_stamp(path: str) -> list[int]:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_done(self, phase: Phase, key: str) -> bool:
+        checkpoint = self.phases.get(phase.name)
+        if not checkpoint or checkpoint['key'] != key:
+            return False
+        for output, stamp in checkpoint['outputs'].items():
+            if not os.path.exists(output) or self.get_stamp(output) != stamp:
+                logging.debug(f'Checkpoint {phase.name}: output {output} is missing or changed')
+                return False
+        return True
+
+    def mark_done(self, phase: Phase, key: str):
+        self.phases[phase.name] = {'key': key, 'outputs': {output: self.get_stamp(output) for output in phase.outputs}}
+        # later phases legitimately modify earlier phases' outputs, only changes from outside the pipeline count
+        for checkpoint in self.phases.values():
+            for output in checkpoint['outputs']:
+                if os.path.exists(output):
+                    checkpoint['outputs'][output] = self.get_stamp(output)
+        self.save()
+
+    def invalidate(self, names: list[str]):
+        for name in names:
+            self.phases.pop(name, None)
+        self.save()
+
+
+def run_phases(phases: list[Phase], checkpoints: Checkpoints, resume: bool = False):
+    """
+    Runs `phases` in order, recording a checkpoint after each one.
+    With `resume`, leading phases whose checkpoints are still valid are skipped
+    and the pipeline restarts at the first invalidated phase, or the phase before it if it isn't idempotent.
+    """
+    keys = []
+    key = ''
+    for phase in phases:
+        key = Checkpoints.get_key(key, phase.inputs)
+        keys.append(key)
+    start = 0
+    if resume:
+        while start < len(phases) and checkpoints.is_done(phases[start], keys[start]):
+            start += 1
+        while 0 < start < len(phases) and not phases[start].idempotent:
+            logging.info(f'Phase "{phases[start].name}" can\'t rerun on its own previous results')
+            start -= 1
+        for phase in phases[:start]:
+            logging.info(f'Skipping phase "{phase.name}": unchanged since the last build')
+        if start < len(phases):
+            logging.info(f'Resuming at phase "{phases[start].name}"')
+    # an interrupted phase must rerun, and so must everything after it
+    checkpoints.invalidate([phase.name for phase in phases[start:]])
+    for phase, key in zip(phases[start:], keys[start:]):
+        logging.info(f'Running phase "{phase.name}"')
+        phase.run()
+        checkpoints.mark_done(phase, key)
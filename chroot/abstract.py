@@ -1,6 +1,7 @@
 import atexit
 import logging
 import os
+import re
 import subprocess
 from copy import deepcopy
 from shlex import quote as shell_quote
@@ -266,6 +267,37 @@ class Chroot(AbstractChroot):
             fail_if_mounted=fail_if_mounted,
         )
 
+    def mount_ccache(self, arch: Arch, fail_if_mounted: bool = False) -> str:
+        """mount the persistent compiler caches for `arch`, which isn't necessarily the chroot's arch when crosscompiling"""
+        arch_cache = os.path.join(config.get_path('ccache'), arch)
+        rel_target = os.path.join(CHROOT_PATHS['ccache'].lstrip('/'), arch)
+        for dir in [arch_cache, self.get_path(rel_target)]:
+            os.makedirs(dir, exist_ok=True)
+        return self.mount(
+            arch_cache,
+            rel_target,
+            fail_if_mounted=fail_if_mounted,
+        )
+
+    def mount_sources(self, fail_if_mounted: bool = False) -> str:
+        path = config.get_path('sources')
+        os.makedirs(path, exist_ok=True)
+        return self.mount(
+            absolute_source=path,
+            relative_destination=CHROOT_PATHS['sources'].lstrip('/'),
+            fail_if_mounted=fail_if_mounted,
+        )
+
+    def mount_build_dirs(self, fail_if_mounted: bool = False) -> str:
+        """mount the persistent makepkg BUILDDIRs used by incremental builds"""
+        path = config.get_path('build_dirs')
+        os.makedirs(path, exist_ok=True)
+        return self.mount(
+            absolute_source=path,
+            relative_destination=CHROOT_PATHS['build_dirs'].lstrip('/'),
+            fail_if_mounted=fail_if_mounted,
+        )
+
     def mount_packages(self, fail_if_mounted: bool = False) -> str:
         return self.mount(
             absolute_source=config.get_path('packages'),
@@ -287,11 +319,11 @@ class Chroot(AbstractChroot):
             f.write(makepkg_cross_conf)
         return makepkg_conf_path_relative
 
-    def write_pacman_conf(self, check_space: Optional[bool] = None):
+    def write_pacman_conf(self, check_space: Optional[bool] = None, no_extract: list[str] = []):
         if check_space is None:
             check_space = config.file['pacman']['check_space']
         os.makedirs(self.get_path('/etc'), exist_ok=True)
-        conf_text = get_base_distro(self.arch).get_pacman_conf(self.extra_repos, check_space=check_space)
+        conf_text = get_base_distro(self.arch).get_pacman_conf(self.extra_repos, check_space=check_space, no_extract=no_extract)
         with open(self.get_path('etc/pacman.conf'), 'w') as file:
             file.write(conf_text)
 
@@ -340,6 +372,25 @@ class Chroot(AbstractChroot):
                 results[pkg] = self.run_cmd(f'{cmd} {pkg}')
         return results
 
+    def download_packages(self, packages: list[str], refresh: bool = True) -> list[str]:
+        """
+        Download `packages` and their dependencies into the pacman cache in a single transaction, skipping installed ones.
+        Packages that can't be found are left out. Returns the requested packages that were downloaded.
+        """
+        packages = list(packages)
+        while packages:
+            result = self.run_cmd(f"pacman -Sw --noconfirm --needed {'-y ' if refresh else ''}{' '.join(packages)}", capture_output=True)
+            assert isinstance(result, subprocess.CompletedProcess)
+            if result.returncode == 0:
+                break
+            missing = re.findall(r'target not found: (\S+)', result.stderr.decode())
+            if not missing:
+                raise Exception(f'{self.name}: failed to download packages: {result.stderr.decode()}')
+            logging.debug(f'{self.name}: skipping unavailable packages {missing}')
+            packages = [package for package in packages if package not in missing]
+            refresh = False
+        return packages
+
 
 chroots: dict[str, Chroot] = {}
 
@@ -5,17 +5,39 @@ from glob import glob
 from typing import Optional
 
 from config import config
-from constants import Arch, GCC_HOSTSPECS, CROSSDIRECT_PKGS, CHROOT_PATHS
+from constants import Arch, BUILD_CHROOT_NO_EXTRACT, BUILD_CHROOT_SKIP_HOOKS, GCC_HOSTSPECS, CROSSDIRECT_PKGS, CHROOT_PATHS
 from distro.distro import get_kupfer_local
 
 from .abstract import Chroot, get_chroot
-from .helpers import build_chroot_name
+from .helpers import build_chroot_name, prefetch_chroot_name
 from .base import get_base_chroot
 
 
 class BuildChroot(Chroot):
 
     copy_base: bool = True
+    # whether to install with the build chroot pacman profile, see `constants.BUILD_CHROOT_NO_EXTRACT`
+    pacman_build_profile: bool = True
+
+    def write_pacman_conf(self, check_space: Optional[bool] = None, no_extract: Optional[list[str]] = None, build_profile: Optional[bool] = None):
+        """`build_profile` overrides whether to use the build chroot pacman profile, by default it's used if configured"""
+        profile = (self.pacman_build_profile and config.file['build']['pacman_build_profile']) if build_profile is None else build_profile
+        if no_extract is None:
+            no_extract = BUILD_CHROOT_NO_EXTRACT if profile else []
+        super().write_pacman_conf(check_space=check_space, no_extract=no_extract)
+        self.mask_pacman_hooks(BUILD_CHROOT_SKIP_HOOKS if profile else [])
+
+    def mask_pacman_hooks(self, hooks: list[str]):
+        """Disables the system pacman `hooks` by overriding them with /dev/null and re-enables the other known ones"""
+        hook_dir = self.get_path('etc/pacman.d/hooks')
+        os.makedirs(hook_dir, exist_ok=True)
+        for hook in set(BUILD_CHROOT_SKIP_HOOKS + hooks):
+            path = os.path.join(hook_dir, hook)
+            masked = os.path.islink(path) and os.readlink(path) == '/dev/null'
+            if hook in hooks and not os.path.lexists(path):
+                os.symlink('/dev/null', path)
+            elif hook not in hooks and masked:
+                os.unlink(path)
 
     def create_rootfs(self, reset: bool, pacman_conf_target: str, active_previously: bool):
         if reset or not os.path.exists(self.get_path('usr/bin')):
@@ -138,3 +160,12 @@ def get_build_chroot(arch: Arch, add_kupfer_repos: bool = True, **kwargs) -> Bui
     chroot = get_chroot(name, **kwargs, extra_repos=repos, default=default)
     assert isinstance(chroot, BuildChroot)
     return chroot
+
+
+def get_prefetch_chroot(arch: Arch) -> BuildChroot:
+    """A chroot for downloading sources in, separate from the build chroots so resetting those doesn't interrupt downloads"""
+    name = prefetch_chroot_name(arch)
+    default = BuildChroot(name, arch, initialize=False, copy_base=True, extra_repos={})
+    chroot = get_chroot(name, extra_repos={}, default=default)
+    assert isinstance(chroot, BuildChroot)
+    return chroot
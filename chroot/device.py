@@ -14,6 +14,16 @@ from .abstract import get_chroot
 class DeviceChroot(BuildChroot):
 
     copy_base: bool = False
+    pacman_build_profile: bool = False
+    # NoExtract patterns of the device profile, see `rootfs.get_no_extract_patterns()`
+    no_extract: list[str] = []
+
+    def write_pacman_conf(self, check_space: Optional[bool] = None, no_extract: Optional[list[str]] = None, build_profile: Optional[bool] = None):
+        super().write_pacman_conf(
+            check_space=check_space,
+            no_extract=self.no_extract if no_extract is None else no_extract,
+            build_profile=build_profile,
+        )
 
     def create_rootfs(self, reset, pacman_conf_target, active_previously):
         clss = BuildChroot if self.copy_base else BaseChroot
@@ -48,6 +58,7 @@ def get_device_chroot(
     packages: list[str] = BASE_PACKAGES,
     use_local_repos: bool = True,
     extra_repos: Optional[dict] = None,
+    no_extract: Optional[list[str]] = None,
     **kwargs,
 ) -> DeviceChroot:
     name = f'rootfs_{device}-{flavour}'
@@ -57,4 +68,6 @@ def get_device_chroot(
     default = DeviceChroot(name, arch, initialize=False, copy_base=False, base_packages=packages, extra_repos=repos)
     chroot = get_chroot(name, **kwargs, extra_repos=repos, default=default)
     assert isinstance(chroot, DeviceChroot)
+    if no_extract is not None:
+        chroot.no_extract = list(no_extract)
     return chroot
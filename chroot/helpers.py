@@ -7,6 +7,7 @@ from constants import Arch
 BIND_BUILD_DIRS = 'BINDBUILDDIRS'
 BASE_CHROOT_PREFIX = 'base_'
 BUILD_CHROOT_PREFIX = 'build_'
+PREFETCH_CHROOT_PREFIX = 'prefetch_'
 
 
 class MountEntry(TypedDict):
@@ -71,4 +72,11 @@ def base_chroot_name(arch: Arch):
 
 
 def build_chroot_name(arch: Arch):
-    return BUILD_CHROOT_PREFIX + arch
+    # concurrent builds on a build worker each need their own chroot
+    slot = config.runtime['build_slot']
+    return BUILD_CHROOT_PREFIX + arch + (f'_slot{slot}' if slot else '')
+
+
+def prefetch_chroot_name(arch: Arch):
+    slot = config.runtime['build_slot']
+    return PREFETCH_CHROOT_PREFIX + arch + (f'_slot{slot}' if slot else '')
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from glob import glob
+from typing import Iterable, Iterator, Optional
+
+from config import config
+from constants import Arch
+from distro.distro import get_kupfer_local
+from utils import mount, umount
+
+from .abstract import Chroot
+
+SNAPSHOT_PACKAGES = 'packages.json'
+SNAPSHOT_ROOTFS = 'rootfs'
+
+
+def get_snapshots_dir(arch: Arch) -> str:
+    return os.path.join(config.get_path('chroots'), 'snapshots', arch)
+
+
+def get_snapshot_key(packages: Iterable[str]) -> str:
+    return hashlib.sha256('\n'.join(sorted(set(packages))).encode()).hexdigest()
+
+
+def get_snapshots(arch: Arch) -> dict[str, set[str]]:
+    """Returns the dependency sets of the snapshots for `arch` by key"""
+    snapshots = {}
+    for path in glob(os.path.join(get_snapshots_dir(arch), '*', SNAPSHOT_PACKAGES)):
+        with open(path, 'r') as file:
+            snapshots[os.path.basename(os.path.dirname(path))] = set(json.load(file))
+    return snapshots
+
+
+def find_closest_snapshot(arch: Arch, packages: Iterable[str], max_extra: int = 0) -> Optional[str]:
+    """
+    Returns the key of the snapshot that leaves the fewest of `packages` to install,
+    with at most `max_extra` packages installed that weren't asked for, or None if no snapshot shares any packages.
+    """
+    wanted = set(packages)
+    candidates = []
+    for key, installed in get_snapshots(arch).items():
+        missing, extra = wanted - installed, installed - wanted
+        if len(extra) <= max_extra and len(missing) < len(wanted):
+            candidates.append((len(missing), len(extra), key))
+    return min(candidates)[2] if candidates else None
+
+
+@contextmanager
+def bind_view(chroot: Chroot) -> Iterator[str]:
+    """Yields a non-recursive bind mount of the chroot's root, which doesn't show the mounts inside the chroot"""
+    with tempfile.TemporaryDirectory(dir=config.get_path('chroots'), prefix='.view_') as view:
+        result = mount(chroot.path, view, options=['bind'], register_unmount=False)
+        if result.returncode != 0:
+            raise Exception(f'{chroot.name}: failed to bind mount {chroot.path} to {view}')
+        try:
+            yield view
+        finally:
+            umount(view)
+
+
+def reflink_copy(source: str, dest: str):
+    """Copies the contents of `source` into `dest`, sharing the data blocks on filesystems that support reflinks"""
+    os.makedirs(dest, exist_ok=True)
+    result = subprocess.run(['cp', '-a', '--reflink=auto', f'{source}/.', dest])
+    if result.returncode != 0:
+        raise Exception(f'Failed to copy {source} to {dest}')
+
+
+def restore_snapshot(chroot: Chroot, packages: Iterable[str]) -> Optional[set[str]]:
+    """
+    Replaces the rootfs of `chroot` with a copy of the closest snapshot for `packages`.
+    Returns the dependency set of the snapshot or None if there's no suitable one. The chroot needs to be re-initialized afterwards.
+    """
+    key = find_closest_snapshot(chroot.arch, packages, config.file['build']['chroot_snapshot_max_extra'])
+    if not key:
+        return None
+    snapshot = os.path.join(get_snapshots_dir(chroot.arch), key)
+    installed = get_snapshots(chroot.arch)[key]
+    logging.info(f'{chroot.name}: restoring snapshot {key[:12]} with {len(installed & set(packages))}/{len(set(packages))} dependencies')
+    chroot.deactivate()
+    with bind_view(chroot) as view:
+        for entry in os.listdir(view):
+            path = os.path.join(view, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        reflink_copy(os.path.join(snapshot, SNAPSHOT_ROOTFS), view)
+    # least recently used snapshots get pruned first
+    os.utime(snapshot)
+    chroot.initialized = False
+    return installed
+
+
+def reinstall_local_packages(chroot: Chroot):
+    """
+    Reinstalls the installed packages that come from the local repos.
+    Local packages get rebuilt without version bumps when their recipe changes,
+    so `pacman -Syu` doesn't replace the stale ones a restored snapshot contains.
+    """
+    repos = [repo for repo in get_kupfer_local(chroot.arch).repos if repo in chroot.extra_repos]
+    if not repos:
+        return
+    available = chroot.run_cmd(['pacman', '-Slq'] + repos, capture_output=True)
+    installed = chroot.run_cmd(['pacman', '-Qq'], capture_output=True)
+    assert isinstance(available, subprocess.CompletedProcess) and isinstance(installed, subprocess.CompletedProcess)
+    if available.returncode != 0 or installed.returncode != 0:
+        raise Exception(f'{chroot.name}: failed to list installed local packages')
+    packages = sorted(set(available.stdout.decode().split()) & set(installed.stdout.decode().split()))
+    if not packages:
+        return
+    logging.info(f'{chroot.name}: reinstalling {len(packages)} local packages from the restored snapshot')
+    result = chroot.run_cmd(['pacman', '-S', '--noconfirm'] + packages)
+    assert isinstance(result, subprocess.CompletedProcess)
+    if result.returncode != 0:
+        raise Exception(f'{chroot.name}: failed to reinstall local packages')
+
+
+def save_snapshot(chroot: Chroot, packages: Iterable[str]):
+    """Snapshots the rootfs of `chroot` with the dependency set `packages` installed and prunes old snapshots"""
+    key = get_snapshot_key(packages)
+    snapshots_dir = get_snapshots_dir(chroot.arch)
+    snapshot = os.path.join(snapshots_dir, key)
+    if os.path.exists(snapshot):
+        os.utime(snapshot)
+        return
+    logging.info(f'{chroot.name}: saving snapshot {key[:12]}')
+    os.makedirs(snapshots_dir, exist_ok=True)
+    tmp = snapshot + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    with bind_view(chroot) as view:
+        reflink_copy(view, os.path.join(tmp, SNAPSHOT_ROOTFS))
+    with open(os.path.join(tmp, SNAPSHOT_PACKAGES), 'w') as file:
+        json.dump(sorted(set(packages)), file)
+    os.rename(tmp, snapshot)
+    prune_snapshots(chroot.arch, config.file['build']['chroot_snapshots'])
+
+
+def prune_snapshots(arch: Arch, keep: int):
+    snapshots = sorted(glob(os.path.join(get_snapshots_dir(arch), '*', '')), key=os.path.getmtime, reverse=True)
+    for snapshot in snapshots[keep:]:
+        logging.info(f'Pruning chroot snapshot {os.path.basename(os.path.dirname(snapshot))[:12]} ({arch})')
+        shutil.rmtree(snapshot)
@@ -24,6 +24,8 @@ class Profile(TypedDict, total=False):
     username: str
     password: Optional[str]
     size_extra_mb: Union[str, int]
+    no_extract: list[str]
+    locales_keep: list[str]
 
 
 PROFILE_DEFAULTS: Profile = {
@@ -36,6 +38,8 @@ PROFILE_DEFAULTS: Profile = {
     'username': 'kupfer',
     'password': None,
     'size_extra_mb': "0",
+    'no_extract': [],  # NoExtract sets for a slim rootfs, see constants.NO_EXTRACT_SETS
+    'locales_keep': ['en'],  # locales to keep if `no_extract` includes locales
 }
 
 PROFILE_EMPTY: Profile = {key: None for key in PROFILE_DEFAULTS.keys()}  # type: ignore
@@ -46,10 +50,21 @@ CONFIG_DEFAULTS: dict = {
     },
     'build': {
         'ccache': True,
+        'ccache_max_size': '10G',  # also used for sccache. empty: tool default
+        'ccache_evict_older_than': '',  # e.g. 30d
+        'pacman_build_profile': True,  # skip docs, locales and cache-updating hooks when installing into build chroots
+        'prefetch_dependencies': True,  # download all remote build dependencies in one pacman transaction before building
+        'source_prefetch_jobs': 4,  # concurrent source downloads while building. 0: fetch right before each build
+        'sources_max_size': '50G',  # shared source cache, pruned least recently used first. empty: unlimited
+        'chroot_snapshots': 4,  # dependency set snapshots of clean build chroots kept per arch. 0: disabled
+        'chroot_snapshot_max_extra': 10,  # unrequested packages a snapshot may have installed to be used
         'clean_mode': True,
         'crosscompile': True,
         'crossdirect': True,
         'threads': 0,
+        'distcc_hosts': [],  # DISTCC_HOSTS entries, e.g. `buildbox/8,lzo,cpp`. volunteers need the native arch of this machine
+        'distcc_pump': True,
+        'workers': [],  # e.g. ssh://user@host:22/?arch=aarch64&slots=2, see packages/workers.py
     },
     'pkgbuilds': {
         'git_repo': 'https://gitlab.com/kupfer/packages/pkgbuilds.git',
@@ -60,6 +75,12 @@ CONFIG_DEFAULTS: dict = {
         'check_space': False,  # TODO: True causes issues
         'repo_branch': DEFAULT_PACKAGE_BRANCH,
     },
+    'binary_cache': {
+        'enabled': False,
+        'url': '',  # empty: the local binary_cache path; otherwise a directory, file:// or http(s):// URL
+        'push': True,
+        'parallel_transfers': 4,
+    },
     'paths': {
         'cache_dir': CACHE_DIR,
         'chroots': os.path.join('%cache_dir%', 'chroots'),
@@ -68,6 +89,11 @@ CONFIG_DEFAULTS: dict = {
         'pkgbuilds': os.path.join('%cache_dir%', 'pkgbuilds'),
         'jumpdrive': os.path.join('%cache_dir%', 'jumpdrive'),
         'images': os.path.join('%cache_dir%', 'images'),
+        'rootfs': os.path.join('%cache_dir%', 'rootfs'),
+        'binary_cache': os.path.join('%cache_dir%', 'binary_cache'),
+        'ccache': os.path.join('%cache_dir%', 'ccache'),
+        'sources': os.path.join('%cache_dir%', 'sources'),
+        'build_dirs': os.path.join('%cache_dir%', 'build_dirs'),
     },
     'profiles': {
         'current': 'default',
@@ -83,6 +109,7 @@ CONFIG_RUNTIME_DEFAULTS = {
     'no_wrap': False,
     'script_source_dir': os.path.dirname(os.path.realpath(__file__)),
     'error_shell': False,
+    'build_slot': 0,
 }
 
 
@@ -2,6 +2,8 @@ from typing_extensions import TypeAlias
 from typing import TypedDict
 
 FASTBOOT = 'fastboot'
+# partition to flash the full image to when flashing the rootfs via fastboot
+FASTBOOT_ROOTFS_PARTITION = 'userdata'
 FLASH_PARTS = {
     'ROOTFS': 'rootfs',
     'ABOOT': 'aboot',
@@ -146,6 +148,38 @@ CFLAGS_ARCHES: dict[Arch, list[str]] = {
 QEMU_BINFMT_PKGS = ['qemu-user-static-bin', 'binfmt-qemu-static']
 CROSSDIRECT_PKGS = ['crossdirect'] + QEMU_BINFMT_PKGS
 
+# NoExtract pattern sets that device profiles can select with `no_extract`. Later patterns win, `!` re-includes.
+NO_EXTRACT_SETS = {
+    'docs': [
+        'usr/share/doc/*',
+        'usr/share/gtk-doc/*',
+        'usr/share/help/*',
+        'usr/share/info/*',
+    ],
+    'man': ['usr/share/man/*'],
+    # profiles' `locales_keep` get re-included
+    'locales': [
+        'usr/share/locale/*',
+        '!usr/share/locale/locale.alias',
+    ],
+    'static': ['usr/lib/*.a'],
+}
+
+# pacman profile for build chroots: files and hooks that don't matter for building packages
+BUILD_CHROOT_NO_EXTRACT = NO_EXTRACT_SETS['docs'] + NO_EXTRACT_SETS['man'] + NO_EXTRACT_SETS['locales']
+BUILD_CHROOT_SKIP_HOOKS = [
+    '30-systemd-catalog.hook',
+    '30-systemd-hwdb.hook',
+    'fontconfig.hook',
+    'gtk-update-icon-cache.hook',
+    'gtk4-update-icon-cache.hook',
+    'man-db.hook',
+    'texinfo-install.hook',
+    'texinfo-remove.hook',
+    'update-desktop-database.hook',
+    'xorg-mkfontscale.hook',
+]
+
 SSH_DEFAULT_HOST = '172.16.42.1'
 SSH_DEFAULT_PORT = 22
 SSH_COMMON_OPTIONS = [
@@ -164,6 +198,11 @@ CHROOT_PATHS = {
     'packages': '/prebuilts',
     'pkgbuilds': '/pkgbuilds',
     'images': '/images',
+    'rootfs': '/var/cache/rootfs',
+    'binary_cache': '/var/cache/binary_cache',
+    'ccache': '/var/cache/ccache',
+    'sources': '/var/cache/sources',
+    'build_dirs': '/var/cache/build_dirs',
 }
 
 WRAPPER_TYPES = [
@@ -1,11 +1,21 @@
+import re
 from typing import Optional
 
 
+def get_dependency_name(dependency: str) -> str:
+    """Strips version constraints like `>=1.0` from a depends or provides entry"""
+    return re.split(r'[<>=]', dependency, maxsplit=1)[0].strip()
+
+
 class PackageInfo:
     name: str
     version: str
     filename: str
     resolved_url: Optional[str]
+    # in bytes, from the repo database
+    installed_size: int
+    depends: list[str]
+    provides: list[str]
 
     def __init__(
         self,
@@ -13,11 +23,17 @@ class PackageInfo:
         version: str,
         filename: str,
         resolved_url: str = None,
+        installed_size: int = 0,
+        depends: list[str] = [],
+        provides: list[str] = [],
     ):
         self.name = name
         self.version = version
         self.filename = filename
         self.resolved_url = resolved_url
+        self.installed_size = installed_size
+        self.depends = list(depends)
+        self.provides = list(provides)
 
     def __repr__(self):
         return f'{self.name}@{self.version}'
@@ -26,8 +42,20 @@ class PackageInfo:
     def parse_desc(desc_str: str, resolved_url=None):
         """Parses a desc file, returning a PackageInfo"""
 
-        pruned_lines = ([line.strip() for line in desc_str.split('%') if line.strip()])
-        desc = {}
-        for key, value in zip(pruned_lines[0::2], pruned_lines[1::2]):
-            desc[key.strip()] = value.strip()
-        return PackageInfo(desc['NAME'], desc['VERSION'], desc['FILENAME'], resolved_url='/'.join([resolved_url, desc['FILENAME']]))
+        desc = dict[str, list[str]]()
+        values: list[str] = []
+        for line in desc_str.splitlines():
+            line = line.strip()
+            if re.fullmatch(r'%[A-Z0-9]+%', line):
+                values = desc.setdefault(line.strip('%'), [])
+            elif line:
+                values.append(line)
+        return PackageInfo(
+            desc['NAME'][0],
+            desc['VERSION'][0],
+            desc['FILENAME'][0],
+            resolved_url='/'.join([resolved_url, desc['FILENAME'][0]]),
+            installed_size=int(desc.get('ISIZE', ['0'])[0]),
+            depends=[get_dependency_name(dependency) for dependency in desc.get('DEPENDS', [])],
+            provides=[get_dependency_name(provided) for provided in desc.get('PROVIDES', [])],
+        )
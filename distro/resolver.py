@@ -0,0 +1,121 @@
+from array import array
+from typing import Iterable, Iterator, Optional
+
+from constants import Arch
+
+from .distro import Distro, get_base_distro, get_kupfer_https, get_kupfer_local
+from .package import PackageInfo, get_dependency_name
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """Yields the positions of the set bits of `mask`, lowest first"""
+    bits = bin(mask)[:1:-1]
+    position = bits.find('1')
+    while position != -1:
+        yield position
+        position = bits.find('1', position + 1)
+
+
+class PackageIndex:
+    """
+    The packages of a set of distros, overlaid in pacman's repo priority order:
+    the first repo containing a package name wins and so does the first provider of a name.
+
+    For resolving, packages get integer IDs and their dependencies are stored as CSR adjacency arrays:
+    the dependency IDs of package `i` are `targets[offsets[i]:offsets[i + 1]]`.
+    Closures are computed as a BFS over bitsets, with the dependencies of each package as a bitmask.
+    """
+    packages: dict[str, PackageInfo]
+    providers: dict[str, PackageInfo]
+    names: list[str]
+    # package and provided names to package IDs
+    ids: dict[str, int]
+    offsets: array
+    targets: array
+    # dependencies no package satisfies by package ID
+    unsatisfied: dict[int, list[str]]
+    masks: list[Optional[int]]
+
+    def __init__(self, distros: Iterable[Distro]):
+        self.packages = {}
+        self.providers = {}
+        for distro in distros:
+            for repo in distro.repos.values():
+                assert repo.scanned, f'repo {repo.name} needs to be scanned'
+                for name, package in repo.packages.items():
+                    if self.packages.setdefault(name, package) is not package:
+                        continue
+                    for provided in package.provides:
+                        self.providers.setdefault(provided, package)
+        self.compile()
+
+    def compile(self):
+        self.names = list(self.packages.keys())
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        for provided, package in self.providers.items():
+            self.ids.setdefault(provided, self.ids[package.name])
+        self.offsets = array('L', [0])
+        self.targets = array('L')
+        self.unsatisfied = {}
+        for i, name in enumerate(self.names):
+            for dependency in self.packages[name].depends:
+                target = self.ids.get(get_dependency_name(dependency))
+                if target is None:
+                    self.unsatisfied.setdefault(i, []).append(dependency)
+                else:
+                    self.targets.append(target)
+            self.offsets.append(len(self.targets))
+        self.masks = [None] * len(self.names)
+
+    def find(self, dependency: str) -> Optional[PackageInfo]:
+        """Returns the package satisfying `dependency`, preferring a package of that name over providers like pacman does"""
+        id = self.ids.get(get_dependency_name(dependency))
+        return self.packages[self.names[id]] if id is not None else None
+
+    def get_mask(self, id: int) -> int:
+        """The dependencies of package `id` as a bitmask, built on first use"""
+        mask = self.masks[id]
+        if mask is None:
+            mask = 0
+            for target in self.targets[self.offsets[id]:self.offsets[id + 1]]:
+                mask |= 1 << target
+            self.masks[id] = mask
+        return mask
+
+    def resolve_ids(self, ids: Iterable[int]) -> int:
+        """Returns the transitive closure of the package `ids` as a bitmask"""
+        closure = frontier = sum(1 << id for id in set(ids))
+        while frontier:
+            reached = 0
+            for id in iter_bits(frontier):
+                reached |= self.get_mask(id)
+            frontier = reached & ~closure
+            closure |= frontier
+        return closure
+
+    def resolve(self, names: Iterable[str]) -> tuple[dict[str, PackageInfo], set[str]]:
+        """
+        Returns the packages installing `names` pulls in, including all transitive dependencies,
+        and the dependencies that no package satisfies. Version constraints are ignored.
+        """
+        ids = set[int]()
+        missing = set[str]()
+        for name in names:
+            id = self.ids.get(get_dependency_name(name))
+            if id is None:
+                missing.add(name)
+            else:
+                ids.add(id)
+        closure = dict[str, PackageInfo]()
+        for id in iter_bits(self.resolve_ids(ids)):
+            closure[self.names[id]] = self.packages[self.names[id]]
+            missing.update(self.unsatisfied.get(id, []))
+        return closure, missing
+
+
+def get_package_index(arch: Arch, use_local_repos: bool = True) -> PackageIndex:
+    """Scans the kupfer and base distro repos for `arch` and indexes them in the same order as the device chroots' pacman.conf"""
+    kupfer = get_kupfer_local(arch, in_chroot=False, scan=True) if use_local_repos else get_kupfer_https(arch, scan=True)
+    base = get_base_distro(arch)
+    base.scan()
+    return PackageIndex([kupfer, base])
@@ -0,0 +1,272 @@
+import mmap
+import os
+import stat
+import struct
+from typing import Iterator, Optional
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_SIZE = 1024
+EXT_MAGIC = 0xEF53
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+EXT_ROOT_INODE = 2
+EXT_GOOD_OLD_INODE_SIZE = 128
+EXT_GOOD_OLD_DESC_SIZE = 32
+
+EXT_INODE_FLAG_EXTENTS = 0x80000
+EXT_INODE_FLAG_INLINE_DATA = 0x10000000
+EXT_EXTENT_MAGIC = 0xF30A
+EXT_EXTENT_HEADER = struct.Struct('<HHHHI')
+# logical block, length, physical block high 16 bits, physical block low 32 bits
+EXT_EXTENT = struct.Struct('<IHHI')
+# logical block, child node block low 32 bits, child node block high 16 bits
+EXT_EXTENT_INDEX = struct.Struct('<IIH2x')
+# lengths above this mark uninitialized (preallocated) extents that read as zeroes
+EXT_INIT_MAX_LEN = 32768
+EXT_DIRECT_BLOCKS = 12
+EXT_DIRENT = struct.Struct('<IHBB')
+
+# (logical block, physical block, block count); physical block 0 means zeroes
+BlockRun = tuple[int, int, int]
+
+
+class Superblock:
+    blocks_count: int
+    free_blocks_count: int
+    block_size: int
+    feature_incompat: int
+    first_data_block: int
+    inodes_per_group: int
+    inode_size: int
+    desc_size: int
+
+    def __init__(
+        self,
+        blocks_count: int,
+        free_blocks_count: int,
+        block_size: int,
+        feature_incompat: int,
+        first_data_block: int = 0,
+        inodes_per_group: int = 0,
+        inode_size: int = EXT_GOOD_OLD_INODE_SIZE,
+        desc_size: int = EXT_GOOD_OLD_DESC_SIZE,
+    ):
+        self.blocks_count = blocks_count
+        self.free_blocks_count = free_blocks_count
+        self.block_size = block_size
+        self.feature_incompat = feature_incompat
+        self.first_data_block = first_data_block
+        self.inodes_per_group = inodes_per_group
+        self.inode_size = inode_size
+        self.desc_size = desc_size
+
+    def __repr__(self):
+        return f'Superblock({self.blocks_count} blocks of {self.block_size} bytes, {self.free_blocks_count} free)'
+
+    def fs_size(self) -> int:
+        return self.blocks_count * self.block_size
+
+    def is_64bit(self) -> bool:
+        return bool(self.feature_incompat & EXT_FEATURE_INCOMPAT_64BIT)
+
+    @staticmethod
+    def unpack(data: bytes) -> 'Superblock':
+        if len(data) < EXT_SUPERBLOCK_SIZE:
+            raise Exception('ext superblock is truncated')
+        blocks_lo, _, free_blocks_lo, _, first_data_block, log_block_size = struct.unpack_from('<IIIIII', data, 0x4)
+        inodes_per_group, = struct.unpack_from('<I', data, 0x28)
+        magic, = struct.unpack_from('<H', data, 0x38)
+        if magic != EXT_MAGIC:
+            raise Exception(f'Not an ext2/3/4 filesystem: bad magic {hex(magic)}')
+        rev_level, = struct.unpack_from('<I', data, 0x4C)
+        inode_size, = struct.unpack_from('<H', data, 0x58)
+        feature_incompat, = struct.unpack_from('<I', data, 0x60)
+        desc_size, = struct.unpack_from('<H', data, 0xFE)
+        blocks_hi = free_blocks_hi = 0
+        if feature_incompat & EXT_FEATURE_INCOMPAT_64BIT:
+            blocks_hi, _, free_blocks_hi = struct.unpack_from('<III', data, 0x150)
+        else:
+            desc_size = EXT_GOOD_OLD_DESC_SIZE
+        return Superblock(
+            blocks_count=blocks_hi << 32 | blocks_lo,
+            free_blocks_count=free_blocks_hi << 32 | free_blocks_lo,
+            block_size=1024 << log_block_size,
+            feature_incompat=feature_incompat,
+            first_data_block=first_data_block,
+            inodes_per_group=inodes_per_group,
+            inode_size=inode_size if rev_level >= 1 else EXT_GOOD_OLD_INODE_SIZE,
+            desc_size=desc_size or EXT_GOOD_OLD_DESC_SIZE,
+        )
+
+
+def read_superblock(path: str, offset: int = 0) -> Superblock:
+    """Reads the superblock of the ext2/3/4 filesystem starting at byte `offset` of `path`"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return Superblock.unpack(os.pread(fd, EXT_SUPERBLOCK_SIZE, offset + EXT_SUPERBLOCK_OFFSET))
+    finally:
+        os.close(fd)
+
+
+class Inode:
+    number: int
+    mode: int
+    size: int
+    flags: int
+    block: bytes
+
+    def __init__(self, number: int, data: bytes):
+        self.number = number
+        self.mode, _, size_lo = struct.unpack_from('<HHI', data, 0x0)
+        self.flags, = struct.unpack_from('<I', data, 0x20)
+        self.block = bytes(data[0x28:0x28 + 60])
+        size_hi, = struct.unpack_from('<I', data, 0x6C)
+        self.size = size_hi << 32 | size_lo
+
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.mode)
+
+    def is_file(self) -> bool:
+        return stat.S_ISREG(self.mode)
+
+
+class Ext2Reader:
+    """
+    Minimal read-only ext2/3/4 reader working on an image file through mmap.
+    `offset` is the byte offset of the filesystem, e.g. of a partition inside a full disk image.
+    Supports block-mapped and extent-mapped files, no inline data.
+    """
+    path: str
+    offset: int
+    superblock: Superblock
+
+    def __init__(self, path: str, offset: int = 0):
+        self.path = path
+        self.offset = offset
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.superblock = Superblock.unpack(self._map[offset + EXT_SUPERBLOCK_OFFSET:offset + EXT_SUPERBLOCK_OFFSET + EXT_SUPERBLOCK_SIZE])
+
+    def __enter__(self) -> 'Ext2Reader':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def read_blocks(self, block: int, count: int = 1) -> bytes:
+        block_size = self.superblock.block_size
+        start = self.offset + block * block_size
+        if block + count > self.superblock.blocks_count or start + count * block_size > len(self._map):
+            raise Exception(f'{self.path}: block {block}+{count} is outside of the filesystem')
+        return self._map[start:start + count * block_size]
+
+    def get_inode(self, number: int) -> Inode:
+        sb = self.superblock
+        group, index = divmod(number - 1, sb.inodes_per_group)
+        # the group descriptor table starts in the block after the superblock
+        descriptors_offset = (sb.first_data_block + 1) * sb.block_size + group * sb.desc_size
+        descriptor = self.read_blocks(0, descriptors_offset // sb.block_size + 1)[descriptors_offset:descriptors_offset + sb.desc_size]
+        inode_table, = struct.unpack_from('<I', descriptor, 0x8)
+        if sb.is_64bit() and sb.desc_size >= 64:
+            inode_table |= struct.unpack_from('<I', descriptor, 0x28)[0] << 32
+        inode_offset = index * sb.inode_size
+        table_block = inode_table + inode_offset // sb.block_size
+        data = self.read_blocks(table_block)[inode_offset % sb.block_size:][:sb.inode_size]
+        return Inode(number, data)
+
+    def _extent_runs(self, node: bytes) -> Iterator[BlockRun]:
+        magic, entries, _, depth, _ = EXT_EXTENT_HEADER.unpack_from(node, 0)
+        if magic != EXT_EXTENT_MAGIC:
+            raise Exception(f'{self.path}: bad extent header magic {hex(magic)}')
+        for i in range(entries):
+            position = EXT_EXTENT_HEADER.size + i * EXT_EXTENT.size
+            if depth == 0:
+                logical, length, start_hi, start_lo = EXT_EXTENT.unpack_from(node, position)
+                if length > EXT_INIT_MAX_LEN:
+                    yield (logical, 0, length - EXT_INIT_MAX_LEN)
+                else:
+                    yield (logical, start_hi << 32 | start_lo, length)
+            else:
+                _, leaf_lo, leaf_hi = EXT_EXTENT_INDEX.unpack_from(node, position)
+                yield from self._extent_runs(self.read_blocks(leaf_hi << 32 | leaf_lo))
+
+    def _indirect_runs(self, block: int, level: int, logical: int) -> Iterator[BlockRun]:
+        """Yields the runs of the `level`-times indirect block `block`, mapping logical blocks from `logical` on"""
+        pointers = self.superblock.block_size // 4
+        span = pointers**(level - 1)
+        for i, pointer in enumerate(struct.unpack(f'<{pointers}I', self.read_blocks(block))):
+            if pointer == 0:
+                continue
+            if level == 1:
+                yield (logical + i, pointer, 1)
+            else:
+                yield from self._indirect_runs(pointer, level - 1, logical + i * span)
+
+    def get_block_runs(self, inode: Inode) -> Iterator[BlockRun]:
+        if inode.flags & EXT_INODE_FLAG_INLINE_DATA:
+            raise Exception(f'{self.path}: inode {inode.number} uses inline data, which is not supported')
+        if inode.flags & EXT_INODE_FLAG_EXTENTS:
+            yield from self._extent_runs(inode.block)
+            return
+        pointers = struct.unpack('<15I', inode.block)
+        for i, pointer in enumerate(pointers[:EXT_DIRECT_BLOCKS]):
+            if pointer:
+                yield (i, pointer, 1)
+        per_block = self.superblock.block_size // 4
+        logical = EXT_DIRECT_BLOCKS
+        for level, pointer in enumerate(pointers[EXT_DIRECT_BLOCKS:], start=1):
+            if pointer:
+                yield from self._indirect_runs(pointer, level, logical)
+            logical += per_block**level
+
+    def read_inode(self, inode: Inode) -> bytes:
+        """Returns the contents of `inode`, with holes and uninitialized extents as zeroes"""
+        block_size = self.superblock.block_size
+        data = bytearray(inode.size)
+        for logical, physical, count in self.get_block_runs(inode):
+            start = logical * block_size
+            if physical == 0 or start >= inode.size:
+                continue
+            length = min(count * block_size, inode.size - start)
+            data[start:start + length] = self.read_blocks(physical, count)[:length]
+        return bytes(data)
+
+    def list_dir(self, inode: Inode) -> dict[str, int]:
+        """Returns a mapping of names to inode numbers of the directory `inode`"""
+        if not inode.is_dir():
+            raise Exception(f'{self.path}: inode {inode.number} is not a directory')
+        data = self.read_inode(inode)
+        entries = {}
+        position = 0
+        while position + EXT_DIRENT.size <= len(data):
+            number, rec_len, name_len, _ = EXT_DIRENT.unpack_from(data, position)
+            if rec_len < EXT_DIRENT.size:
+                raise Exception(f'{self.path}: corrupt directory entry in inode {inode.number}')
+            if number:
+                name = data[position + EXT_DIRENT.size:position + EXT_DIRENT.size + name_len].decode('utf-8', errors='surrogateescape')
+                entries[name] = number
+            position += rec_len
+        return entries
+
+    def lookup(self, path: str) -> Optional[Inode]:
+        """Resolves the absolute `path` to its inode, returns None if it doesn't exist. Symlinks aren't followed."""
+        inode = self.get_inode(EXT_ROOT_INODE)
+        for name in filter(None, path.split('/')):
+            if not inode.is_dir():
+                return None
+            number = self.list_dir(inode).get(name)
+            if number is None:
+                return None
+            inode = self.get_inode(number)
+        return inode
+
+    def read_file(self, path: str) -> bytes:
+        inode = self.lookup(path)
+        if inode is None:
+            raise Exception(f'{path} not found in the filesystem at {self.path}:{self.offset}')
+        if not inode.is_file():
+            raise Exception(f'{path} in the filesystem at {self.path}:{self.offset} is not a regular file')
+        return self.read_inode(inode)
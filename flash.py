@@ -1,29 +1,87 @@
-import atexit
-import shutil
+import json
 import os
-import subprocess
 import click
-import tempfile
+import logging
 
-from constants import FLASH_PARTS, LOCATIONS
+from constants import BOOT_STRATEGIES, FASTBOOT, FASTBOOT_ROOTFS_PARTITION, FLASH_PARTS, LOCATIONS
 from fastboot import fastboot_flash
-from image import dd_image, partprobe, shrink_fs, losetup_rootfs_image, dump_aboot, dump_lk2nd, dump_qhypstub, get_device_and_flavour, get_image_name, get_image_path
+from blockcopy import copy_image, get_fd_size
+from bmap import flash_bmap_image
+from sparse_image import write_sparse_image
+from ext2 import read_superblock
+from image import shrink_fs, dump_aboot, dump_lk2nd, dump_qhypstub, get_device_and_flavour, get_image_path, get_image_stamp
+from partitions import read_partition_table
 from wrapper import enforce_wrap
 
 ABOOT = FLASH_PARTS['ABOOT']
 LK2ND = FLASH_PARTS['LK2ND']
 QHYPSTUB = FLASH_PARTS['QHYPSTUB']
 ROOTFS = FLASH_PARTS['ROOTFS']
+# images sized to their rootfs by `image build` have less free space than this and get flashed without shrinking
+SHRINK_MIN_FREE_MB = 1024
+
+
+def get_rootfs_free_mb(device_image_path: str, sector_size: int, root_partition: int = 2) -> int:
+    offset, _ = read_partition_table(device_image_path, sector_size).get_offset(root_partition)
+    superblock = read_superblock(device_image_path, offset)
+    return superblock.free_blocks_count * superblock.block_size // (1024 * 1024)
+
+
+def get_minimal_image(device_image_path: str, sector_size: int) -> str:
+    """
+    Returns the path to a copy of `device_image_path` with the rootfs shrunk to its minimal size.
+    The copy is cached next to the image and keyed by the image's mtime and size,
+    so reflashing an unchanged image doesn't need to shrink it again.
+    """
+    image_dir, image_name = os.path.split(device_image_path)
+    minimal_image_path = os.path.join(image_dir, f'minimal-{image_name}')
+    stamp_path = minimal_image_path + '.json'
+    stamp = get_image_stamp(device_image_path)
+    if os.path.exists(minimal_image_path) and os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as file:
+            cached = json.load(file)
+        if cached.get('source') == stamp and cached.get('minimal') == get_image_stamp(minimal_image_path):
+            logging.info(f'Reusing cached minimal image {minimal_image_path}')
+            return minimal_image_path
+        logging.debug(f'Cached minimal image {minimal_image_path} is outdated: {cached} != {stamp}')
+    if os.path.exists(stamp_path):
+        os.unlink(stamp_path)
+
+    logging.info(f'Creating minimal image {minimal_image_path}')
+    # copy_file_range() reflinks on supporting filesystems and only copies data extents otherwise
+    copy_image(device_image_path, minimal_image_path)
+    shrink_fs(minimal_image_path, sector_size)
+    with open(stamp_path, 'w') as file:
+        json.dump({'source': stamp, 'minimal': get_image_stamp(minimal_image_path)}, file)
+    return minimal_image_path
+
+
+def get_sparse_image(device_image_path: str) -> str:
+    """Returns the path to an android sparse version of `device_image_path` for fastboot, regenerating it if the image is newer"""
+    image_dir, image_name = os.path.split(device_image_path)
+    sparse_image_path = os.path.join(image_dir, f'sparse-{image_name}')
+    if os.path.exists(sparse_image_path) and os.path.getmtime(sparse_image_path) >= os.path.getmtime(device_image_path):
+        logging.info(f'Reusing sparse image {sparse_image_path}')
+    else:
+        write_sparse_image(device_image_path, sparse_image_path)
+    return sparse_image_path
 
 
 @click.command(name='flash')
 @click.argument('what', type=click.Choice(list(FLASH_PARTS.values())))
 @click.argument('location', type=str, required=False)
-def cmd_flash(what: str, location: str):
-    """Flash a partition onto a device. `location` takes either a path to a block device or one of emmc, sdcard"""
+@click.option('--bmap-image',
+              type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Flash the rootfs from a (compressed) image and its .bmap file, writing only mapped blocks')
+def cmd_flash(what: str, location: str, bmap_image: str = None):
+    """
+    Flash a partition onto a device. `location` takes either a path to a block device or one of emmc, sdcard.
+
+    Pass `fastboot` as location to flash the rootfs as an android sparse image via fastboot instead of JumpDrive.
+    """
     enforce_wrap()
     device, flavour = get_device_and_flavour()
-    device_image_name = get_image_name(device, flavour)
     device_image_path = get_image_path(device, flavour)
 
     # TODO: PARSE DEVICE SECTOR SIZE
@@ -31,62 +89,66 @@ def cmd_flash(what: str, location: str):
 
     if what not in FLASH_PARTS.values():
         raise Exception(f'Unknown what "{what}", must be one of {", ".join(FLASH_PARTS.values())}')
+    if bmap_image and what != ROOTFS:
+        raise Exception(f'--bmap-image is only supported for flashing {ROOTFS}')
 
     if what == ROOTFS:
         if location is None:
             raise Exception(f'You need to specify a location to flash {what} to')
 
+        if location == FASTBOOT:
+            if BOOT_STRATEGIES.get(device) != FASTBOOT:
+                raise Exception(f'Device {device} does not support flashing via fastboot')
+            sparse_image_path = get_sparse_image(device_image_path)
+            fastboot_flash(FASTBOOT_ROOTFS_PARTITION, sparse_image_path)
+            return
+
         path = ''
         if location.startswith("/dev/"):
             path = location
         else:
             if location not in LOCATIONS:
-                raise Exception(f'Invalid location {location}. Choose one of {", ".join(LOCATIONS)}')
+                raise Exception(f'Invalid location {location}. Choose one of {", ".join(LOCATIONS + [FASTBOOT])}')
 
             dir = '/dev/disk/by-id'
             for file in os.listdir(dir):
                 sanitized_file = file.replace('-', '').replace('_', '').lower()
                 if f'jumpdrive{location.split("-")[0]}' in sanitized_file:
                     path = os.path.realpath(os.path.join(dir, file))
-                    partprobe(path)
-                    result = subprocess.run(['lsblk', path, '-o', 'SIZE'], capture_output=True)
-                    if result.returncode != 0:
-                        raise Exception(f'Failed to lsblk {path}')
-                    if result.stdout == b'SIZE\n  0B\n':
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        size = get_fd_size(fd)
+                    finally:
+                        os.close(fd)
+                    if size == 0:
                         raise Exception(
                             f'Disk {path} has a size of 0B. That probably means it is not available (e.g. no microSD inserted or no microSD card slot installed in the device) or corrupt or defect'
                         )
             if path == '':
                 raise Exception('Unable to discover Jumpdrive')
 
-        minimal_image_dir = tempfile.gettempdir()
-        minimal_image_path = os.path.join(minimal_image_dir, f'minimal-{device_image_name}')
-
-        def clean_dir():
-            shutil.rmtree(minimal_image_dir)
-
-        atexit.register(clean_dir)
+        if bmap_image:
+            flash_bmap_image(bmap_image, path)
+            return
 
-        shutil.copyfile(device_image_path, minimal_image_path)
-
-        loop_device = losetup_rootfs_image(minimal_image_path, sector_size)
-        partprobe(loop_device)
-        shrink_fs(loop_device, minimal_image_path, sector_size)
-
-        result = dd_image(input=minimal_image_path, output=path)
+        free_mb = get_rootfs_free_mb(device_image_path, sector_size)
+        if free_mb < SHRINK_MIN_FREE_MB:
+            logging.debug(f'Rootfs has only {free_mb} MB free, not shrinking it')
+            image_path = device_image_path
+        else:
+            image_path = get_minimal_image(device_image_path, sector_size)
 
-        if result.returncode != 0:
-            raise Exception(f'Failed to flash {minimal_image_path} to {path}')
+        logging.info(f'Flashing {image_path} to {path}')
+        copy_image(image_path, path)
     else:
-        loop_device = losetup_rootfs_image(device_image_path, sector_size)
         if what == ABOOT:
-            path = dump_aboot(f'{loop_device}p1')
+            path = dump_aboot(device_image_path, sector_size)
             fastboot_flash('boot', path)
         elif what == LK2ND:
-            path = dump_lk2nd(f'{loop_device}p1')
+            path = dump_lk2nd(device_image_path, sector_size)
             fastboot_flash('lk2nd', path)
         elif what == QHYPSTUB:
-            path = dump_qhypstub(f'{loop_device}p1')
+            path = dump_qhypstub(device_image_path, sector_size)
             fastboot_flash('qhypstub', path)
         else:
             raise Exception(f'Unknown what "{what}", this must be a bug in kupferbootstrap!')
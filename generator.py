@@ -193,6 +193,7 @@ export LDFLAGS="$LDFLAGS,-L/usr/{hostspec}/lib,-L/{chroot}/usr/lib,-rpath-link,/
 def generate_pacman_conf_body(
     arch: Arch,
     check_space: bool = True,
+    no_extract: list[str] = [],
 ):
     return f'''
 #
@@ -223,7 +224,7 @@ Architecture = {arch}
 #IgnoreGroup =
 
 #NoUpgrade   =
-#NoExtract   =
+{'NoExtract   = ' + ' '.join(no_extract) if no_extract else '#NoExtract   ='}
 
 # Misc options
 #UseSyslog
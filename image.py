@@ -1,120 +1,87 @@
-import atexit
+import hashlib
 import json
 import os
-import re
+import shutil
 import subprocess
 import click
 import logging
 from signal import pause
-from subprocess import run, CompletedProcess
+from subprocess import run
 from typing import Optional
 
+from blockcopy import copy_image, get_fd_size
+from bmap import COMPRESSION_EXTENSIONS, COMPRESSIONS, compress_image, get_bmap_path
+from checkpoints import Checkpoints, Phase, run_phases
 from chroot.device import DeviceChroot, get_device_chroot
-from constants import Arch, BASE_PACKAGES, DEVICES, FLAVOURS
+from constants import Arch, BASE_PACKAGES, DEVICES, FLAVOURS, REPOSITORIES
 from config import config, Profile
 from distro.distro import get_base_distro, get_kupfer_https
+from distro.resolver import get_package_index
+from ext2 import Ext2Reader, read_superblock
 from packages import build_enable_qemu_binfmt, discover_packages, build_packages
-from ssh import copy_ssh_keys
+from loop import get_loop_device
+from partitions import MBR, PartitionTable, read_partition_table
+from rootfs import build_rootfs_layers, get_no_extract_patterns, get_rootfs_layers, install_rootfs_layers
+from ssh import copy_ssh_keys, find_ssh_keys
+from utils import format_size
 from wrapper import enforce_wrap
 
-# image files need to be slightly smaller than partitions to fit
-IMG_FILE_ROOT_DEFAULT_SIZE = "1800M"
-IMG_FILE_BOOT_DEFAULT_SIZE = "90M"
-
-
-def dd_image(input: str, output: str, blocksize='1M') -> CompletedProcess:
-    cmd = [
-        'dd',
-        f'if={input}',
-        f'of={output}',
-        f'bs={blocksize}',
-        'iflag=direct',
-        'oflag=direct',
-        'status=progress',
-        'conv=sync,noerror',
-    ]
-    logging.debug(f'running dd cmd: {cmd}')
-    return subprocess.run(cmd)
-
-
-def partprobe(device: str):
-    return subprocess.run(['partprobe', device])
-
-
-def shrink_fs(loop_device: str, file: str, sector_size: int):
-    # 8: 512 bytes sectors
-    # 1: 4096 bytes sectors
-    sectors_blocks_factor = 4096 // sector_size
-    partprobe(loop_device)
-    logging.debug(f"Checking filesystem at {loop_device}p2")
-    result = subprocess.run(['e2fsck', '-fy', f'{loop_device}p2'])
-    if result.returncode > 2:
-        # https://man7.org/linux/man-pages/man8/e2fsck.8.html#EXIT_CODE
-        raise Exception(f'Failed to e2fsck {loop_device}p2 with exit code {result.returncode}')
-
-    logging.debug(f'Shrinking filesystem at {loop_device}p2')
-    result = subprocess.run(['resize2fs', '-M', f'{loop_device}p2'], capture_output=True)
-    if result.returncode != 0:
-        print(result.stdout)
-        print(result.stderr)
-        raise Exception(f'Failed to resize2fs {loop_device}p2')
-
-    logging.debug(f'Finding end block of shrunken filesystem on {loop_device}p2')
-    blocks = int(re.search('is now [0-9]+', result.stdout.decode('utf-8')).group(0).split(' ')[2])  # type: ignore
-    sectors = blocks * sectors_blocks_factor  #+ 157812 - 25600
-
-    logging.debug(f'Shrinking partition at {loop_device}p2 to {sectors} sectors')
-    child_proccess = subprocess.Popen(
-        ['fdisk', '-b', str(sector_size), loop_device],
-        stdin=subprocess.PIPE,
-    )
-    child_proccess.stdin.write('\n'.join([  # type: ignore
-        'd',
-        '2',
-        'n',
-        'p',
-        '2',
-        '',
-        f'+{sectors}',
-        'w',
-        'q',
-    ]).encode('utf-8'))
-
-    child_proccess.communicate()
-
-    returncode = child_proccess.wait()
-    if returncode == 1:
-        # For some reason re-reading the partition table fails, but that is not a problem
-        subprocess.run(['partprobe'])
-    if returncode > 1:
-        raise Exception(f'Failed to shrink partition size of {loop_device}p2 with fdisk')
-
-    partprobe(loop_device)
-
-    logging.debug(f'Finding end sector of partition at {loop_device}p2')
-    result = subprocess.run(['fdisk', '-b', str(sector_size), '-l', loop_device], capture_output=True)
-    if result.returncode != 0:
-        print(result.stdout)
-        print(result.stderr)
-        raise Exception(f'Failed to fdisk -l {loop_device}')
-
-    end_sector = 0
-    for line in result.stdout.decode('utf-8').split('\n'):
-        if line.startswith(f'{loop_device}p2'):
-            parts = list(filter(lambda part: part != '', line.split(' ')))
-            end_sector = int(parts[2])
-
-    if end_sector == 0:
-        raise Exception(f'Failed to find end sector of {loop_device}p2')
-
-    end_size = (end_sector + 1) * sector_size
-
-    logging.debug(f'({end_sector} + 1) sectors * {sector_size} bytes/sector = {end_size} bytes')
-    logging.info(f'Truncating {file} to {end_size} bytes')
-    result = subprocess.run(['truncate', '-s', str(end_size), file])
-    if result.returncode != 0:
-        raise Exception(f'Failed to truncate {file}')
-    partprobe(loop_device)
+BOOT_PARTITION = 1
+BOOT_PARTITION_SIZE_MB = 100
+# rootfs sizing, see `get_image_size_mb()`
+ROOTFS_FREE_MB = 512
+# small repo updates shouldn't change the size and invalidate the allocate checkpoint
+ROOTFS_SIZE_STEP_MB = 256
+# for estimating the number of files from installed sizes
+ROOTFS_AVG_FILE_SIZE = 32 * 1024
+# sized rootfs filesystems get created with at least this many inodes
+ROOTFS_MIN_INODES = 100000
+# mke2fs defaults for ext4
+EXT4_INODE_SIZE = 256
+EXT4_RESERVED_RATIO = 0.05
+EXT4_JOURNAL_MB = 128
+# block bitmaps, group descriptors, extent trees and directories
+EXT4_METADATA_RATIO = 0.02
+
+
+def shrink_fs(image_path: str, sector_size: int, root_partition: int = 2):
+    """
+    Shrinks the ext4 filesystem in partition `root_partition` of `image_path` to its minimal size,
+    then shrinks the partition and truncates the image file to match.
+    The filesystem is resized in a temporary file, so no loop devices or partition rescans are needed.
+    """
+    table = read_partition_table(image_path, sector_size)
+    offset, size = table.get_offset(root_partition)
+    part_path = f'{image_path}.p{root_partition}'
+    copy_image(image_path, part_path, length=size, input_offset=offset)
+    try:
+        logging.debug(f"Checking filesystem at {part_path}")
+        result = subprocess.run(['e2fsck', '-fy', part_path])
+        if result.returncode > 2:
+            # https://man7.org/linux/man-pages/man8/e2fsck.8.html#EXIT_CODE
+            raise Exception(f'Failed to e2fsck {part_path} with exit code {result.returncode}')
+
+        logging.debug(f'Shrinking filesystem at {part_path}')
+        result = subprocess.run(['resize2fs', '-M', part_path], capture_output=True)
+        if result.returncode != 0:
+            print(result.stdout)
+            print(result.stderr)
+            raise Exception(f'Failed to resize2fs {part_path}')
+
+        fs_size = read_superblock(part_path).fs_size()
+        copy_image(part_path, image_path, length=fs_size, output_offset=offset)
+    finally:
+        os.unlink(part_path)
+
+    sectors = -(-fs_size // sector_size)
+    logging.debug(f'Shrinking partition {root_partition} of {image_path} to {sectors} sectors')
+    table.resize_partition(root_partition, sectors)
+    end_sector = table.get_partition(root_partition).end()
+    table.resize_disk(end_sector + (table.sectors - 1 - table.last_usable_sector()))
+    end_size = table.sectors * sector_size
+    logging.info(f'Truncating {image_path} to {end_size} bytes')
+    os.truncate(image_path, end_size)
+    table.write(image_path)
 
 
 def get_device_and_flavour(profile_name: Optional[str] = None) -> tuple[str, str]:
@@ -137,56 +104,6 @@ def get_image_path(device, flavour, img_type='full') -> str:
     return os.path.join(config.get_path('images'), get_image_name(device, flavour, img_type))
 
 
-def losetup_rootfs_image(image_path: str, sector_size: int) -> str:
-    logging.debug(f'Creating loop device for {image_path} with sector size {sector_size}')
-    result = subprocess.run([
-        'losetup',
-        '-f',
-        '-b',
-        str(sector_size),
-        '-P',
-        image_path,
-    ])
-    if result.returncode != 0:
-        logging.fatal(f'Failed to create loop device for {image_path}')
-        exit(1)
-
-    logging.debug(f'Finding loop device for {image_path}')
-
-    result = subprocess.run(['losetup', '-J'], capture_output=True)
-    if result.returncode != 0:
-        print(result.stdout)
-        print(result.stderr)
-        logging.fatal('Failed to list loop devices')
-        exit(1)
-
-    data = json.loads(result.stdout.decode('utf-8'))
-    loop_device = ''
-    for d in data['loopdevices']:
-        if d['back-file'] == image_path:
-            loop_device = d['name']
-            break
-
-    if loop_device == '':
-        raise Exception(f'Failed to find loop device for {image_path}')
-    partprobe(loop_device)
-
-    def losetup_destroy():
-        logging.debug(f'Destroying loop device {loop_device} for {image_path}')
-        subprocess.run(
-            [
-                'losetup',
-                '-d',
-                loop_device,
-            ],
-            stderr=subprocess.DEVNULL,
-        )
-
-    atexit.register(losetup_destroy)
-
-    return loop_device
-
-
 def mount_chroot(rootfs_source: str, boot_src: str, chroot: DeviceChroot):
     logging.debug(f'Mounting {rootfs_source} at {chroot.path}')
 
@@ -199,49 +116,56 @@ def mount_chroot(rootfs_source: str, boot_src: str, chroot: DeviceChroot):
     chroot.mount(boot_src, '/boot', options=['defaults'])
 
 
-def dump_aboot(image_path: str) -> str:
-    path = '/tmp/aboot.img'
-    result = subprocess.run([
-        'debugfs',
-        image_path,
-        '-R',
-        f'dump /aboot.img {path}',
-    ])
-    if result.returncode != 0:
-        logging.fatal('Failed to dump aboot.img')
-        exit(1)
+def get_image_stamp(image_path: str) -> dict[str, int]:
+    stat = os.stat(image_path)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def extract_boot_file(image_path: str, file_name: str, sector_size: int) -> str:
+    """
+    Extracts `file_name` from the boot partition of the full image at `image_path` without loop devices or debugfs.
+    Extracted files are cached next to the image until its mtime or size changes. Returns the extracted file's path.
+    """
+    cache_dir = f'{image_path}.boot'
+    stamp_path = os.path.join(cache_dir, 'stamp.json')
+    path = os.path.join(cache_dir, file_name)
+    stamp = get_image_stamp(image_path)
+    if os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as file:
+            cached = json.load(file)
+        if cached != stamp:
+            logging.debug(f'Dropping boot files extracted from an older {image_path}')
+            shutil.rmtree(cache_dir)
+        elif os.path.exists(path):
+            logging.debug(f'Reusing {path} extracted from {image_path}')
+            return path
+    os.makedirs(cache_dir, exist_ok=True)
+
+    offset, _ = read_partition_table(image_path, sector_size).get_offset(BOOT_PARTITION)
+    logging.info(f'Extracting {file_name} from {image_path}')
+    with Ext2Reader(image_path, offset) as fs:
+        data = fs.read_file(file_name)
+    with open(f'{path}.tmp', 'wb') as file:
+        file.write(data)
+    os.rename(f'{path}.tmp', path)
+    with open(stamp_path, 'w') as file:
+        json.dump(stamp, file)
     return path
 
 
-def dump_lk2nd(image_path: str) -> str:
+def dump_aboot(image_path: str, sector_size: int) -> str:
+    return extract_boot_file(image_path, 'aboot.img', sector_size)
+
+
+def dump_lk2nd(image_path: str, sector_size: int) -> str:
     """
     This doesn't append the image with the appended DTB which is needed for some devices, so it should get added in the future.
     """
-    path = '/tmp/lk2nd.img'
-    result = subprocess.run([
-        'debugfs',
-        image_path,
-        '-R',
-        f'dump /lk2nd.img {path}',
-    ])
-    if result.returncode != 0:
-        logging.fatal('Failed to dump lk2nd.img')
-        exit(1)
-    return path
+    return extract_boot_file(image_path, 'lk2nd.img', sector_size)
 
 
-def dump_qhypstub(image_path: str) -> str:
-    path = '/tmp/qhypstub.bin'
-    result = subprocess.run([
-        'debugfs',
-        image_path,
-        '-R',
-        f'dump /qhypstub.bin {path}',
-    ])
-    if result.returncode != 0:
-        logging.fatal('Failed to dump qhypstub.bin')
-        exit(1)
-    return path
+def dump_qhypstub(image_path: str, sector_size: int) -> str:
+    return extract_boot_file(image_path, 'qhypstub.bin', sector_size)
 
 
 def create_img_file(image_path: str, size_str: str):
@@ -256,19 +180,20 @@ def create_img_file(image_path: str, size_str: str):
     return image_path
 
 
-def partition_device(device: str):
-    boot_partition_size = '100MiB'
-    create_partition_table = ['mklabel', 'msdos']
-    create_boot_partition = ['mkpart', 'primary', 'ext2', '0%', boot_partition_size]
-    create_root_partition = ['mkpart', 'primary', boot_partition_size, '100%']
-    enable_boot = ['set', '1', 'boot', 'on']
-    result = subprocess.run([
-        'parted',
-        '--script',
-        device,
-    ] + create_partition_table + create_boot_partition + create_root_partition + enable_boot)
-    if result.returncode != 0:
-        raise Exception(f'Failed to create partitions on {device}')
+def partition_device(image_path: str, sector_size: int, table_type: str = MBR) -> PartitionTable:
+    """Writes a partition table with a 100 MiB bootable boot partition and a root partition filling the rest to `image_path`"""
+    boot_partition_end = BOOT_PARTITION_SIZE_MB * 1024 * 1024 // sector_size
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        sectors = get_fd_size(fd) // sector_size
+    finally:
+        os.close(fd)
+    table = PartitionTable(table_type, sector_size, sectors)
+    boot = table.add_partition(start=table.align(table.first_usable_sector()), bootable=True)
+    table.resize_partition(boot.number, boot_partition_end - boot.start)
+    table.add_partition()
+    table.write(image_path)
+    return table
 
 
 def create_filesystem(device: str, blocksize: int = 4096, label=None, options=[], fstype='ext4'):
@@ -284,20 +209,65 @@ def create_filesystem(device: str, blocksize: int = 4096, label=None, options=[]
         '-F',
         '-b',
         str(blocksize),
-    ] + labels + [device]
+    ] + labels + options + [device]
     result = subprocess.run(cmd)
     if result.returncode != 0:
         raise Exception(f'Failed to create {fstype} filesystem on {device} with CMD: {cmd}')
 
 
-def create_root_fs(device: str, blocksize: int):
-    create_filesystem(device, blocksize=blocksize, label='kupfer_root', options=['-O', '^metadata_csum', '-N', '100000'])
+def create_root_fs(device: str, blocksize: int, inodes: Optional[int] = None):
+    """Creates the root filesystem with `inodes` inodes, or mke2fs' default number for its size"""
+    inode_options = ['-N', str(inodes)] if inodes else []
+    create_filesystem(device, blocksize=blocksize, label='kupfer_root', options=['-O', '^metadata_csum'] + inode_options)
 
 
 def create_boot_fs(device: str, blocksize: int):
     create_filesystem(device, blocksize=blocksize, label='kupfer_boot', fstype='ext2')
 
 
+def unmount_chroot(chroot: DeviceChroot):
+    logging.info('Preparing to unmount chroot')
+    res = chroot.run_cmd('sync && umount /boot', attach_tty=True)
+    logging.debug(f'rc: {res}')
+    chroot.deactivate()
+
+    logging.debug(f'Unmounting rootfs at "{chroot.path}"')
+    res = run(['umount', chroot.path])
+    logging.debug(f'rc: {res.returncode}')
+
+
+def get_extra_packages(packages: list[str], device: str, flavour: str) -> list[str]:
+    """The packages that aren't part of the base, flavour or device package lists"""
+    return [pkg for pkg in packages if pkg not in BASE_PACKAGES + FLAVOURS[flavour]['packages'] + DEVICES[device]]
+
+
+def get_image_size_mb(data: int, inodes: int) -> tuple[int, int]:
+    """
+    Size of an image with a rootfs of `data` bytes in `inodes` files and directories, including the boot partition,
+    and the inode count to create the rootfs with. Accounts for the inode tables, journal and reserved blocks of ext4
+    and leaves `ROOTFS_FREE_MB` free.
+    """
+    # a fifth of the inodes stay free, plus enough for the free space
+    inode_count = max(ROOTFS_MIN_INODES, int(inodes * 1.25) + ROOTFS_FREE_MB * 1024 * 1024 // ROOTFS_AVG_FILE_SIZE)
+    content = data * (1 + EXT4_METADATA_RATIO) + ROOTFS_FREE_MB * 1024 * 1024
+    fs_size = content / (1 - EXT4_RESERVED_RATIO) + inode_count * EXT4_INODE_SIZE + EXT4_JOURNAL_MB * 1024 * 1024
+    fs_mb = -(-int(fs_size) // (1024 * 1024))
+    return BOOT_PARTITION_SIZE_MB + -(-fs_mb // ROOTFS_SIZE_STEP_MB) * ROOTFS_SIZE_STEP_MB, inode_count
+
+
+def estimate_image_size_mb(arch: Arch, packages: list[str], use_local_repos: bool, block_size: int) -> tuple[int, int]:
+    """Estimates the image size from the installed sizes of `packages` and their dependencies in the repo databases"""
+    closure, missing = get_package_index(arch, use_local_repos).resolve(packages)
+    if missing:
+        logging.warning(f'Image size estimate: no package satisfies {", ".join(sorted(missing))}')
+    installed = sum(package.installed_size for package in closure.values())
+    files = installed // ROOTFS_AVG_FILE_SIZE
+    # on average, half a block at the end of each file stays unused
+    size_mb, inode_count = get_image_size_mb(installed + files * block_size // 2, files)
+    logging.info(f'Rootfs: {len(closure)} packages with {format_size(installed)} installed, needing a {size_mb} MB image')
+    return size_mb, inode_count
+
+
 def install_rootfs(
     rootfs_device: str,
     bootfs_device: str,
@@ -306,16 +276,47 @@ def install_rootfs(
     arch: Arch,
     packages: list[str],
     use_local_repos: bool,
+    use_cache: bool = True,
+    no_extract: list[str] = [],
+):
+    chroot = get_device_chroot(
+        device=device,
+        flavour=flavour,
+        arch=arch,
+        packages=packages,
+        use_local_repos=use_local_repos,
+        no_extract=no_extract,
+    )
+
+    mount_chroot(rootfs_device, bootfs_device, chroot)
+
+    chroot.mount_pacman_cache()
+    if use_cache:
+        layer = get_rootfs_layers(arch, device, flavour, get_extra_packages(packages, device, flavour), use_local_repos, no_extract)
+        install_rootfs_layers(chroot, layer)
+    else:
+        chroot.initialize()
+    unmount_chroot(chroot)
+
+
+def configure_rootfs(
+    rootfs_device: str,
+    bootfs_device: str,
+    device: str,
+    flavour: str,
+    arch: Arch,
     profile: Profile,
 ):
+    """Sets up the user, ssh keys and config files and runs the flavour's post_cmds in an installed rootfs"""
     user = profile['username'] or 'kupfer'
     post_cmds = FLAVOURS[flavour].get('post_cmds', [])
-    chroot = get_device_chroot(device=device, flavour=flavour, arch=arch, packages=packages, use_local_repos=use_local_repos)
+    # keep the rootfs slim across updates on the device
+    no_extract = get_no_extract_patterns(profile['no_extract'] or [], profile['locales_keep'] or [])
+    chroot = get_device_chroot(device=device, flavour=flavour, arch=arch, no_extract=no_extract)
 
     mount_chroot(rootfs_device, bootfs_device, chroot)
 
-    chroot.mount_pacman_cache()
-    chroot.initialize()
+    chroot.initialized = True
     chroot.activate()
     chroot.create_user(
         user=user,
@@ -326,7 +327,11 @@ def install_rootfs(
         user=user,
     )
     files = {
-        'etc/pacman.conf': get_base_distro(arch).get_pacman_conf(check_space=True, extra_repos=get_kupfer_https(arch).repos),
+        'etc/pacman.conf': get_base_distro(arch).get_pacman_conf(
+            check_space=True,
+            extra_repos=get_kupfer_https(arch).repos,
+            no_extract=no_extract,
+        ),
         'etc/sudoers.d/wheel': "# allow members of group wheel to execute any command\n%wheel ALL=(ALL:ALL) ALL\n",
         'etc/hostname': profile['hostname'],
     }
@@ -339,14 +344,18 @@ def install_rootfs(
         if result.returncode != 0:
             raise Exception('Error running post_cmds')
 
-    logging.info('Preparing to unmount chroot')
-    res = chroot.run_cmd('sync && umount /boot', attach_tty=True)
-    logging.debug(f'rc: {res}')
-    chroot.deactivate()
+    unmount_chroot(chroot)
 
-    logging.debug(f'Unmounting rootfs at "{chroot.path}"')
-    res = run(['umount', chroot.path])
-    logging.debug(f'rc: {res.returncode}')
+
+def get_local_repos_state(arch: Arch) -> dict[str, str]:
+    """Hashes the local repo databases, so rebuilt packages invalidate build checkpoints"""
+    state = {}
+    for repo in REPOSITORIES:
+        db = os.path.join(config.get_path('packages'), arch, repo, f'{repo}.db.tar.xz')
+        if os.path.exists(db):
+            with open(db, 'rb') as file:
+                state[repo] = hashlib.sha256(file.read()).hexdigest()
+    return state
 
 
 @click.group(name='image')
@@ -354,6 +363,183 @@ def cmd_image():
     """Build and manage device images"""
 
 
+def copy_image_file(source: str, dest: str):
+    """Copies the image file `source` to `dest`, sharing the data blocks on filesystems that support reflinks"""
+    result = run(['cp', '--reflink=auto', '--sparse=always', source, dest])
+    if result.returncode != 0:
+        raise Exception(f'Failed to copy {source} to {dest}')
+
+
+def get_checkpoints_path(device: str, flavour: str) -> str:
+    return os.path.join(config.get_path('images'), f'{device}-{flavour}.checkpoints.json')
+
+
+def build_image(
+    device: str,
+    flavour: str,
+    profile: Profile,
+    local_repos: bool = True,
+    block_target: Optional[str] = None,
+    skip_part_images: bool = False,
+    compress: str = 'none',
+    rootfs_cache: bool = True,
+    resume: bool = False,
+) -> str:
+    """
+    Builds the image for `device` and `flavour`, returns its path. Packages need to be built already.
+    The build runs in phases that are checkpointed under the images dir. With `resume`,
+    phases whose inputs didn't change since the last build are skipped.
+    """
+    size_extra_mb: int = int(profile["size_extra_mb"])
+
+    # TODO: PARSE DEVICE ARCH AND SECTOR SIZE
+    arch = 'aarch64'
+    sector_size = 4096
+    rootfs_size_mb = FLAVOURS[flavour].get('size', 2) * 1000
+    # None: mke2fs' default for the size
+    root_inodes: Optional[int] = None
+
+    packages = BASE_PACKAGES + DEVICES[device] + FLAVOURS[flavour]['packages'] + profile['pkgs_include']
+    no_extract = get_no_extract_patterns(profile['no_extract'] or [], profile['locales_keep'] or [])
+    if no_extract and rootfs_cache:
+        # build the layers up front to size the image to the slim rootfs instead of the flavour's size
+        layer = get_rootfs_layers(arch, device, flavour, get_extra_packages(packages, device, flavour), local_repos, no_extract)
+        build_rootfs_layers(layer)
+        footprint, inodes = layer.get_footprint()
+        rootfs_size_mb, root_inodes = get_image_size_mb(footprint, inodes)
+        logging.info(f'Slim rootfs footprint: {format_size(footprint)}, sizing the image to {rootfs_size_mb + size_extra_mb} MB')
+    else:
+        try:
+            rootfs_size_mb, root_inodes = estimate_image_size_mb(arch, packages, local_repos, sector_size)
+        except Exception as ex:
+            logging.warning(f'Failed to estimate the image size, falling back to the flavour size of {rootfs_size_mb} MB: {ex}')
+    if root_inodes:
+        # size_extra_mb is for more files as well
+        root_inodes += size_extra_mb * 1024 * 1024 // ROOTFS_AVG_FILE_SIZE
+
+    image_path = block_target or get_image_path(device, flavour)
+    boot_image_path = get_image_path(device, flavour, 'boot')
+    root_image_path = get_image_path(device, flavour, 'root')
+
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+
+    part_images = [] if skip_part_images else [boot_image_path, root_image_path]
+    # copies of the freshly installed partition images, so configure can rerun without reinstalling
+    installed_images = [f'{path}.installed' for path in part_images]
+    loop_device: Optional[str] = None
+
+    def get_part_devices() -> tuple[str, str]:
+        nonlocal loop_device
+        if not skip_part_images:
+            return boot_image_path, root_image_path
+        if not loop_device:
+            loop_device = get_loop_device(image_path, sector_size)
+        return loop_device + 'p1', loop_device + 'p2'
+
+    def allocate():
+        # truncate keeps existing contents and copy_image() leaves the holes of the partition images untouched
+        for path in [image_path] + part_images + installed_images:
+            if os.path.exists(path):
+                logging.debug(f'Removing old image {path}')
+                os.unlink(path)
+        logging.info(f'Creating new file at {image_path}')
+        create_img_file(image_path, f"{rootfs_size_mb + size_extra_mb}M")
+        table = partition_device(image_path, sector_size)
+        if not skip_part_images:
+            logging.info('Creating per-partition image files')
+            create_img_file(boot_image_path, str(table.get_offset(1)[1]))
+            create_img_file(root_image_path, str(table.get_offset(2)[1]))
+
+    def rootfs():
+        for path in part_images:
+            # mkfs leaves the unused blocks of an earlier run's filesystem as they are
+            size = os.path.getsize(path)
+            os.truncate(path, 0)
+            os.truncate(path, size)
+        boot_dev, root_dev = get_part_devices()
+        create_boot_fs(boot_dev, sector_size)
+        create_root_fs(root_dev, sector_size, root_inodes)
+        install_rootfs(root_dev, boot_dev, device, flavour, arch, packages, local_repos, use_cache=rootfs_cache, no_extract=no_extract)
+        for path, installed in zip(part_images, installed_images):
+            copy_image_file(path, installed)
+
+    def configure():
+        for path, installed in zip(part_images, installed_images):
+            logging.info(f'Restoring installed partition image {path}')
+            copy_image_file(installed, path)
+        boot_dev, root_dev = get_part_devices()
+        configure_rootfs(root_dev, boot_dev, device, flavour, arch, profile)
+
+    def assemble():
+        table = read_partition_table(image_path, sector_size)
+        logging.info('Copying partition image files into full image:')
+        logging.info(f'Block-copying /boot to {image_path}')
+        copy_image(boot_image_path, image_path, output_offset=table.get_offset(1)[0])
+        logging.info(f'Block-copying rootfs to {image_path}')
+        copy_image(root_image_path, image_path, output_offset=table.get_offset(2)[0])
+
+    def compress_phase():
+        compress_image(image_path, compress)
+
+    phases = [
+        Phase(
+            'allocate',
+            {
+                'image': image_path,
+                'size_mb': rootfs_size_mb + size_extra_mb,
+                'sector_size': sector_size,
+                'skip_part_images': skip_part_images,
+            },
+            allocate,
+            # the partition images are checked by the phases that write them
+            outputs=[image_path],
+        ),
+        Phase(
+            'rootfs',
+            {
+                'arch': arch,
+                'packages': sorted(set(packages)),
+                'local_repos': get_local_repos_state(arch) if local_repos else None,
+                'rootfs_cache': rootfs_cache,
+                'no_extract': no_extract,
+                'inodes': root_inodes,
+            },
+            rootfs,
+            outputs=installed_images,
+        ),
+        Phase(
+            'configure',
+            {
+                'username': profile['username'],
+                'password': hashlib.sha256((profile['password'] or '').encode()).hexdigest(),
+                'hostname': profile['hostname'],
+                'post_cmds': FLAVOURS[flavour].get('post_cmds', []),
+                'ssh_keys': sorted(find_ssh_keys()),
+                'no_extract': no_extract,
+            },
+            configure,
+            outputs=part_images,
+            # without partition images, it adds users, keys and post_cmds changes on top of what's on the target
+            idempotent=not skip_part_images,
+        ),
+    ]
+    if not skip_part_images:
+        phases.append(Phase('assemble', {}, assemble, outputs=[image_path]))
+    if compress != 'none':
+        compressed_path = image_path + COMPRESSION_EXTENSIONS[compress]
+        phases.append(Phase(
+            'compress',
+            {'compression': compress},
+            compress_phase,
+            outputs=[compressed_path, get_bmap_path(compressed_path)],
+        ))
+
+    run_phases(phases, Checkpoints(get_checkpoints_path(device, flavour)), resume=resume)
+
+    logging.info(f'Done! Image saved to {image_path}')
+    return image_path
+
+
 @cmd_image.command(name='build')
 @click.argument('profile_name', required=False)
 @click.option('--local-repos/--no-local-repos',
@@ -375,12 +561,34 @@ def cmd_image():
               is_flag=True,
               default=False,
               help='Skip creating image files for the partitions and directly work on the target block device.')
+@click.option('--compress',
+              type=click.Choice(['none'] + list(COMPRESSIONS.keys())),
+              default='none',
+              show_default=True,
+              help='Additionally write a compressed copy of the image and a bmap file of its used blocks.')
+@click.option('--rootfs-cache/--no-rootfs-cache',
+              default=True,
+              show_default=True,
+              help='Install the rootfs from cached base, flavour and device layers shared between images.')
+@click.option('--all',
+              'build_all',
+              is_flag=True,
+              default=False,
+              help="Build images for all devices and flavours, using the profile's other settings.")
+@click.option('--resume',
+              is_flag=True,
+              default=False,
+              help='Skip build phases whose inputs are unchanged since the last (possibly failed) build of the image.')
 def cmd_build(profile_name: str = None,
               local_repos: bool = True,
               build_pkgs: bool = True,
               no_download_pkgs=False,
               block_target: str = None,
-              skip_part_images: bool = False):
+              skip_part_images: bool = False,
+              compress: str = 'none',
+              rootfs_cache: bool = True,
+              build_all: bool = False,
+              resume: bool = False):
     """
     Build a device image.
 
@@ -388,70 +596,40 @@ def cmd_build(profile_name: str = None,
     """
     enforce_wrap()
     profile: Profile = config.get_profile(profile_name)
-    device, flavour = get_device_and_flavour(profile_name)
-    size_extra_mb: int = int(profile["size_extra_mb"])
+    if build_all:
+        if block_target:
+            raise Exception('--block-target can not be used with --all')
+        targets = [(device, flavour) for device in DEVICES for flavour in FLAVOURS]
+    else:
+        targets = [get_device_and_flavour(profile_name)]
 
-    # TODO: PARSE DEVICE ARCH AND SECTOR SIZE
+    # TODO: PARSE DEVICE ARCH
     arch = 'aarch64'
-    sector_size = 4096
-    rootfs_size_mb = FLAVOURS[flavour].get('size', 2) * 1000
-
-    packages = BASE_PACKAGES + DEVICES[device] + FLAVOURS[flavour]['packages'] + profile['pkgs_include']
 
     if arch != config.runtime['arch']:
         build_enable_qemu_binfmt(arch)
 
     if local_repos and build_pkgs:
         logging.info("Making sure all packages are built")
+        packages = set(BASE_PACKAGES + profile['pkgs_include'])
+        for device, flavour in targets:
+            packages.update(DEVICES[device] + FLAVOURS[flavour]['packages'])
         repo = discover_packages()
         build_packages(repo, [p for name, p in repo.items() if name in packages], arch, try_download=not no_download_pkgs)
 
-    image_path = block_target or get_image_path(device, flavour)
-
-    os.makedirs(os.path.dirname(image_path), exist_ok=True)
-
-    logging.info(f'Creating new file at {image_path}')
-    create_img_file(image_path, f"{rootfs_size_mb + size_extra_mb}M")
-
-    loop_device = losetup_rootfs_image(image_path, sector_size)
-
-    partition_device(loop_device)
-    partprobe(loop_device)
-
-    boot_dev: str
-    root_dev: str
-    loop_boot = loop_device + 'p1'
-    loop_root = loop_device + 'p2'
-    if skip_part_images:
-        boot_dev = loop_boot
-        root_dev = loop_root
-    else:
-        logging.info('Creating per-partition image files')
-        boot_dev = create_img_file(get_image_path(device, flavour, 'boot'), IMG_FILE_BOOT_DEFAULT_SIZE)
-        root_dev = create_img_file(get_image_path(device, flavour, 'root'), f'{rootfs_size_mb + size_extra_mb - 200}M')
-
-    create_boot_fs(boot_dev, sector_size)
-    create_root_fs(root_dev, sector_size)
-
-    install_rootfs(
-        root_dev,
-        boot_dev,
-        device,
-        flavour,
-        arch,
-        packages,
-        local_repos,
-        profile,
-    )
-
-    if not skip_part_images:
-        logging.info('Copying partition image files into full image:')
-        logging.info(f'Block-copying /boot to {image_path}')
-        dd_image(input=boot_dev, output=loop_boot)
-        logging.info(f'Block-copying rootfs to {image_path}')
-        dd_image(input=root_dev, output=loop_root)
-
-    logging.info(f'Done! Image saved to {image_path}')
+    for device, flavour in targets:
+        logging.info(f'Building image for {device} with flavour {flavour}')
+        build_image(
+            device,
+            flavour,
+            profile,
+            local_repos=local_repos,
+            block_target=block_target,
+            skip_part_images=skip_part_images,
+            compress=compress,
+            rootfs_cache=rootfs_cache,
+            resume=resume,
+        )
 
 
 @cmd_image.command(name='inspect')
@@ -467,8 +645,7 @@ def cmd_inspect(profile: str = None, shell: bool = False):
     sector_size = 4096
     chroot = get_device_chroot(device, flavour, arch)
     image_path = get_image_path(device, flavour)
-    loop_device = losetup_rootfs_image(image_path, sector_size)
-    partprobe(loop_device)
+    loop_device = get_loop_device(image_path, sector_size)
     mount_chroot(loop_device + 'p2', loop_device + 'p1', chroot)
 
     logging.info(f'Inspect the rootfs image at {chroot.path}')
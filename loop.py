@@ -0,0 +1,182 @@
+import errno
+import fcntl
+import logging
+import os
+import stat
+import struct
+import subprocess
+import time
+from glob import glob
+from typing import Optional
+
+# see include/uapi/linux/loop.h
+LOOP_CONTROL = '/dev/loop-control'
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+BLKRRPART = 0x125F
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_PARTSCAN = 8
+# device, inode, rdevice, offset, sizelimit, number, encrypt type, encrypt key size, flags,
+# file name, crypt name, encrypt key, init
+LOOP_INFO64 = struct.Struct('<QQQQQIIII64s64s32s2Q')
+# fd, block size, loop_info64, reserved
+LOOP_CONFIG = struct.Struct(f'<II{LOOP_INFO64.size}s64x')
+
+PARTITION_WAIT_TIMEOUT = 10
+
+# fds of the loop devices used by this process. The devices are attached with LO_FLAGS_AUTOCLEAR,
+# so the kernel detaches them once these fds are closed at exit and nothing else (e.g. a mount) uses them anymore.
+_loop_fds: dict[str, int] = {}
+
+
+class LoopInfo:
+    device: int
+    inode: int
+    offset: int
+    sizelimit: int
+    flags: int
+    raw: bytes
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.device, self.inode, _, self.offset, self.sizelimit, _, _, _, self.flags = LOOP_INFO64.unpack(raw)[:9]
+
+    def with_flags(self, flags: int) -> bytes:
+        fields = list(LOOP_INFO64.unpack(self.raw))
+        fields[8] = flags
+        return LOOP_INFO64.pack(*fields)
+
+
+def _get_status(fd: int) -> Optional[LoopInfo]:
+    try:
+        return LoopInfo(fcntl.ioctl(fd, LOOP_GET_STATUS64, bytes(LOOP_INFO64.size)))
+    except OSError as ex:
+        if ex.errno == errno.ENXIO:
+            # not attached
+            return None
+        raise
+
+
+def _get_block_size(loop_device: str) -> int:
+    with open(f'/sys/block/{os.path.basename(loop_device)}/queue/logical_block_size', 'r') as file:
+        return int(file.read())
+
+
+def find_loop_device(image_path: str, sector_size: int) -> Optional[str]:
+    """Returns an existing loop device backed by the same file (by device and inode) with a matching configuration"""
+    image_stat = os.stat(image_path)
+    for loop_dir in sorted(glob('/sys/block/loop*/loop')):
+        loop_device = os.path.join('/dev', os.path.basename(os.path.dirname(loop_dir)))
+        try:
+            fd = os.open(loop_device, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            info = _get_status(fd)
+        finally:
+            os.close(fd)
+        if not info or (info.device, info.inode) != (image_stat.st_dev, image_stat.st_ino):
+            continue
+        if info.offset or info.sizelimit or not info.flags & LO_FLAGS_PARTSCAN or _get_block_size(loop_device) != sector_size:
+            logging.debug(f'Not reusing {loop_device} for {image_path}: configured differently')
+            continue
+        return loop_device
+    return None
+
+
+def _configure(image_fd: int, sector_size: int) -> str:
+    """Attaches `image_fd` to a free loop device with LOOP_CONFIGURE, retrying if another process grabs the device first"""
+    control = os.open(LOOP_CONTROL, os.O_RDWR)
+    try:
+        while True:
+            number = fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+            loop_device = f'/dev/loop{number}'
+            fd = os.open(loop_device, os.O_RDWR)
+            info = LOOP_INFO64.pack(0, 0, 0, 0, 0, 0, 0, 0, LO_FLAGS_AUTOCLEAR | LO_FLAGS_PARTSCAN, b'', b'', b'', 0, 0)
+            try:
+                fcntl.ioctl(fd, LOOP_CONFIGURE, LOOP_CONFIG.pack(image_fd, sector_size, info))
+            except OSError as ex:
+                os.close(fd)
+                if ex.errno == errno.EBUSY:
+                    continue
+                raise
+            _loop_fds[loop_device] = fd
+            return loop_device
+    finally:
+        os.close(control)
+
+
+def _losetup(image_path: str, sector_size: int) -> str:
+    """Fallback for kernels without LOOP_CONFIGURE (< 5.8)"""
+    result = subprocess.run(['losetup', '--show', '-f', '-P', '-b', str(sector_size), image_path], capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f'Failed to create loop device for {image_path}: {result.stderr.decode()}')
+    loop_device = result.stdout.decode().strip()
+    fd = os.open(loop_device, os.O_RDWR)
+    info = _get_status(fd)
+    assert info
+    fcntl.ioctl(fd, LOOP_SET_STATUS64, info.with_flags(info.flags | LO_FLAGS_AUTOCLEAR))
+    _loop_fds[loop_device] = fd
+    return loop_device
+
+
+def wait_for_partitions(loop_device: str, timeout: float = PARTITION_WAIT_TIMEOUT) -> list[str]:
+    """
+    Waits until the kernel's partition scan of `loop_device` shows up in sysfs and returns the partition device paths.
+    Missing device nodes (e.g. in containers without udev) are created from the sysfs major:minor numbers.
+    """
+    name = os.path.basename(loop_device)
+    deadline = time.monotonic() + timeout
+    while True:
+        partitions = sorted(glob(f'/sys/block/{name}/{name}p*'), key=lambda path: int(path.rsplit('p', 1)[1]))
+        if partitions or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    devices = []
+    for partition in partitions:
+        path = os.path.join('/dev', os.path.basename(partition))
+        if not os.path.exists(path):
+            with open(os.path.join(partition, 'dev'), 'r') as file:
+                major, minor = file.read().strip().split(':')
+            logging.debug(f'Creating missing device node {path}')
+            os.mknod(path, 0o660 | stat.S_IFBLK, os.makedev(int(major), int(minor)))
+        devices.append(path)
+    if not devices:
+        raise Exception(f'No partitions showed up for {loop_device} after {timeout} seconds')
+    return devices
+
+
+def get_loop_device(image_path: str, sector_size: int) -> str:
+    """
+    Returns a loop device with partition scanning for `image_path`, reusing an existing attachment of the same file.
+    New attachments are detached automatically once this process exits and nothing else uses them.
+    """
+    image_path = os.path.realpath(image_path)
+    loop_device = find_loop_device(image_path, sector_size)
+    if loop_device:
+        logging.debug(f'Reusing loop device {loop_device} for {image_path}')
+        if loop_device not in _loop_fds:
+            _loop_fds[loop_device] = os.open(loop_device, os.O_RDONLY)
+        try:
+            # the partition table might have been rewritten since the device was attached
+            fcntl.ioctl(_loop_fds[loop_device], BLKRRPART)
+        except OSError as ex:
+            if ex.errno != errno.EBUSY:
+                raise
+            logging.debug(f'Not rescanning partitions of {loop_device}: in use')
+    else:
+        logging.debug(f'Creating loop device for {image_path} with sector size {sector_size}')
+        image_fd = os.open(image_path, os.O_RDWR)
+        try:
+            loop_device = _configure(image_fd, sector_size)
+        except OSError as ex:
+            if ex.errno not in [errno.EINVAL, errno.ENOTTY]:
+                raise
+            logging.debug(f'LOOP_CONFIGURE unsupported ({ex}), falling back to losetup')
+            loop_device = _losetup(image_path, sector_size)
+        finally:
+            os.close(image_fd)
+    wait_for_partitions(loop_device)
+    return loop_device
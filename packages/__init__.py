@@ -1,9 +1,13 @@
 import click
+import fcntl
+import json
 import logging
 import multiprocessing
 import os
 import shutil
 import subprocess
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import deepcopy
 from joblib import Parallel, delayed
 from glob import glob
@@ -14,14 +18,29 @@ from typing import Iterable, Iterator, Any, Optional
 
 from constants import REPOSITORIES, CROSSDIRECT_PKGS, QEMU_BINFMT_PKGS, GCC_HOSTSPECS, ARCHES, Arch, CHROOT_PATHS, MAKEPKG_CMD
 from config import config
-from chroot.build import get_build_chroot, BuildChroot
+from chroot.build import get_build_chroot, get_prefetch_chroot, BuildChroot
+from chroot.helpers import build_chroot_name
+from chroot.snapshot import bind_view, reinstall_local_packages, restore_snapshot, save_snapshot
 from distro.distro import PackageInfo, get_kupfer_https, get_kupfer_local
+from distro.resolver import get_package_index
 from ssh import run_ssh_command, scp_put_files
 from wrapper import enforce_wrap
-from utils import git
+from utils import format_size, git, parse_size
 from binfmt import register as binfmt_register
+from .binary_cache import get_binary_cache, pull_packages, serve_binary_cache
+from .compiler_cache import (CompilerCacheStats, evict_ccache, get_compiler_cache_env, log_compiler_cache_summary, read_ccache_stats,
+                             read_sccache_stats, uses_rust)
+from .distcc import get_distcc_hosts, setup_distcc
+from .build_key import get_build_key, read_build_key, write_build_key
+from .workers import BUILD_RESULTS_DIR, get_build_result_name, get_workers, schedule_builds
+from .sources import get_srcdest, hash_file, log_sources_usage, prepare_sources, prune_sources, store_sources
 from .pkgbuild import Pkgbuild, parse_pkgbuild
 
+# hashes of the PKGBUILD and local sources the sources in an incremental BUILDDIR were extracted from
+INCREMENTAL_STAMP = '.recipe'
+# local sources makepkg extracts instead of linking into srcdir
+ARCHIVE_EXTENSIONS = ('.tar', '.tgz', '.zip', '.gz', '.bz2', '.xz', '.zst', '.lz4', '.7z')
+
 pacman_cmd = [
     'pacman',
     '-Syuu',
@@ -165,11 +184,12 @@ def filter_packages(repo: dict[str, Pkgbuild], paths: Iterable[str], allow_empty
     return result
 
 
-def generate_dependency_chain(package_repo: dict[str, Pkgbuild], to_build: Iterable[Pkgbuild]) -> list[set[Pkgbuild]]:
+def generate_dependency_chain(package_repo: dict[str, Pkgbuild], to_build: Iterable[Pkgbuild], arch: Optional[Arch] = None) -> list[set[Pkgbuild]]:
     """
     This figures out all dependencies and their sub-dependencies for the selection and adds those packages to the selection.
     First the top-level packages get selected by searching the paths.
     Then their dependencies and sub-dependencies and so on get added to the selection.
+    Only the build dependencies for `arch` are considered, or those of all arches if `arch` is None.
     """
     visited = set[Pkgbuild]()
     visited_names = set[str]()
@@ -187,7 +207,7 @@ def generate_dependency_chain(package_repo: dict[str, Pkgbuild], to_build: Itera
         return result
 
     def get_dependencies(package: Pkgbuild, package_repo: dict[str, Pkgbuild] = package_repo) -> Iterator[Pkgbuild]:
-        for dep_name in package.depends:
+        for dep_name in package.get_depends(arch):
             if dep_name in visited_names:
                 continue
             elif dep_name in package_repo:
@@ -242,7 +262,7 @@ def generate_dependency_chain(package_repo: dict[str, Pkgbuild], to_build: Itera
                     break
                 if not issubclass(type(other_pkg), Pkgbuild):
                     raise Exception('Not a Pkgbuild object:' + repr(other_pkg))
-                for dep_name in other_pkg.depends:
+                for dep_name in other_pkg.get_depends(arch):
                     if dep_name in pkg.names():
                         dep_levels[level].remove(pkg)
                         dep_levels[level + 1].add(pkg)
@@ -250,7 +270,7 @@ def generate_dependency_chain(package_repo: dict[str, Pkgbuild], to_build: Itera
                         modified = True
                         pkg_done = True
                         break
-            for dep_name in pkg.depends:
+            for dep_name in pkg.get_depends(arch):
                 if dep_name in visited_names:
                     continue
                 elif dep_name in package_repo:
@@ -293,6 +313,13 @@ def add_file_to_repo(file_path: str, repo_name: str, arch: Arch):
     cache_file = os.path.join(pacman_cache_dir, file_name)
     if os.path.exists(cache_file):
         os.unlink(cache_file)
+    # concurrent builds on a build worker share the repo
+    with open(os.path.join(repo_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        repo_add(repo_dir, repo_name, target_file)
+
+
+def repo_add(repo_dir: str, repo_name: str, target_file: str):
     cmd = [
         'repo-add',
         '--remove',
@@ -389,7 +416,11 @@ def try_download_package(dest_file_path: str, package: Pkgbuild, arch: Arch) ->
         return False
 
 
-def check_package_version_built(package: Pkgbuild, arch: Arch, try_download: bool = False) -> bool:
+def check_package_version_built(package: Pkgbuild, arch: Arch, try_download: bool = False, build_key: Optional[str] = None) -> bool:
+    """
+    Checks whether the package files for the current version are in the local repo, trying to download them if requested.
+    With a `build_key`, packages that were built from different inputs (see `get_build_key()`) count as missing.
+    """
     native_chroot = setup_build_chroot(config.runtime['arch'])
     config_path = '/' + native_chroot.write_makepkg_conf(
         target_arch=arch,
@@ -413,6 +444,7 @@ def check_package_version_built(package: Pkgbuild, arch: Arch, try_download: boo
         raise Exception(f'Failed to get package list for {package.path}:' + '\n' + result.stdout.decode() + '\n' + result.stderr.decode())
 
     missing = True
+    outdated = False
     for line in result.stdout.decode('utf-8').split('\n'):
         if not line:
             continue
@@ -423,6 +455,10 @@ def check_package_version_built(package: Pkgbuild, arch: Arch, try_download: boo
         if not filename_stripped.endswith('.pkg.tar'):
             logging.debug(f'skipping unknown file extension {basename}')
             continue
+        if build_key and os.path.exists(file) and read_build_key(file) not in [None, build_key]:
+            logging.info(f'{package.path}: build inputs changed since {basename} was built')
+            outdated = True
+            continue
         if os.path.exists(file) or (try_download and try_download_package(file, package, arch)):
             missing = False
             add_file_to_repo(file, repo_name=package.repo, arch=arch)
@@ -455,7 +491,7 @@ def check_package_version_built(package: Pkgbuild, arch: Arch, try_download: boo
                         logging.info(f"copying to {copy_target}")
                         shutil.copyfile(target_repo_file, copy_target)
                         add_file_to_repo(copy_target, package.repo, repo_arch)
-    return not missing
+    return not (missing or outdated)
 
 
 def setup_build_chroot(
@@ -463,37 +499,210 @@ def setup_build_chroot(
     extra_packages: list[str] = [],
     add_kupfer_repos: bool = True,
     clean_chroot: bool = False,
+    pacman_build_profile: Optional[bool] = None,
 ) -> BuildChroot:
+    """`pacman_build_profile` overrides whether to install with the build chroot pacman profile, see `BuildChroot.write_pacman_conf()`"""
     init_prebuilts(arch)
     chroot = get_build_chroot(arch, add_kupfer_repos=add_kupfer_repos)
+    # clean chroots start from the closest snapshot of a previous dependency set instead of the base chroot
+    snapshots = clean_chroot and bool(extra_packages) and config.file['build']['chroot_snapshots'] > 0
+    snapshot_packages = restore_snapshot(chroot, extra_packages) if snapshots else None
     chroot.mount_packages()
     logging.debug(f'packages.py: Initializing {arch} build chroot')
-    chroot.initialize(reset=clean_chroot)
-    chroot.write_pacman_conf()  # in case it was initialized with different repos
+    chroot.initialize(reset=clean_chroot and snapshot_packages is None)
+    chroot.write_pacman_conf(build_profile=pacman_build_profile)  # in case it was initialized with different repos
     chroot.activate()
     chroot.mount_pacman_cache()
     chroot.mount_pkgbuilds()
+    chroot.mount_sources()
+    if snapshot_packages is not None:
+        # the snapshot may predate packages built since
+        result = chroot.run_cmd('pacman -Syu --noconfirm')
+        assert isinstance(result, subprocess.CompletedProcess)
+        if result.returncode != 0:
+            raise Exception(f'{chroot.name}: failed to upgrade restored snapshot')
+        reinstall_local_packages(chroot)
     if extra_packages:
-        chroot.try_install_packages(extra_packages, allow_fail=False)
+        results = chroot.try_install_packages(extra_packages, allow_fail=False)
+        installed = all(isinstance(result, subprocess.CompletedProcess) and result.returncode == 0 for result in results.values())
+        if snapshots and installed and snapshot_packages != set(extra_packages):
+            save_snapshot(chroot, set(extra_packages).union(snapshot_packages or []))
     return chroot
 
 
-def setup_sources(package: Pkgbuild, chroot: BuildChroot, makepkg_conf_path='/etc/makepkg.conf', pkgbuilds_dir: str = None):
+def setup_sources(
+    package: Pkgbuild,
+    chroot: BuildChroot,
+    makepkg_conf_path='/etc/makepkg.conf',
+    pkgbuilds_dir: str = None,
+    arch: Arch = None,
+    extract: bool = True,
+    build_dir: Optional[str] = None,
+):
+    """
+    Downloads and verifies the sources of `package` through the shared source cache and extracts them unless `extract` is unset,
+    into the makepkg BUILDDIR `build_dir` if given. Returns the SRCDEST inside `chroot`.
+    """
+    arch = arch or chroot.arch
     pkgbuilds_dir = pkgbuilds_dir if pkgbuilds_dir else CHROOT_PATHS['pkgbuilds']
     makepkg_setup_args = [
         '--config',
         makepkg_conf_path,
-        '--nobuild',
+        '--nobuild' if extract else '--verifysource',
         '--holdver',
         '--nodeps',
         '--skippgpcheck',
     ]
 
     logging.info(f'Setting up sources for {package.path} in {chroot.name}')
-    result = chroot.run_cmd(MAKEPKG_CMD + makepkg_setup_args, cwd=os.path.join(CHROOT_PATHS['pkgbuilds'], package.path))
+    srcdest = prepare_sources(package, arch)
+    env = {'SRCDEST': srcdest}
+    if build_dir:
+        env['BUILDDIR'] = build_dir
+    result = chroot.run_cmd(
+        MAKEPKG_CMD + makepkg_setup_args,
+        inner_env=env,
+        cwd=os.path.join(CHROOT_PATHS['pkgbuilds'], package.path),
+    )
     assert isinstance(result, subprocess.CompletedProcess)
     if result.returncode != 0:
         raise Exception(f'Failed to check sources for {package.path}')
+    store_sources(package, arch)
+    return srcdest
+
+
+def prefetch_sources(executor: ThreadPoolExecutor, packages: Iterable[Pkgbuild], arch: Arch) -> dict[str, Future]:
+    """
+    Queues downloading and verifying the sources of `packages` in the native prefetch chroot on `executor`, in the given order.
+    Returns the futures by package path. Failures are only logged, the build retries fetching and reports the error.
+    """
+    native_chroot = get_prefetch_chroot(config.runtime['arch'])
+    native_chroot.initialize()
+    native_chroot.activate()
+    native_chroot.mount_pkgbuilds()
+    native_chroot.mount_sources()
+    makepkg_conf_path = '/etc/makepkg.conf'
+    if arch != native_chroot.arch:
+        # makepkg picks the source_$CARCH arrays by CARCH
+        chroot_relative = os.path.join(CHROOT_PATHS['chroots'], build_chroot_name(arch))
+        makepkg_conf_path = os.path.join('/', native_chroot.write_makepkg_conf(target_arch=arch, cross_chroot_relative=chroot_relative, cross=True))
+
+    def fetch(package: Pkgbuild):
+        try:
+            setup_sources(package, native_chroot, makepkg_conf_path=makepkg_conf_path, arch=arch, extract=False)
+        except Exception as ex:
+            logging.warning(f'Failed to prefetch sources for {package.path}: {ex}')
+
+    futures = dict[str, Future]()
+    for package in packages:
+        # split packages share their path
+        if package.path not in futures:
+            futures[package.path] = executor.submit(fetch, package)
+    return futures
+
+
+def get_remote_dependencies(
+    packages: Iterable[Pkgbuild],
+    arch: Arch,
+    enable_crosscompile: bool = True,
+    enable_ccache: bool = True,
+    enable_distcc: bool = True,
+) -> dict[Arch, set[str]]:
+    """
+    Returns the packages `build_package()` will install for building `packages`, by chroot arch.
+    Packages provided by `packages` themselves aren't available before they're built and are left out.
+    """
+    native = config.runtime['arch']
+    planned = {name for package in packages for name in package.names()}
+    distcc = enable_distcc and bool(get_distcc_hosts())
+    dependencies = {arch: set[str](), native: set[str]()}
+    if arch != native:
+        dependencies[native].update(['base-devel'] + CROSSDIRECT_PKGS)
+    for package in packages:
+        cross = arch != native and package.mode == 'cross' and enable_crosscompile
+        chroot_arch = native if cross else arch
+        depends = package.get_depends(arch)
+        dependencies[chroot_arch].update(depends)
+        if cross:
+            dependencies[native].update(CROSSDIRECT_PKGS + [f'{GCC_HOSTSPECS[native][arch]}-gcc'])
+        elif enable_ccache:
+            dependencies[arch].add('ccache')
+        if distcc:
+            dependencies[chroot_arch].add('distcc')
+        if enable_ccache and uses_rust(depends):
+            dependencies[chroot_arch].add('sccache')
+    return {chroot_arch: names - planned for chroot_arch, names in dependencies.items() if names - planned}
+
+
+def prefetch_dependencies(dependencies: dict[Arch, set[str]]):
+    """Downloads `dependencies` into the pacman caches of the build chroots, so the per-package installs don't need to download"""
+    for chroot_arch, names in dependencies.items():
+        logging.info(f'Prefetching {len(names)} build dependencies for {chroot_arch}')
+        try:
+            setup_build_chroot(chroot_arch).download_packages(sorted(names))
+        except Exception as ex:
+            logging.warning(f'Failed to prefetch build dependencies for {chroot_arch}: {ex}')
+
+
+def get_incremental_build_dir(package: Pkgbuild, arch: Arch, in_chroot: bool = False) -> str:
+    """The persistent BUILDDIR of `package`, makepkg keeps `<pkgbase>/src` in it"""
+    return os.path.join(CHROOT_PATHS['build_dirs'] if in_chroot else config.get_path('build_dirs'), arch, package.path)
+
+
+def get_incremental_stamp(package: Pkgbuild) -> dict[str, str]:
+    """Hashes the PKGBUILD and the local sources of `package` by file name"""
+    pkgbuild_dir = os.path.join(config.get_path('pkgbuilds'), package.path)
+    stamp = {}
+    for file in ['PKGBUILD'] + sorted(set(package.local_sources)):
+        path = os.path.join(pkgbuild_dir, file)
+        if os.path.isfile(path):
+            stamp[file] = hash_file(path, 'sha256')
+    return stamp
+
+
+def update_incremental_build_dir(package: Pkgbuild, build_dir: str) -> bool:
+    """
+    Returns whether the sources kept in the incremental `build_dir` of `package` can be reused without extracting them again.
+    Changed local sources get copied into the kept `src` dirs. Changes to the PKGBUILD or local archives need a fresh extract
+    and `prepare()`, e.g. patches adding files don't apply twice, so the kept tree gets removed instead.
+    """
+    stamp_path = os.path.join(build_dir, INCREMENTAL_STAMP)
+    src_dirs = glob(os.path.join(build_dir, '*', 'src'))
+    current = get_incremental_stamp(package)
+    previous = {}
+    if src_dirs and os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as stamp_file:
+            try:
+                previous = json.load(stamp_file)
+            except json.JSONDecodeError:
+                pass
+    changed = sorted(file for file in set(current) | set(previous) if current.get(file) != previous.get(file))
+    targets = [os.path.join(src_dir, os.path.basename(file)) for file in changed for src_dir in src_dirs]
+    reusable = isinstance(previous, dict) and 'PKGBUILD' in previous and previous['PKGBUILD'] == current.get('PKGBUILD')
+    reusable = reusable and not any(file.endswith(ARCHIVE_EXTENSIONS) for file in changed)
+    reusable = reusable and not any(os.path.isdir(target) and not os.path.islink(target) for target in targets)
+    if not reusable:
+        if os.path.exists(build_dir):
+            logging.info(f'{package.path}: PKGBUILD changed, extracting the sources from scratch')
+            shutil.rmtree(build_dir)
+        return False
+    for file in changed:
+        for src_dir in src_dirs:
+            target = os.path.join(src_dir, os.path.basename(file))
+            if not os.path.lexists(target):
+                continue
+            logging.info(f'{package.path}: refreshing {file} in {src_dir}')
+            os.unlink(target)
+            if file in current:
+                shutil.copy2(os.path.join(config.get_path('pkgbuilds'), package.path, file), target)
+    write_incremental_stamp(package, build_dir, current)
+    return True
+
+
+def write_incremental_stamp(package: Pkgbuild, build_dir: str, stamp: Optional[dict[str, str]] = None):
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, INCREMENTAL_STAMP), 'w') as stamp_file:
+        json.dump(stamp if stamp is not None else get_incremental_stamp(package), stamp_file)
 
 
 def build_package(
@@ -503,13 +712,21 @@ def build_package(
     enable_crosscompile: bool = True,
     enable_crossdirect: bool = True,
     enable_ccache: bool = True,
+    enable_distcc: bool = True,
     clean_chroot: bool = False,
-):
+    incremental: bool = False,
+) -> dict[str, CompilerCacheStats]:
+    """
+    Builds `package` and returns the compiler cache statistics of the build.
+    With `incremental`, the extracted sources and build trees are kept in a persistent BUILDDIR, so make and ninja only
+    rebuild what changed. See `update_incremental_build_dir()` for when they get extracted again.
+    """
     makepkg_compile_opts = ['--holdver']
     makepkg_conf_path = 'etc/makepkg.conf'
     repo_dir = repo_dir if repo_dir else config.get_path('pkgbuilds')
     foreign_arch = config.runtime['arch'] != arch
-    deps = (list(set(package.depends) - set(package.names())))
+    depends = package.get_depends(arch)
+    deps = (list(set(depends) - set(package.names())))
     target_chroot = setup_build_chroot(
         arch=arch,
         extra_packages=deps,
@@ -521,6 +738,10 @@ def build_package(
         clean_chroot=clean_chroot,
     )
     cross = foreign_arch and package.mode == 'cross' and enable_crosscompile
+    distcc = enable_distcc and bool(get_distcc_hosts())
+    crossdirect = False
+    ccache = False
+    sccache = enable_ccache and uses_rust(depends)
 
     target_chroot.initialize()
 
@@ -531,9 +752,11 @@ def build_package(
         env = deepcopy(get_makepkg_env())
         if enable_ccache:
             env['PATH'] = f"/usr/lib/ccache:{env['PATH']}"
+            ccache = True
         logging.info('Setting up dependencies for cross-compilation')
         # include crossdirect for ccache symlinks and qemu-user
-        results = native_chroot.try_install_packages(package.depends + CROSSDIRECT_PKGS + [f"{GCC_HOSTSPECS[native_chroot.arch][arch]}-gcc"])
+        results = native_chroot.try_install_packages(depends + CROSSDIRECT_PKGS + [f"{GCC_HOSTSPECS[native_chroot.arch][arch]}-gcc"] +
+                                                     (['distcc'] if distcc else []) + (['sccache'] if sccache else []))
         res_crossdirect = results['crossdirect']
         assert isinstance(res_crossdirect, subprocess.CompletedProcess)
         if res_crossdirect.returncode != 0:
@@ -548,7 +771,8 @@ def build_package(
         build_root = target_chroot
         makepkg_compile_opts += ['--syncdeps']
         env = deepcopy(get_makepkg_env())
-        if foreign_arch and enable_crossdirect and package.name not in CROSSDIRECT_PKGS:
+        crossdirect = foreign_arch and enable_crossdirect and package.name not in CROSSDIRECT_PKGS
+        if crossdirect:
             env['PATH'] = f"/native/usr/lib/crossdirect/{arch}:{env['PATH']}"
             target_chroot.mount_crossdirect(native_chroot)
         else:
@@ -556,35 +780,82 @@ def build_package(
                 logging.debug('ccache enabled')
                 env['PATH'] = f"/usr/lib/ccache:{env['PATH']}"
                 deps += ['ccache']
+                ccache = True
             logging.debug(('Building for native arch. ' if not foreign_arch else '') + 'Skipping crossdirect.')
+        if distcc:
+            deps += ['distcc']
+        if sccache:
+            deps += ['sccache']
         dep_install = target_chroot.try_install_packages(deps, allow_fail=False)
         failed_deps = [name for name, res in dep_install.items() if res.returncode != 0]  # type: ignore[union-attr]
         if failed_deps:
             raise Exception(f'Dependencies failed to install: {failed_deps}')
 
     makepkg_conf_absolute = os.path.join('/', makepkg_conf_path)
-    setup_sources(package, build_root, makepkg_conf_path=makepkg_conf_absolute)
+    extract = True
+    if incremental:
+        build_root.mount_build_dirs()
+        build_dir = get_incremental_build_dir(package, arch)
+        extract = not update_incremental_build_dir(package, build_dir)
+        env['BUILDDIR'] = get_incremental_build_dir(package, arch, in_chroot=True)
+        # setup_sources extracted already, or the kept tree is still up to date
+        makepkg_compile_opts += ['--noextract']
+    if extract:
+        env['SRCDEST'] = setup_sources(
+            package,
+            build_root,
+            makepkg_conf_path=makepkg_conf_absolute,
+            arch=arch,
+            build_dir=env['BUILDDIR'] if incremental else None,
+        )
+        if incremental:
+            write_incremental_stamp(package, build_dir)
+    else:
+        logging.info(f'{package.path}: reusing the extracted sources in {build_dir}')
+        env['SRCDEST'] = get_srcdest(package, in_chroot=True)
 
     build_cmd = f'makepkg --config {makepkg_conf_absolute} --skippgpcheck --needed --noconfirm --ignorearch {" ".join(makepkg_compile_opts)}'
+    if distcc and setup_distcc(build_root, arch, env, crossdirect=crossdirect):
+        build_cmd = f'pump {build_cmd}'
+    stats = {}
+    if ccache or sccache:
+        # persisted per target arch under the cache dir, independent of chroot resets
+        build_root.mount_ccache(arch)
+        env |= get_compiler_cache_env(arch, rust=sccache)
+    if ccache:
+        ccache_before = read_ccache_stats(build_root, env)
     logging.debug(f'Building: Running {build_cmd}')
-    result = build_root.run_cmd(build_cmd, inner_env=env, cwd=os.path.join(CHROOT_PATHS['pkgbuilds'], package.path))
+    try:
+        result = build_root.run_cmd(build_cmd, inner_env=env, cwd=os.path.join(CHROOT_PATHS['pkgbuilds'], package.path))
+    finally:
+        if sccache:
+            # also stops the sccache server after failed builds, without replacing their error
+            try:
+                stats['sccache'] = read_sccache_stats(build_root, env)
+            except Exception as ex:
+                logging.warning(f'Failed to read sccache stats: {ex}')
     assert isinstance(result, subprocess.CompletedProcess)
+    if ccache:
+        stats['ccache'] = read_ccache_stats(build_root, env) - ccache_before
+        evict_ccache(build_root, env)
     if result.returncode != 0:
         raise Exception(f'Failed to compile package {package.path}')
+    return stats
 
 
 def get_dependants(
     repo: dict[str, Pkgbuild],
     packages: Iterable[Pkgbuild],
     recursive: bool = True,
+    arch: Optional[Arch] = None,
 ) -> set[Pkgbuild]:
     names = set([pkg.name for pkg in packages])
     to_add = set[Pkgbuild]()
     for pkg in repo.values():
-        if set.intersection(names, set(pkg.depends)):
+        if set.intersection(names, set(pkg.get_depends(arch))):
             to_add.add(pkg)
     if recursive and to_add:
-        to_add.update(get_dependants(repo, to_add))
+        to_add.update(get_dependants(repo, to_add, arch=arch))
     return to_add
 
 
@@ -598,8 +869,8 @@ def get_unbuilt_package_levels(
 ) -> list[set[Pkgbuild]]:
     dependants = set[Pkgbuild]()
     if rebuild_dependants:
-        dependants = get_dependants(repo, packages)
-    package_levels = generate_dependency_chain(repo, set(packages).union(dependants))
+        dependants = get_dependants(repo, packages, arch=arch)
+    package_levels = generate_dependency_chain(repo, set(packages).union(dependants), arch=arch)
     build_names = set[str]()
     build_levels = list[set[Pkgbuild]]()
     i = 0
@@ -607,7 +878,7 @@ def get_unbuilt_package_levels(
         level = set[Pkgbuild]()
         for package in level_packages:
             if ((force and package in packages) or (rebuild_dependants and package in dependants) or
-                    not check_package_version_built(package, arch, try_download)):
+                    not check_package_version_built(package, arch, try_download, build_key=get_build_key(package, arch, repo))):
                 level.add(package)
                 build_names.update(package.names())
         if level:
@@ -627,7 +898,9 @@ def build_packages(
     enable_crosscompile: bool = True,
     enable_crossdirect: bool = True,
     enable_ccache: bool = True,
+    enable_distcc: bool = True,
     clean_chroot: bool = False,
+    incremental: bool = False,
 ):
     init_prebuilts(arch)
     build_levels = get_unbuilt_package_levels(
@@ -644,18 +917,93 @@ def build_packages(
         return
 
     files = []
-    for level, need_build in enumerate(build_levels):
-        logging.info(f"(Level {level}) Building {', '.join([x.name for x in need_build])}")
-        for package in need_build:
-            build_package(
-                package,
-                arch=arch,
+    binary_cache = get_binary_cache()
+    if binary_cache and not force:
+        # build keys only depend on the dependencies' versions, so all levels can be pulled at once
+        keys = {package: get_build_key(package, arch, repo) for level in build_levels for package in level}
+        pulled = pull_packages(binary_cache, keys, arch)
+        for package, package_files in pulled.items():
+            for file in package_files:
+                write_build_key(file, keys[package])
+                add_file_to_repo(file, package.repo, arch)
+                files.append(file)
+        build_levels = [level for level in (need_build - pulled.keys() for need_build in build_levels) if level]
+        if not build_levels:
+            logging.info('Everything pulled from the binary cache')
+            return files
+
+    cache_stats = dict[str, dict[str, CompilerCacheStats]]()
+    # incremental build trees only exist locally
+    workers = get_workers(arch) if not incremental else []
+    prefetch_jobs = config.file['build']['source_prefetch_jobs']
+    # workers fetch their own sources
+    prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_jobs) if prefetch_jobs > 0 and not workers else None
+    prefetches = dict[str, Future]()
+
+    def build(package: Pkgbuild):
+        if package.path in prefetches:
+            prefetches[package.path].result()
+        cache_stats[package.path] = build_package(
+            package,
+            arch=arch,
+            enable_crosscompile=enable_crosscompile,
+            enable_crossdirect=enable_crossdirect,
+            enable_ccache=enable_ccache,
+            enable_distcc=enable_distcc,
+            clean_chroot=clean_chroot,
+            incremental=incremental,
+        )
+
+    def finish(package: Pkgbuild) -> list[str]:
+        build_key = get_build_key(package, arch, repo)
+        package_files = add_package_to_repo(package, arch)
+        for file in package_files:
+            write_build_key(file, build_key)
+            files.append(file)
+        # incremental builds may contain stale objects
+        if binary_cache and config.file['binary_cache']['push'] and package_files and not incremental:
+            try:
+                binary_cache.push(arch, build_key, package, package_files)
+            except Exception as ex:
+                logging.warning(f'Failed to push {package.path} to {binary_cache}: {ex}')
+        return package_files
+
+    if prefetch_executor:
+        logging.info(f'Prefetching sources with {prefetch_jobs} jobs')
+        prefetches = prefetch_sources(prefetch_executor, [package for level in build_levels for package in level], arch)
+    if config.file['build']['prefetch_dependencies'] and not workers:
+        # overlaps with the source downloads, but has to finish before the builds install into the chroots
+        prefetch_dependencies(
+            get_remote_dependencies(
+                set.union(*build_levels),
+                arch,
                 enable_crosscompile=enable_crosscompile,
-                enable_crossdirect=enable_crossdirect,
                 enable_ccache=enable_ccache,
-                clean_chroot=clean_chroot,
-            )
-            files += add_package_to_repo(package, arch)
+                enable_distcc=enable_distcc,
+            ))
+    try:
+        if workers:
+            need_build = set.union(*build_levels)
+            logging.info(f"Building {', '.join(sorted(x.name for x in need_build))} on {len(workers)} workers")
+            build_args = [
+                '--crosscompile' if enable_crosscompile else '--no-crosscompile',
+                '--crossdirect' if enable_crossdirect else '--no-crossdirect',
+                '--ccache' if enable_ccache else '--no-ccache',
+                '--distcc' if enable_distcc else '--no-distcc',
+                '--clean-chroot' if clean_chroot else '--no-clean-chroot',
+            ]
+            schedule_builds(repo, need_build, arch, workers, build, finish, build_args)
+        else:
+            for level, need_build in enumerate(build_levels):
+                logging.info(f"(Level {level}) Building {', '.join([x.name for x in need_build])}")
+                for package in need_build:
+                    build(package)
+                    finish(package)
+    finally:
+        if prefetch_executor:
+            prefetch_executor.shutdown(cancel_futures=True)
+    log_compiler_cache_summary({path: stats for path, stats in cache_stats.items() if stats})
+    prune_sources()
     return files
 
 
@@ -669,7 +1017,9 @@ def build_packages_by_paths(
     enable_crosscompile: bool = True,
     enable_crossdirect: bool = True,
     enable_ccache: bool = True,
+    enable_distcc: bool = True,
     clean_chroot: bool = False,
+    incremental: bool = False,
 ):
     if isinstance(paths, str):
         paths = [paths]
@@ -687,7 +1037,9 @@ def build_packages_by_paths(
         enable_crosscompile=enable_crosscompile,
         enable_crossdirect=enable_crossdirect,
         enable_ccache=enable_ccache,
+        enable_distcc=enable_distcc,
         clean_chroot=clean_chroot,
+        incremental=incremental,
     )
 
 
@@ -709,6 +1061,7 @@ def build_enable_qemu_binfmt(arch: Arch, repo: dict[str, Pkgbuild] = None):
         enable_crosscompile=False,
         enable_crossdirect=False,
         enable_ccache=False,
+        enable_distcc=False,
     )
     subprocess.run(['pacman', '-Syy', '--noconfirm', '--needed', '--config', os.path.join(chroot.path, 'etc/pacman.conf')] + QEMU_BINFMT_PKGS)
     if arch != native:
@@ -733,8 +1086,9 @@ def cmd_update(non_interactive: bool = False):
 @click.option('--arch', default=None, required=False, type=click.Choice(ARCHES), help="The CPU architecture to build for")
 @click.option('--rebuild-dependants', is_flag=True, default=False, help='Rebuild packages that depend on packages that will be [re]built')
 @click.option('--no-download', is_flag=True, default=False, help="Don't try downloading packages from online repos before building")
+@click.option('--incremental', is_flag=True, default=False, help='Keep extracted sources and build trees between builds, only rebuild what changed')
 @click.argument('paths', nargs=-1)
-def cmd_build(paths: list[str], force=False, arch=None, rebuild_dependants: bool = False, no_download: bool = False):
+def cmd_build(paths: list[str], force=False, arch=None, rebuild_dependants: bool = False, no_download: bool = False, incremental: bool = False):
     """
     Build packages (and dependencies) by paths as required.
 
@@ -745,7 +1099,7 @@ def cmd_build(paths: list[str], force=False, arch=None, rebuild_dependants: bool
     Packages that aren't built already will be downloaded from HTTPS repos unless --no-download is passed,
     if an exact version match exists on the server.
     """
-    build(paths, force, arch, rebuild_dependants, not no_download)
+    build(paths, force, arch, rebuild_dependants, not no_download, incremental=incremental)
 
 
 def build(
@@ -754,6 +1108,7 @@ def build(
     arch: Optional[Arch],
     rebuild_dependants: bool = False,
     try_download: bool = False,
+    incremental: bool = False,
 ):
     # TODO: arch = config.get_profile()...
     arch = arch or 'aarch64'
@@ -777,6 +1132,7 @@ def build(
         enable_crossdirect=config.file['build']['crossdirect'],
         enable_ccache=config.file['build']['ccache'],
         clean_chroot=config.file['build']['clean_mode'],
+        incremental=incremental,
     )
 
 
@@ -870,6 +1226,156 @@ def cmd_list():
         )
 
 
+@cmd_packages.command(name='build-one')
+@click.option('--arch', required=True, type=click.Choice(ARCHES), help="The CPU architecture to build for")
+@click.option('--commit', required=True, help='The PKGBUILDs commit to build from, checked out if necessary')
+@click.option('--slot', default=0, type=int, help='Build slot number, separates the build chroots of concurrent builds')
+@click.option('--add', 'add_files', multiple=True, help='Package file (`<repo>/<file>`) shipped into the local repo to add first')
+@click.option('--crosscompile/--no-crosscompile', default=True, help='Crosscompile packages that support it')
+@click.option('--crossdirect/--no-crossdirect', default=True, help='Use crossdirect for foreign arch builds')
+@click.option('--ccache/--no-ccache', default=True, help='Use ccache')
+@click.option('--distcc/--no-distcc', default=True, help='Use the configured distcc hosts')
+@click.option('--clean-chroot/--no-clean-chroot', default=False, help='Reset the build chroot before building')
+@click.argument('path')
+def cmd_build_one(
+    arch: Arch,
+    commit: str,
+    path: str,
+    slot: int = 0,
+    add_files: Iterable[str] = [],
+    crosscompile: bool = True,
+    crossdirect: bool = True,
+    ccache: bool = True,
+    distcc: bool = True,
+    clean_chroot: bool = False,
+):
+    """Build worker mode: build a single package without its dependencies and record the resulting files"""
+    config.runtime['build_slot'] = slot
+    enforce_wrap()
+    pkgbuilds = config.get_path('pkgbuilds')
+
+    def get_head() -> str:
+        return git(['rev-parse', 'HEAD'], dir=pkgbuilds, capture_output=True).stdout.decode().strip()
+
+    # checkouts take the lock exclusively, builds hold it shared until they're done,
+    # so slots only build concurrently from the same commit
+    with open(os.path.join(pkgbuilds, '.git', 'kupferbootstrap-worker.lock'), 'w') as lock:
+        while True:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if get_head() != commit:
+                logging.info(f'Checking out PKGBUILDs commit {commit}')
+                if git(['cat-file', '-e', f'{commit}^{{commit}}'], dir=pkgbuilds).returncode != 0:
+                    git(['fetch', 'origin'], dir=pkgbuilds).check_returncode()
+                git(['checkout', '--detach', commit], dir=pkgbuilds).check_returncode()
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            # downgrading isn't atomic, another slot might have checked out its commit in between
+            if get_head() == commit:
+                break
+        for file in add_files:
+            add_file_to_repo(os.path.join(config.get_package_dir(arch), file), os.path.dirname(file), arch)
+        repo = discover_packages()
+        # split packages share their path and get built together
+        package = list(filter_packages(repo, [path], allow_empty_results=False, use_names=False))[0]
+        build_package(
+            package,
+            arch=arch,
+            enable_crosscompile=crosscompile,
+            enable_crossdirect=crossdirect,
+            enable_ccache=ccache,
+            enable_distcc=distcc,
+            clean_chroot=clean_chroot,
+        )
+        package_dir = config.get_package_dir(arch)
+        results = [os.path.relpath(file, package_dir) for file in add_package_to_repo(package, arch)]
+    os.makedirs(os.path.join(package_dir, BUILD_RESULTS_DIR), exist_ok=True)
+    with open(os.path.join(package_dir, BUILD_RESULTS_DIR, get_build_result_name(package)), 'w') as result_file:
+        json.dump({'commit': commit, 'files': results}, result_file)
+
+
+@cmd_packages.command(name='worker-info')
+def cmd_worker_info():
+    """Print the paths a build scheduler needs to ship packages to this machine as JSON"""
+    print(json.dumps({'packages': config.get_path('packages')}))
+
+
+@cmd_packages.command(name='serve-cache')
+@click.option('--host', default='0.0.0.0', help='Address to listen on')
+@click.option('--port', default=8020, type=int, help='Port to listen on')
+@click.option('--allow-push', is_flag=True, default=False, help='Accept packages pushed via HTTP PUT')
+@click.argument('directory', required=False)
+def cmd_serve_cache(host: str, port: int, allow_push: bool = False, directory: Optional[str] = None):
+    """Serve a binary cache of built packages over HTTP, defaulting to the local binary_cache path"""
+    serve_binary_cache(directory or config.get_path('binary_cache'), host, port, allow_push=allow_push)
+
+
+@cmd_packages.command(name='source-cache')
+@click.option('--prune', is_flag=True, default=False, help='Prune least recently used entries down to build.sources_max_size')
+@click.option('--max-size', default=None, help='Prune down to this size instead, e.g. 20G')
+def cmd_source_cache(prune: bool = False, max_size: Optional[str] = None):
+    """Show the usage of the shared source download cache and optionally prune it"""
+    enforce_wrap()
+    if prune or max_size:
+        prune_sources(parse_size(max_size) if max_size else None)
+    log_sources_usage()
+
+
+@cmd_packages.command(name='resolve')
+@click.option('--arch', default=None, required=False, type=click.Choice(ARCHES), help='The CPU architecture to resolve for')
+@click.option('--https', 'use_https', is_flag=True, default=False, help='Use the online kupfer repos instead of the local ones')
+@click.argument('names', nargs=-1, required=True)
+def cmd_resolve(names: list[str], arch: Optional[Arch] = None, use_https: bool = False):
+    """Print the packages installing NAMES pulls in from the kupfer and base distro repos, with their installed sizes"""
+    enforce_wrap()
+    arch = arch or config.runtime['arch']
+    index = get_package_index(arch, use_local_repos=not use_https)
+    start = time.monotonic()
+    closure, missing = index.resolve(names)
+    elapsed = time.monotonic() - start
+    for name, package in sorted(closure.items()):
+        print(f'{name}\t{package.version}\t{format_size(package.installed_size)}')
+    if missing:
+        logging.warning(f'No package satisfies: {", ".join(sorted(missing))}')
+    installed = sum(package.installed_size for package in closure.values())
+    logging.info(f'Resolved {len(closure)} of {len(index.packages)} packages in {elapsed * 1000:.1f}ms, {format_size(installed)} installed')
+
+
+@cmd_packages.command(name='benchmark-deps')
+@click.option('--arch', default=None, required=False, type=click.Choice(ARCHES), help='The CPU architecture to build for')
+@click.option('--runs', default=1, type=int, help='Installs per profile, the fastest one counts')
+@click.argument('paths', nargs=-1, required=True)
+def cmd_benchmark_deps(paths: list[str], arch: Optional[Arch] = None, runs: int = 1):
+    """
+    Compare installing the build dependencies of PATHS into a clean build chroot with and without the build chroot pacman profile.
+
+    The packages are downloaded first, so only installing is timed.
+    """
+    enforce_wrap()
+    arch = arch or config.runtime['arch']
+    repo = discover_packages()
+    packages = filter_packages(repo, paths, allow_empty_results=False)
+    names = {name for package in packages for name in package.names()}
+    deps = sorted({dep for package in packages for dep in package.get_depends(arch)} - names)
+    chroot = setup_build_chroot(arch)
+    deps = chroot.download_packages(deps)
+    results = {}
+    for profile in [False, True]:
+        timings = []
+        for _ in range(runs):
+            # no extra packages, so no snapshot gets restored
+            setup_build_chroot(arch, clean_chroot=True, pacman_build_profile=profile)
+            start = time.monotonic()
+            install = chroot.try_install_packages(deps, allow_fail=False)
+            timings.append(time.monotonic() - start)
+            if any(isinstance(result, subprocess.CompletedProcess) and result.returncode != 0 for result in install.values()):
+                raise Exception(f'{chroot.name}: failed to install {len(deps)} dependencies')
+        # the pacman cache, pkgbuilds and sources are bind mounted into the chroot
+        with bind_view(chroot) as view:
+            size = subprocess.run(['du', '-sxb', view], capture_output=True).stdout.decode().split('\t')[0]
+        results['build profile' if profile else 'default'] = (min(timings), int(size or 0))
+    logging.info(f'Installing {len(deps)} dependencies for {arch}:\n' +
+                 '\n'.join(f'{name}: {seconds:.1f}s, chroot size {format_size(size)}' for name, (seconds, size) in results.items()))
+
+
 @cmd_packages.command(name='check')
 @click.argument('paths', nargs=-1)
 def cmd_check(paths):
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from config import config
+from constants import Arch
+
+from .pkgbuild import Pkgbuild
+
+MANIFEST = 'manifest.json'
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+
+class BinaryCache:
+    """
+    A store of built packages addressed by their build key, either a local directory or an HTTP server.
+    Layout: `<arch>/<build key>/<package files>` plus a `manifest.json` with the files' sha256 sums,
+    which is written last, so only complete entries are visible.
+    """
+    url: str
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def __repr__(self):
+        return f'BinaryCache({self.url})'
+
+    def is_remote(self) -> bool:
+        return self.url.startswith(('http://', 'https://'))
+
+    def get_path(self, arch: Arch, key: str, file: str = '') -> str:
+        base = self.url if self.is_remote() else self.url.removeprefix('file://')
+        return '/'.join(filter(None, [base, arch, key, file]))
+
+    def _open(self, arch: Arch, key: str, file: str):
+        """Returns a readable stream for `file` of the entry or None if it doesn't exist"""
+        path = self.get_path(arch, key, file)
+        if not self.is_remote():
+            return open(path, 'rb') if os.path.exists(path) else None
+        try:
+            return urlopen(path)
+        except HTTPError as ex:
+            if ex.code == 404:
+                return None
+            raise
+
+    def get_manifest(self, arch: Arch, key: str) -> Optional[dict]:
+        stream = self._open(arch, key, MANIFEST)
+        if stream is None:
+            return None
+        with stream:
+            manifest = json.load(stream)
+        if manifest.get('key') != key:
+            raise Exception(f'{self}: manifest of {arch}/{key} belongs to {manifest.get("key")}')
+        return manifest
+
+    def pull(self, arch: Arch, key: str, dest_dir: str) -> Optional[list[str]]:
+        """
+        Downloads the entry for `key` into `dest_dir`, verifying the checksums. Returns the file paths or None on a cache miss.
+        Files only get moved into `dest_dir` once all of them are verified.
+        """
+        manifest = self.get_manifest(arch, key)
+        if manifest is None:
+            return None
+        os.makedirs(dest_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=dest_dir, prefix='.pull_') as tmp:
+            for file, sha256 in manifest['files'].items():
+                if os.path.basename(file) != file:
+                    raise Exception(f'{self}: invalid file name {file} in {arch}/{key}')
+                stream = self._open(arch, key, file)
+                if stream is None:
+                    raise Exception(f'{self}: {file} listed in {arch}/{key} is missing')
+                checksum = hashlib.sha256()
+                with stream, open(os.path.join(tmp, file), 'wb') as out:
+                    while chunk := stream.read(TRANSFER_CHUNK_SIZE):
+                        checksum.update(chunk)
+                        out.write(chunk)
+                if checksum.hexdigest() != sha256:
+                    raise Exception(f'{self}: checksum mismatch for {arch}/{key}/{file}')
+            results = []
+            for file in manifest['files']:
+                dest = os.path.join(dest_dir, file)
+                os.rename(os.path.join(tmp, file), dest)
+                results.append(dest)
+        return results
+
+    def _write(self, arch: Arch, key: str, name: str, source: str):
+        path = self.get_path(arch, key, name)
+        if self.is_remote():
+            with open(source, 'rb') as file:
+                request = Request(path, data=file, method='PUT', headers={'Content-Length': str(os.path.getsize(source))})
+                with urlopen(request):
+                    pass
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(source, f'{path}.part')
+            os.rename(f'{path}.part', path)
+
+    def push(self, arch: Arch, key: str, package: Pkgbuild, files: list[str]):
+        manifest: dict = {'key': key, 'package': package.path, 'version': package.version, 'files': {}}
+        for file in files:
+            checksum = hashlib.sha256()
+            with open(file, 'rb') as fd:
+                while chunk := fd.read(TRANSFER_CHUNK_SIZE):
+                    checksum.update(chunk)
+            manifest['files'][os.path.basename(file)] = checksum.hexdigest()
+            self._write(arch, key, os.path.basename(file), file)
+        manifest_path = os.path.join(os.path.dirname(files[0]), f'.{key}.{MANIFEST}')
+        with open(manifest_path, 'w') as fd:
+            json.dump(manifest, fd)
+        try:
+            self._write(arch, key, MANIFEST, manifest_path)
+        finally:
+            os.unlink(manifest_path)
+        logging.info(f'Pushed {package.path} ({key[:12]}) to {self}')
+
+
+def get_binary_cache() -> Optional[BinaryCache]:
+    """Returns the configured binary cache or None if it's disabled"""
+    if not config.file['binary_cache']['enabled']:
+        return None
+    return BinaryCache(config.file['binary_cache']['url'] or config.get_path('binary_cache'))
+
+
+def pull_packages(cache: BinaryCache, packages: dict[Pkgbuild, str], arch: Arch) -> dict[Pkgbuild, list[str]]:
+    """
+    Concurrently pulls the packages from `packages` (package -> build key) found in `cache` into the local repo dirs.
+    Returns the pulled packages and their files. Failed transfers are logged and treated as cache misses.
+    """
+
+    def pull(package: Pkgbuild, key: str) -> Optional[list[str]]:
+        try:
+            return cache.pull(arch, key, os.path.join(config.get_package_dir(arch), package.repo))
+        except Exception as ex:
+            logging.warning(f'Failed to pull {package.path} from {cache}: {ex}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, config.file['binary_cache']['parallel_transfers'])) as executor:
+        futures = {package: executor.submit(pull, package, key) for package, key in packages.items()}
+    results = {}
+    for package, future in futures.items():
+        files = future.result()
+        if files:
+            logging.info(f'Pulled {package.path} from {cache}')
+            results[package] = files
+    return results
+
+
+class BinaryCacheRequestHandler(SimpleHTTPRequestHandler):
+    """Serves a binary cache directory over HTTP, optionally accepting pushes via PUT"""
+    allow_push = False
+
+    def do_PUT(self):
+        if not self.allow_push:
+            self.send_error(405, 'Pushing is disabled')
+            return
+        path = self.translate_path(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.part', 'wb') as file:
+            while length > 0:
+                chunk = self.rfile.read(min(length, TRANSFER_CHUNK_SIZE))
+                if not chunk:
+                    break
+                file.write(chunk)
+                length -= len(chunk)
+        if length:
+            os.unlink(f'{path}.part')
+            self.send_error(400, 'Incomplete upload')
+            return
+        os.rename(f'{path}.part', path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def serve_binary_cache(directory: str, host: str, port: int, allow_push: bool = False):
+    os.makedirs(directory, exist_ok=True)
+    handler = partial(type('Handler', (BinaryCacheRequestHandler,), {'allow_push': allow_push}), directory=directory)
+    server = ThreadingHTTPServer((host, port), handler)
+    logging.info(f'Serving binary cache {directory} on http://{host}:{port}/' + (' (push enabled)' if allow_push else ''))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
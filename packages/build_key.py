@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+from chroot.build import build_chroot_name
+from config import config
+from constants import Arch, CHROOT_PATHS
+from generator import generate_makepkg_conf
+
+from .pkgbuild import Pkgbuild
+
+BUILD_KEY_EXTENSION = '.buildkey'
+
+_build_keys: dict[tuple[str, Arch], str] = {}
+
+
+def hash_recipe(package: Pkgbuild) -> str:
+    """Hashes the PKGBUILD and the local files it references. Downloaded sources are pinned by the PKGBUILD's checksums."""
+    pkgbuild_dir = os.path.join(config.get_path('pkgbuilds'), package.path)
+    checksum = hashlib.sha256()
+    for file in ['PKGBUILD'] + sorted(set(package.local_sources)):
+        path = os.path.join(pkgbuild_dir, file)
+        checksum.update(file.encode() + b'\0')
+        if not os.path.exists(path):
+            logging.debug(f'{package.path}: local source {file} is missing')
+            continue
+        with open(path, 'rb') as fd:
+            checksum.update(hashlib.sha256(fd.read()).digest())
+    return checksum.hexdigest()
+
+
+def resolve_local_package(repo: dict[str, Pkgbuild], name: str) -> Optional[Pkgbuild]:
+    if name in repo:
+        return repo[name]
+    for package in repo.values():
+        if name in package.names():
+            return package
+    return None
+
+
+def get_build_key(package: Pkgbuild, arch: Arch, repo: dict[str, Pkgbuild]) -> str:
+    """
+    Returns the key identifying the result of building `package` for `arch`: a hash of the PKGBUILD and its local sources,
+    the generated makepkg.conf, the versions of the local dependencies and the build mode.
+    Packages of the same pkgbase share their key.
+    """
+    cache_key = (package.path, arch)
+    if cache_key in _build_keys:
+        return _build_keys[cache_key]
+    cross = arch != config.runtime['arch'] and package.mode == 'cross'
+    cross_chroot = os.path.join(CHROOT_PATHS['chroots'], build_chroot_name(arch)) if cross else None
+    depends = set[str]()
+    for dep in package.get_depends(arch):
+        resolved = resolve_local_package(repo, dep)
+        if resolved and resolved.path != package.path:
+            depends.add(f'{dep}={resolved.version}')
+    inputs = {
+        'arch': arch,
+        'recipe': hash_recipe(package),
+        'makepkg_conf': hashlib.sha256(generate_makepkg_conf(arch, cross=cross, chroot=cross_chroot).encode()).hexdigest(),
+        'depends': sorted(depends),
+        'mode': package.mode,
+        'cross': cross,
+    }
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+    logging.debug(f'{package.path}: build key {key} for {arch} from {inputs}')
+    _build_keys[cache_key] = key
+    return key
+
+
+def get_build_key_path(package_file: str) -> str:
+    return package_file + BUILD_KEY_EXTENSION
+
+
+def read_build_key(package_file: str) -> Optional[str]:
+    path = get_build_key_path(package_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return file.read().strip()
+
+
+def write_build_key(package_file: str, key: str):
+    with open(get_build_key_path(package_file), 'w') as file:
+        file.write(key + '\n')
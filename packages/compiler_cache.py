@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import subprocess
+
+from chroot import Chroot
+from constants import Arch, CHROOT_PATHS
+from config import config
+
+RUST_PACKAGES = ['rust', 'cargo', 'rustup']
+
+
+class CompilerCacheStats:
+    hits: int
+    misses: int
+
+    def __init__(self, hits: int = 0, misses: int = 0):
+        self.hits = hits
+        self.misses = misses
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        rate = f' ({100 * self.hits // total}%)' if total else ''
+        return f'{self.hits} hits, {self.misses} misses{rate}'
+
+    def __sub__(self, other: 'CompilerCacheStats') -> 'CompilerCacheStats':
+        return CompilerCacheStats(self.hits - other.hits, self.misses - other.misses)
+
+
+def uses_rust(depends: list[str]) -> bool:
+    return bool(set(depends).intersection(RUST_PACKAGES))
+
+
+def get_compiler_cache_env(arch: Arch, rust: bool = False) -> dict[str, str]:
+    """Environment for ccache, and sccache if `rust` is set, using the per-arch cache mounted by `Chroot.mount_ccache()`"""
+    cache_dir = os.path.join(CHROOT_PATHS['ccache'], arch)
+    max_size = config.file['build']['ccache_max_size']
+    env = {'CCACHE_DIR': os.path.join(cache_dir, 'ccache')}
+    if max_size:
+        env['CCACHE_MAXSIZE'] = max_size
+    if rust:
+        env |= {'RUSTC_WRAPPER': 'sccache', 'SCCACHE_DIR': os.path.join(cache_dir, 'sccache')}
+        if max_size:
+            env['SCCACHE_CACHE_SIZE'] = max_size
+    return env
+
+
+def read_ccache_stats(chroot: Chroot, env: dict[str, str]) -> CompilerCacheStats:
+    result = chroot.run_cmd('ccache --print-stats', inner_env=env, capture_output=True)
+    assert isinstance(result, subprocess.CompletedProcess)
+    if result.returncode != 0:
+        logging.debug(f'Failed to read ccache stats: {result.stderr.decode()}')
+        return CompilerCacheStats()
+    counters = dict[str, int]()
+    for line in result.stdout.decode().splitlines():
+        key, _, value = line.partition('\t')
+        if value.isdigit():
+            counters[key] = int(value)
+    return CompilerCacheStats(
+        hits=counters.get('direct_cache_hit', 0) + counters.get('preprocessed_cache_hit', 0),
+        misses=counters.get('cache_miss', 0),
+    )
+
+
+def read_sccache_stats(chroot: Chroot, env: dict[str, str]) -> CompilerCacheStats:
+    """Reads the stats of the sccache server started by the build and stops it, so it doesn't keep the chroot busy"""
+    result = chroot.run_cmd('sccache --show-stats --stats-format=json', inner_env=env, capture_output=True)
+    assert isinstance(result, subprocess.CompletedProcess)
+    chroot.run_cmd('sccache --stop-server', inner_env=env, capture_output=True)
+    if result.returncode != 0:
+        logging.debug(f'Failed to read sccache stats: {result.stderr.decode()}')
+        return CompilerCacheStats()
+    stats = json.loads(result.stdout.decode())['stats']
+    return CompilerCacheStats(
+        hits=sum(stats['cache_hits']['counts'].values()),
+        misses=sum(stats['cache_misses']['counts'].values()),
+    )
+
+
+def evict_ccache(chroot: Chroot, env: dict[str, str]):
+    """Evicts cache entries older than `build.ccache_evict_older_than`, on top of ccache's size based eviction"""
+    age = config.file['build']['ccache_evict_older_than']
+    if not age:
+        return
+    result = chroot.run_cmd(['ccache', '--evict-older-than', age], inner_env=env, capture_output=True)
+    assert isinstance(result, subprocess.CompletedProcess)
+    if result.returncode != 0:
+        logging.warning(f'Failed to evict old ccache entries: {result.stderr.decode()}')
+
+
+def log_compiler_cache_summary(stats: dict[str, dict[str, CompilerCacheStats]]):
+    if not stats:
+        return
+    lines = []
+    for path, package_stats in sorted(stats.items()):
+        lines.append(f'{path}: ' + '; '.join(f'{tool} {tool_stats}' for tool, tool_stats in package_stats.items()))
+    logging.info('Compiler cache statistics:\n' + '\n'.join(lines))
@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import os
+
+from chroot import Chroot
+from config import config
+from constants import Arch, GCC_HOSTSPECS
+
+# masquerade symlinks to distcc named like the compilers the volunteers should run
+DISTCC_MASQUERADE_DIR = '/usr/lib/distcc/kupfer'
+# local stand-ins for those compilers in foreign arch chroots, so distcc can compile and preprocess locally
+DISTCC_LOCAL_DIR = '/usr/lib/distcc/kupfer-local'
+DISTCC_DEFAULT_LIMIT = 4
+DISTCC_LOCALHOST_LIMIT = 2
+
+
+def get_distcc_hosts() -> list[str]:
+    return config.file['build']['distcc_hosts']
+
+
+def parse_distcc_hosts(hosts: list[str]) -> tuple[int, bool]:
+    """
+    Parses DISTCC_HOSTS entries like `host:port/limit,lzo,cpp` or `@host/limit`.
+    Returns the total job limit of the remote hosts and whether all of them support pump mode.
+    """
+    slots = 0
+    pump = True
+    for host in hosts:
+        if host.startswith('-'):
+            # options like --randomize
+            continue
+        name, _, options = host.partition(',')
+        name, _, limit = name.partition('/')
+        if name.lstrip('@').split(':')[0] in ['localhost', '127.0.0.1']:
+            continue
+        slots += int(limit) if limit else DISTCC_DEFAULT_LIMIT
+        pump = pump and 'cpp' in options.split(',')
+    return slots, pump
+
+
+def get_distcc_compilers(arch: Arch) -> list[str]:
+    """
+    The names the volunteers know the compilers for `arch` by.
+    Volunteers are assumed to have the native arch of this machine.
+    """
+    hostspec = GCC_HOSTSPECS[config.runtime['arch']][arch]
+    return [f'{hostspec}-gcc', f'{hostspec}-g++']
+
+
+def setup_distcc(build_root: Chroot, arch: Arch, env: dict[str, str], crossdirect: bool = False) -> bool:
+    """
+    Sets up `env` to distribute compile jobs for `arch` in `build_root` according to `build.distcc_hosts`:
+    the compilers are masqueraded by distcc under their volunteer-side names and MAKEFLAGS is scaled to the remote slots.
+    In foreign arch chroots, local compiles go to crossdirect if `crossdirect` is set or the emulated gcc otherwise.
+    Returns whether the build should be wrapped in `pump`.
+    """
+    hosts = get_distcc_hosts()
+    slots, pump = parse_distcc_hosts(hosts)
+    compilers = get_distcc_compilers(arch)
+    masquerade_dir = build_root.get_path(DISTCC_MASQUERADE_DIR)
+    os.makedirs(masquerade_dir, exist_ok=True)
+    for compiler in compilers:
+        link = os.path.join(masquerade_dir, compiler)
+        if not os.path.islink(link):
+            os.symlink('/usr/bin/distcc', link)
+    path = [DISTCC_MASQUERADE_DIR]
+    if build_root.arch != config.runtime['arch']:
+        local_dir = build_root.get_path(DISTCC_LOCAL_DIR)
+        os.makedirs(local_dir, exist_ok=True)
+        local_compiler_dir = f'/native/usr/lib/crossdirect/{arch}' if crossdirect else '/usr/bin'
+        for compiler, local_compiler in zip(compilers, ['gcc', 'g++']):
+            with open(os.path.join(local_dir, compiler), 'w') as file:
+                file.write(f'#!/bin/sh\nexec {local_compiler_dir}/{local_compiler} "$@"\n')
+            os.chmod(os.path.join(local_dir, compiler), 0o755)
+        path.append(DISTCC_LOCAL_DIR)
+        # pump mode's include server would run emulated
+        pump = False
+    search_path = env['PATH'].split(':')
+    # keep ccache in front, so cache hits don't get distributed
+    position = 1 if search_path[0].startswith('/usr/lib/ccache') else 0
+    env['PATH'] = ':'.join(search_path[:position] + path + search_path[position:])
+    env['DISTCC_HOSTS'] = ' '.join(hosts)
+    # cross builds get CC and CXX with the same compiler names from makepkg.conf
+    env.setdefault('CC', compilers[0])
+    env.setdefault('CXX', compilers[1])
+    threads = config.file['build']['threads'] or multiprocessing.cpu_count()
+    env['MAKEFLAGS'] = f'-j{threads + slots}'
+    pump = pump and config.file['build']['distcc_pump']
+    logging.info(f'Distributing compile jobs to {slots} remote slots' + (' in pump mode' if pump else ''))
+    return pump
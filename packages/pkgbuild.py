@@ -1,18 +1,32 @@
 from copy import deepcopy
 import os
+import re
 import subprocess
+from typing import Optional
 
 from chroot import Chroot
-from constants import CHROOT_PATHS, MAKEPKG_CMD
+from constants import Arch, CHROOT_PATHS, MAKEPKG_CMD
 
 from distro.package import PackageInfo
 
+CHECKSUMS_KEY = re.compile(r'^(md5|sha1|sha224|sha256|sha384|sha512|b2)sums(_\w+)?$')
+DEPENDS_KEY = re.compile(r'^(depends|makedepends|checkdepends|optdepends)(_\w+)?$')
+# what building needs installed. checkdepends aren't needed as our BUILDENV disables check()
+BUILD_DEPENDS_CLASSES = ['depends', 'makedepends']
+
 
 class Pkgbuild(PackageInfo):
+    # the build dependencies of all arches, see `get_depends()`
     depends: list[str]
+    # srcinfo dependency arrays by class and arch (`depends`, `makedepends_aarch64`, `optdepends`, ...)
+    dependencies: dict[str, list[str]]
     provides: list[str]
     replaces: list[str]
     local_depends: list[str]
+    local_sources: list[str]
+    # srcinfo source arrays (`source`, `source_aarch64`, ...) and checksum arrays (`sha256sums`, `b2sums_aarch64`, ...)
+    sources: dict[str, list[str]]
+    checksums: dict[str, list[str]]
     repo = ''
     mode = ''
     path = ''
@@ -29,8 +43,12 @@ class Pkgbuild(PackageInfo):
         self.version = ''
         self.path = relative_path
         self.depends = deepcopy(depends)
+        self.dependencies = {'depends': deepcopy(depends)} if depends else {}
         self.provides = deepcopy(provides)
         self.replaces = deepcopy(replaces)
+        self.local_sources = []
+        self.sources = {}
+        self.checksums = {}
 
     def __repr__(self):
         return f'Pkgbuild({self.name},{repr(self.path)},{self.version},{self.mode})'
@@ -38,6 +56,15 @@ class Pkgbuild(PackageInfo):
     def names(self):
         return list(set([self.name] + self.provides + self.replaces))
 
+    def get_depends(self, arch: Optional[Arch] = None, classes: list[str] = BUILD_DEPENDS_CLASSES) -> list[str]:
+        """Returns the dependency names of `classes` for `arch` or for any arch if `arch` is None"""
+        names = set[str]()
+        for key, dependencies in self.dependencies.items():
+            dependency_class, _, dependency_arch = key.partition('_')
+            if dependency_class in classes and (not dependency_arch or arch is None or dependency_arch == arch):
+                names.update(dependencies)
+        return sorted(names)
+
 
 class Pkgbase(Pkgbuild):
     subpackages: list[Pkgbuild]
@@ -92,12 +119,23 @@ def parse_pkgbuild(relative_pkg_dir: str, native_chroot: Chroot) -> list[Pkgbuil
             current.provides.append(splits[1])
         elif line.startswith('replaces'):
             current.replaces.append(splits[1])
-        elif line.startswith('depends') or line.startswith('makedepends') or line.startswith('checkdepends') or line.startswith('optdepends'):
-            current.depends.append(splits[1].split('=')[0].split(': ')[0])
-    current.depends = list(set(current.depends))
+        elif line.startswith('source') or line.startswith('install'):
+            if line.startswith('source'):
+                current.sources.setdefault(splits[0], []).append(splits[1])
+            # files shipped next to the PKGBUILD, as opposed to downloaded sources
+            source = splits[1].split('::')[-1]
+            if '://' not in source:
+                current.local_sources.append(source)
+        elif CHECKSUMS_KEY.match(splits[0]):
+            current.checksums.setdefault(splits[0], []).append(splits[1])
+        elif DEPENDS_KEY.match(splits[0]):
+            # strip version constraints and optdepends descriptions
+            current.dependencies.setdefault(splits[0], []).append(re.split(r'[<>=:]', splits[1], maxsplit=1)[0].strip())
+    current.local_sources = list(set(current.local_sources))
 
     results = base_package.subpackages or [base_package]
     for pkg in results:
+        pkg.depends = pkg.get_depends()
         pkg.version = f'{pkg.pkgver}-{pkg.pkgrel}'
         if not (pkg.pkgver == base_package.pkgver and pkg.pkgrel == base_package.pkgrel):
             raise Exception('subpackage malformed! pkgver differs!')
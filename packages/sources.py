@@ -0,0 +1,261 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+from glob import glob
+from typing import Optional
+
+from config import config
+from constants import Arch, CHROOT_PATHS
+from utils import format_size, git, parse_size
+
+from .pkgbuild import Pkgbuild
+
+# content-addressed downloads, named `<algorithm>-<checksum>`
+SOURCES_FILES_DIR = 'files'
+# bare git mirrors shared by all packages, named by a hash of their URL
+SOURCES_GIT_DIR = 'git'
+# per-package SRCDEST dirs: `<repo>/<package>`
+SOURCES_SRCDEST_DIR = 'srcdest'
+# strongest first
+CHECKSUM_ALGORITHMS = ['b2', 'sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5']
+VCS_PROTOCOLS = ['bzr', 'fossil', 'git', 'hg', 'svn']
+
+
+class Source:
+    """A remote source of a PKGBUILD, named like makepkg names it in SRCDEST"""
+    name: str
+    url: str
+    protocol: str
+    checksum: Optional[tuple[str, str]]
+
+    def __init__(self, source: str, checksum: Optional[tuple[str, str]] = None):
+        name, _, url = source.rpartition('::')
+        self.url = url
+        scheme = url.split('://')[0]
+        self.protocol = scheme.split('+')[0]
+        self.checksum = checksum
+        if name:
+            self.name = name
+        elif self.is_vcs():
+            # see get_filename() in makepkg's util/source.sh
+            self.name = url.split('#')[0].split('?')[0].rstrip('/').split('/')[-1]
+            if self.protocol == 'git':
+                self.name = self.name.split('.git')[0]
+        else:
+            self.name = url.split('/')[-1]
+
+    def __repr__(self):
+        return f'Source({self.name}, {self.url})'
+
+    def is_vcs(self) -> bool:
+        return self.protocol in VCS_PROTOCOLS
+
+    def get_git_url(self) -> str:
+        """The URL makepkg clones from, see download_git() in makepkg's source/git.sh"""
+        return self.url.removeprefix('git+').split('#')[0].split('?')[0]
+
+
+def get_sources(package: Pkgbuild, arch: Arch) -> list[Source]:
+    """Returns the remote sources of `package` for `arch` with the strongest checksum given for each"""
+    sources = []
+    for key in ['source', f'source_{arch}']:
+        suffix = key.removeprefix('source')
+        for i, source in enumerate(package.sources.get(key, [])):
+            if '://' not in source:
+                continue
+            checksum = None
+            for algorithm in CHECKSUM_ALGORITHMS:
+                checksums = package.checksums.get(f'{algorithm}sums{suffix}', [])
+                if i < len(checksums) and checksums[i] != 'SKIP':
+                    checksum = (algorithm, checksums[i])
+                    break
+            sources.append(Source(source, checksum))
+    return sources
+
+
+def get_sources_path(*joins: str) -> str:
+    return os.path.join(config.get_path('sources'), *joins)
+
+
+def get_srcdest(package: Pkgbuild, in_chroot: bool = False) -> str:
+    base = CHROOT_PATHS['sources'] if in_chroot else config.get_path('sources')
+    return os.path.join(base, SOURCES_SRCDEST_DIR, package.path)
+
+
+def touch(path: str):
+    """Marks a cache entry as used for LRU pruning"""
+    os.utime(path, follow_symlinks=False)
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    checksum = hashlib.new('blake2b' if algorithm == 'b2' else algorithm)
+    with open(path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def update_git_mirror(url: str) -> str:
+    """Clones or incrementally fetches the shared bare mirror of `url` and returns its path"""
+    path = get_sources_path(SOURCES_GIT_DIR, hashlib.sha256(url.encode()).hexdigest()[:32] + '.git')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # packages sharing a source get prefetched concurrently
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _update_git_mirror(url, path)
+    touch(path)
+    return path
+
+
+def _update_git_mirror(url: str, path: str):
+    if os.path.exists(path):
+        logging.info(f'Fetching {url} into git mirror')
+        result = git(['fetch', '--prune', 'origin'], dir=path)
+    else:
+        logging.info(f'Cloning {url} into git mirror')
+        result = git(['clone', '--mirror', url, path + '.tmp'])
+        if result.returncode == 0:
+            os.rename(path + '.tmp', path)
+        else:
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+    if result.returncode != 0:
+        raise Exception(f'Failed to update git mirror of {url}')
+
+
+def prepare_git_source(source: Source, srcdest: str):
+    """
+    Sets up `srcdest/<name>` as the mirror clone makepkg expects, borrowing all objects from the shared mirror
+    so makepkg's own `git fetch` only has to transfer what's newer than the shared mirror.
+    """
+    mirror = update_git_mirror(source.get_git_url())
+    clone = os.path.join(srcdest, source.name)
+    if not os.path.exists(clone):
+        result = git(['init', '--quiet', '--bare', clone])
+        if result.returncode != 0:
+            raise Exception(f'Failed to create {clone}')
+        git(['remote', 'add', '--mirror=fetch', 'origin', source.get_git_url()], dir=clone).check_returncode()
+    # relative to the objects dir, so the clone works both inside and outside of the chroots
+    with open(os.path.join(clone, 'objects', 'info', 'alternates'), 'w') as file:
+        file.write(os.path.relpath(os.path.join(mirror, 'objects'), os.path.join(clone, 'objects')) + '\n')
+    result = git(['fetch', '--quiet', '--prune', mirror, '+refs/*:refs/*'], dir=clone)
+    if result.returncode != 0:
+        raise Exception(f'Failed to update {clone} from {mirror}')
+
+
+def prepare_sources(package: Pkgbuild, arch: Arch) -> str:
+    """
+    Populates the SRCDEST of `package` from the shared caches: git sources from the git mirrors,
+    files with known checksums from the content-addressed store. Returns the SRCDEST path inside the chroots.
+    """
+    srcdest = get_srcdest(package)
+    os.makedirs(srcdest, exist_ok=True)
+    touch(srcdest)
+    for source in get_sources(package, arch):
+        if source.protocol == 'git':
+            prepare_git_source(source, srcdest)
+        elif not source.is_vcs() and source.checksum:
+            stored = get_sources_path(SOURCES_FILES_DIR, '-'.join(source.checksum))
+            target = os.path.join(srcdest, source.name)
+            if os.path.exists(stored) and not os.path.exists(target):
+                logging.debug(f'{package.path}: reusing cached {source.name}')
+                try:
+                    os.link(stored, target)
+                except OSError:
+                    shutil.copyfile(stored, target)
+            if os.path.exists(stored):
+                touch(stored)
+    return get_srcdest(package, in_chroot=True)
+
+
+def store_sources(package: Pkgbuild, arch: Arch):
+    """Adds the downloaded files of `package` to the content-addressed store after verifying their checksums"""
+    srcdest = get_srcdest(package)
+    for source in get_sources(package, arch):
+        if source.is_vcs() or not source.checksum:
+            continue
+        algorithm, checksum = source.checksum
+        stored = get_sources_path(SOURCES_FILES_DIR, f'{algorithm}-{checksum}')
+        downloaded = os.path.join(srcdest, source.name)
+        if os.path.exists(stored) or not os.path.exists(downloaded):
+            continue
+        if hash_file(downloaded, algorithm) != checksum:
+            logging.warning(f'{package.path}: not caching {source.name}: checksum mismatch')
+            continue
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        try:
+            os.link(downloaded, stored)
+        except FileExistsError:
+            # stored concurrently by another package with the same source
+            pass
+        except OSError:
+            shutil.copyfile(downloaded, stored + '.part')
+            os.rename(stored + '.part', stored)
+
+
+def get_entry_size(path: str) -> float:
+    """Disk usage of `path`, sharing the size of hardlinked files among their links"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        stat = os.lstat(path)
+        return stat.st_blocks * 512 / stat.st_nlink
+    size = 0.0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            stat = os.lstat(os.path.join(root, name))
+            size += stat.st_blocks * 512 / stat.st_nlink
+    return size
+
+
+def get_cache_entries() -> dict[str, list[tuple[str, float, float]]]:
+    """Returns the `(path, size, last used)` of the cache entries by kind"""
+    patterns = {
+        SOURCES_FILES_DIR: get_sources_path(SOURCES_FILES_DIR, '*'),
+        SOURCES_GIT_DIR: get_sources_path(SOURCES_GIT_DIR, '*.git'),
+        SOURCES_SRCDEST_DIR: get_sources_path(SOURCES_SRCDEST_DIR, '*', '*'),
+    }
+    return {kind: [(path, get_entry_size(path), os.lstat(path).st_mtime) for path in glob(pattern)] for kind, pattern in patterns.items()}
+
+
+def remove_entry(path: str):
+    logging.info(f'Pruning {os.path.relpath(path, get_sources_path())}')
+    if path.endswith('.git'):
+        # per-package clones borrow the mirror's objects
+        for alternates in glob(get_sources_path(SOURCES_SRCDEST_DIR, '*', '*', '*', 'objects', 'info', 'alternates')):
+            with open(alternates, 'r') as file:
+                if os.path.basename(path) in file.read():
+                    shutil.rmtree(os.path.dirname(os.path.dirname(os.path.dirname(alternates))))
+        if os.path.exists(path + '.lock'):
+            os.unlink(path + '.lock')
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def prune_sources(max_size: Optional[int] = None) -> float:
+    """Removes the least recently used entries until the cache fits into `max_size`. Returns the resulting size."""
+    if max_size is None:
+        if not config.file['build']['sources_max_size']:
+            return 0
+        max_size = parse_size(config.file['build']['sources_max_size'])
+    entries = sorted((entry for kind in get_cache_entries().values() for entry in kind), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+    for path, size, _ in entries:
+        if total <= max_size:
+            break
+        if os.path.exists(path):
+            remove_entry(path)
+        total -= size
+    return total
+
+
+def log_sources_usage():
+    lines = []
+    for kind, entries in get_cache_entries().items():
+        size = sum(size for _, size, _ in entries)
+        oldest = min((used for _, _, used in entries), default=None)
+        age = f', oldest used {int((time.time() - oldest) // 86400)} days ago' if oldest else ''
+        lines.append(f'{kind}: {len(entries)} entries, {format_size(size)}{age}')
+    logging.info('Source cache usage:\n' + '\n'.join(lines))
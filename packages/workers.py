@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from glob import glob
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+from config import config
+from constants import ARCHES, Arch, SSH_COMMON_OPTIONS
+from ssh import find_ssh_keys
+from utils import git
+
+from .build_key import resolve_local_package
+from .pkgbuild import Pkgbuild
+
+WORKER_SCHEMES = ['ssh', 'local']
+BUILD_RESULTS_DIR = '.build-one'
+
+
+class Transport:
+    """Runs commands on a build worker and copies files to and from it"""
+
+    def run(self, cmd: list[str], capture_output: bool = False, tty: bool = False) -> subprocess.CompletedProcess:
+        raise NotImplementedError()
+
+    def put(self, files: list[str], remote_dir: str):
+        raise NotImplementedError()
+
+    def get(self, remote_files: list[str], local_dir: str):
+        raise NotImplementedError()
+
+
+class LocalTransport(Transport):
+    """Runs the worker on this machine, e.g. with a second config file. Mostly useful for testing."""
+
+    def __repr__(self):
+        return 'local'
+
+    def run(self, cmd: list[str], capture_output: bool = False, tty: bool = False) -> subprocess.CompletedProcess:
+        logging.debug(f'worker local: running {cmd}')
+        return subprocess.run(cmd, capture_output=capture_output)
+
+    def put(self, files: list[str], remote_dir: str):
+        os.makedirs(remote_dir, exist_ok=True)
+        for file in files:
+            shutil.copy2(file, remote_dir)
+
+    def get(self, remote_files: list[str], local_dir: str):
+        self.put(remote_files, local_dir)
+
+
+class SSHTransport(Transport):
+    user: str
+    host: str
+    port: int
+
+    def __init__(self, user: str, host: str, port: int):
+        self.user = user
+        self.host = host
+        self.port = port
+
+    def __repr__(self):
+        return f'{self.user}@{self.host}:{self.port}'
+
+    def get_ssh_cmd(self) -> list[str]:
+        keys = find_ssh_keys()
+        return ['ssh'] + (['-i', keys[0]] if keys else []) + SSH_COMMON_OPTIONS + ['-p', str(self.port)]
+
+    def run(self, cmd: list[str], capture_output: bool = False, tty: bool = False) -> subprocess.CompletedProcess:
+        # the docker wrapper on the worker needs a tty
+        full_cmd = self.get_ssh_cmd() + (['-tt'] if tty else []) + [f'{self.user}@{self.host}', '--', shlex.join(cmd)]
+        logging.debug(f'worker {self}: running {full_cmd}')
+        return subprocess.run(full_cmd, capture_output=capture_output)
+
+    def rsync(self, sources: list[str], dest: str):
+        cmd = ['rsync', '-a', '-e', shlex.join(self.get_ssh_cmd())] + sources + [dest]
+        logging.debug(f'worker {self}: running {cmd}')
+        result = subprocess.run(cmd)
+        if result.returncode != 0:
+            raise Exception(f'{self}: failed to copy {sources} to {dest}')
+
+    def put(self, files: list[str], remote_dir: str):
+        if self.run(['mkdir', '-p', remote_dir]).returncode != 0:
+            raise Exception(f'{self}: failed to create {remote_dir}')
+        self.rsync(files, f'{self.user}@{self.host}:{remote_dir}/')
+
+    def get(self, remote_files: list[str], local_dir: str):
+        os.makedirs(local_dir, exist_ok=True)
+        self.rsync([f'{self.user}@{self.host}:{file}' for file in remote_files], f'{local_dir}/')
+
+
+class Worker:
+    """
+    A machine that builds packages for the scheduler via `kupferbootstrap packages build-one`, configured as a URL:
+    `ssh://user@host:port/?arch=aarch64&slots=4&cmd=kupferbootstrap` or `local:///?cmd=kupferbootstrap+-C+other.toml`.
+    `arch` may be given multiple times and defaults to all architectures.
+    """
+    url: str
+    transport: Transport
+    arches: list[Arch]
+    slots: int
+    command: list[str]
+    packages_dir: Optional[str]
+    # repo-relative paths of package files already shipped to the worker
+    shipped: set[str]
+    lock: threading.Lock
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        if parsed.scheme not in WORKER_SCHEMES:
+            raise Exception(f'Invalid worker URL {url}: scheme must be one of {", ".join(WORKER_SCHEMES)}')
+        query = parse_qs(parsed.query)
+        self.url = url
+        if parsed.scheme == 'ssh':
+            if not parsed.hostname:
+                raise Exception(f'Invalid worker URL {url}: host missing')
+            self.transport = SSHTransport(parsed.username or config.get_profile()['username'], parsed.hostname, parsed.port or 22)
+        else:
+            self.transport = LocalTransport()
+        self.arches = [arch for value in query.get('arch', []) for arch in value.split(',')] or list(ARCHES)
+        if unknown := set(self.arches) - set(ARCHES):
+            raise Exception(f'Invalid worker URL {url}: unknown architectures {", ".join(unknown)}')
+        self.slots = int(query.get('slots', ['1'])[0])
+        if self.slots < 1:
+            raise Exception(f'Invalid worker URL {url}: slots must be at least 1')
+        self.command = shlex.split(query.get('cmd', ['kupferbootstrap'])[0])
+        self.packages_dir = None
+        self.shipped = set()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'worker {self.transport}'
+
+    def connect(self):
+        """Queries the worker's paths. Raises an exception if the worker is unreachable."""
+        result = self.transport.run(self.command + ['packages', 'worker-info'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f'{self}: failed to query worker info: {result.stderr.decode()}')
+        info = json.loads(result.stdout.decode().strip().splitlines()[-1])
+        self.packages_dir = info['packages']
+
+    def ship(self, arch: Arch, files: list[str]) -> list[str]:
+        """
+        Copies the local repo `files` (`<repo>/<file>` relative to the local package dir) missing on the worker.
+        They only count as shipped once a build on the worker added them to its repo.
+        """
+        assert self.packages_dir
+        with self.lock:
+            delta = [file for file in files if file not in self.shipped]
+        for repo in sorted(set(os.path.dirname(file) for file in delta)):
+            sources = [os.path.join(config.get_package_dir(arch), file) for file in delta if os.path.dirname(file) == repo]
+            logging.info(f'{self}: shipping {len(sources)} packages to {repo}')
+            self.transport.put(sources, os.path.join(self.packages_dir, arch, repo))
+        return delta
+
+    def build(
+        self,
+        package: Pkgbuild,
+        arch: Arch,
+        commit: str,
+        slot: int,
+        dependency_files: list[str],
+        dest_dir: str,
+        build_args: list[str] = [],
+    ):
+        """Builds `package` on the worker with the `build-one` options `build_args` and copies the resulting package files to `dest_dir`"""
+        assert self.packages_dir
+        delta = self.ship(arch, dependency_files)
+        cmd = self.command + ['packages', 'build-one', '--arch', arch, '--commit', commit, '--slot', str(slot)] + build_args
+        for file in delta:
+            cmd += ['--add', file]
+        logging.info(f'{self} (slot {slot}): building {package.path}')
+        if self.transport.run(cmd + [package.path], tty=True).returncode != 0:
+            raise Exception(f'{self}: failed to build {package.path}')
+        remote_dir = os.path.join(self.packages_dir, arch)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.transport.get([os.path.join(remote_dir, BUILD_RESULTS_DIR, get_build_result_name(package))], tmp)
+            with open(os.path.join(tmp, get_build_result_name(package)), 'r') as result_file:
+                results = json.load(result_file)['files']
+        self.transport.get([os.path.join(remote_dir, file) for file in results], dest_dir)
+        # the worker's repo has the built packages now, no need to ship them back
+        with self.lock:
+            self.shipped.update(delta + results)
+
+
+def get_build_result_name(package: Pkgbuild) -> str:
+    return package.path.replace('/', '_') + '.json'
+
+
+def get_workers(arch: Arch) -> list[Worker]:
+    return [worker for worker in (Worker(url) for url in config.file['build']['workers']) if arch in worker.arches]
+
+
+def get_pkgbuilds_commit(package_paths: list[str]) -> tuple[Optional[str], set[str]]:
+    """Returns the checked out PKGBUILDs commit (None if unavailable) and the `package_paths` with uncommitted changes"""
+    pkgbuilds = config.get_path('pkgbuilds')
+    result = git(['rev-parse', 'HEAD'], dir=pkgbuilds, capture_output=True)
+    if result.returncode != 0:
+        return None, set(package_paths)
+    status = git(['status', '--porcelain', '--untracked-files=no', '--'] + package_paths, dir=pkgbuilds, capture_output=True)
+    dirty = set[str]()
+    for line in status.stdout.decode().splitlines():
+        path = line[3:]
+        dirty.update(package for package in package_paths if path.startswith(package + '/'))
+    return result.stdout.decode().strip(), dirty
+
+
+def get_local_repo_files(arch: Arch) -> dict[str, str]:
+    """Maps the package names in the local repos to their `<repo>/<file>` paths"""
+    files = {}
+    for path in glob(os.path.join(config.get_package_dir(arch), '*', '*.pkg.tar.*')):
+        # skips signatures, build keys etc.
+        if not os.path.basename(path).rsplit('.', 1)[0].endswith('.pkg.tar'):
+            continue
+        files[os.path.basename(path).rsplit('-', 3)[0]] = os.path.relpath(path, config.get_package_dir(arch))
+    return files
+
+
+def get_dependency_closure(package: Pkgbuild, repo: dict[str, Pkgbuild], arch: Arch) -> set[Pkgbuild]:
+    closure = set[Pkgbuild]()
+    queue = [package]
+    while queue:
+        for dep in queue.pop().get_depends(arch):
+            resolved = resolve_local_package(repo, dep)
+            if resolved and resolved not in closure and resolved.path != package.path:
+                closure.add(resolved)
+                queue.append(resolved)
+    return closure
+
+
+def schedule_builds(
+    repo: dict[str, Pkgbuild],
+    packages: set[Pkgbuild],
+    arch: Arch,
+    workers: list[Worker],
+    build_local: Callable[[Pkgbuild], None],
+    finish: Callable[[Pkgbuild], list[str]],
+    build_args: list[str] = [],
+):
+    """
+    Builds `packages` on `workers` and locally, dispatching each package to a free worker slot as soon as its
+    dependencies among `packages` are built. Remote builds get the `build-one` options `build_args`, which have to match
+    how `build_local` builds a package in the local PKGBUILDs dir,
+    one package at a time on a pool thread alongside the remote slots;
+    `finish` adds a package's built files from there to the local repo and returns their paths, only ever on the calling thread.
+    Packages with uncommitted changes are always built locally.
+    Split packages are built once per PKGBUILD.
+    """
+    groups = dict[str, list[Pkgbuild]]()
+    for package in sorted(packages, key=lambda package: package.name):
+        groups.setdefault(package.path, []).append(package)
+    commit, dirty = get_pkgbuilds_commit(sorted(groups))
+    if dirty:
+        logging.info(f'Building locally due to uncommitted changes: {", ".join(sorted(dirty))}')
+    for worker in list(workers):
+        try:
+            worker.connect()
+        except Exception as ex:
+            logging.warning(f'Not using {worker}: {ex}')
+            workers.remove(worker)
+    free_slots = [(worker, slot) for worker in workers for slot in range(worker.slots)]
+    if commit is None or not free_slots:
+        logging.warning('No usable build workers, building everything locally')
+        free_slots = []
+    closures = {path: set.union(*(get_dependency_closure(package, repo, arch) for package in group)) for path, group in groups.items()}
+    pending = {path: set(dep.path for dep in closure if dep.path in groups and dep.path != path) for path, closure in closures.items()}
+    repo_files = get_local_repo_files(arch)
+    # remote builds by worker and slot, the local build with a worker of None
+    running = dict[Future, tuple[str, Optional[Worker], int]]()
+
+    def complete(path: str):
+        for file in finish(groups[path][0]):
+            repo_files[os.path.basename(file).rsplit('-', 3)[0]] = os.path.relpath(file, config.get_package_dir(arch))
+        for deps in pending.values():
+            deps.discard(path)
+
+    def collect(future: Future):
+        path, worker, slot = running.pop(future)
+        if worker:
+            free_slots.append((worker, slot))
+        future.result()
+        complete(path)
+
+    with ThreadPoolExecutor(max_workers=len(free_slots) + 1) as executor:
+        while pending or running:
+            local_busy = any(worker is None for _, worker, _ in running.values())
+            for path in sorted(path for path, deps in pending.items() if not deps):
+                if path in dirty or not free_slots:
+                    if not local_busy:
+                        # the local machine acts as an additional slot
+                        running[executor.submit(build_local, groups[path][0])] = (path, None, 0)
+                        del pending[path]
+                        local_busy = True
+                    continue
+                assert commit
+                worker, slot = free_slots.pop(0)
+                dependency_files = sorted(set(repo_files[name] for dep in closures[path] for name in dep.names() if name in repo_files))
+                future = executor.submit(
+                    worker.build,
+                    groups[path][0],
+                    arch,
+                    commit,
+                    slot,
+                    dependency_files,
+                    os.path.join(config.get_path('pkgbuilds'), path),
+                    build_args,
+                )
+                running[future] = (path, worker, slot)
+                del pending[path]
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            elif pending:
+                raise Exception(f'Unable to schedule {", ".join(pending)}: dependency cycle')
@@ -0,0 +1,303 @@
+import logging
+import os
+import struct
+import uuid
+import zlib
+from typing import Optional
+
+from blockcopy import get_fd_size
+
+MBR = 'msdos'
+GPT = 'gpt'
+PARTITION_TABLE_TYPES = [MBR, GPT]
+
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_DISK_ID_OFFSET = 440
+MBR_PARTITIONS_OFFSET = 446
+MBR_PARTITIONS = 4
+# status, CHS of first sector, type, CHS of last sector, first LBA, sectors count
+MBR_PARTITION = struct.Struct('<B3sB3sII')
+MBR_BOOTABLE = 0x80
+MBR_TYPE_LINUX = 0x83
+MBR_TYPE_GPT_PROTECTIVE = 0xEE
+# CHS values are meaningless on anything we partition, use the LBA-only marker like other tools do
+MBR_CHS_DUMMY = b'\xfe\xff\xff'
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+# signature, revision, header size, header crc32, reserved, current LBA, backup LBA,
+# first usable LBA, last usable LBA, disk GUID, partition entries LBA, entries count, entry size, entries crc32
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+# type GUID, partition GUID, first LBA, last LBA (inclusive), attributes, UTF-16LE name
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+GPT_ENTRIES = 128
+GPT_TYPE_LINUX = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+GPT_ATTR_LEGACY_BOOTABLE = 1 << 2
+
+# partitions start at 1 MiB boundaries, like parted and fdisk do by default
+PARTITION_ALIGNMENT = 1024 * 1024
+
+
+class Partition:
+    number: int
+    start: int
+    size: int
+    type: str
+    bootable: bool
+    name: str
+    uuid: Optional[str]
+
+    def __init__(
+        self,
+        number: int,
+        start: int,
+        size: int,
+        type: Optional[str] = None,
+        bootable: bool = False,
+        name: str = '',
+        uuid: Optional[str] = None,
+    ):
+        """`start` and `size` are in sectors. `type` is a hex MBR type like '83' or a GPT type GUID."""
+        self.number = number
+        self.start = start
+        self.size = size
+        self.type = type or ''
+        self.bootable = bootable
+        self.name = name
+        self.uuid = uuid
+
+    def __repr__(self):
+        return f'Partition({self.number}: sectors {self.start}+{self.size}, type {self.type}{", bootable" if self.bootable else ""})'
+
+    def end(self) -> int:
+        """Returns the first sector after the partition"""
+        return self.start + self.size
+
+
+class PartitionTable:
+    type: str
+    sector_size: int
+    sectors: int
+    disk_id: str
+    partitions: list[Partition]
+
+    def __init__(self, type: str, sector_size: int, sectors: int, disk_id: Optional[str] = None, partitions: list[Partition] = []):
+        if type not in PARTITION_TABLE_TYPES:
+            raise Exception(f'Unknown partition table type "{type}". Choices: {", ".join(PARTITION_TABLE_TYPES)}')
+        self.type = type
+        self.sector_size = sector_size
+        self.sectors = sectors
+        self.disk_id = disk_id or (str(uuid.uuid4()) if type == GPT else os.urandom(4).hex())
+        self.partitions = list(partitions)
+
+    def __repr__(self):
+        return f'PartitionTable({self.type}, {self.sectors} sectors of {self.sector_size} bytes, {self.partitions})'
+
+    def gpt_entries_sectors(self) -> int:
+        return -(-GPT_ENTRIES * GPT_ENTRY.size // self.sector_size)
+
+    def first_usable_sector(self) -> int:
+        return 2 + self.gpt_entries_sectors() if self.type == GPT else 1
+
+    def last_usable_sector(self) -> int:
+        return self.sectors - 1 - (1 + self.gpt_entries_sectors() if self.type == GPT else 0)
+
+    def align(self, sector: int) -> int:
+        """Rounds `sector` up to the next partition alignment boundary"""
+        alignment = max(1, PARTITION_ALIGNMENT // self.sector_size)
+        return -(-sector // alignment) * alignment
+
+    def get_partition(self, number: int) -> Partition:
+        for partition in self.partitions:
+            if partition.number == number:
+                return partition
+        raise Exception(f'Partition {number} not found in {self}')
+
+    def get_offset(self, number: int) -> tuple[int, int]:
+        """Returns the byte offset and byte size of partition `number`"""
+        partition = self.get_partition(number)
+        return partition.start * self.sector_size, partition.size * self.sector_size
+
+    def add_partition(self, size: Optional[int] = None, start: Optional[int] = None, **kwargs) -> Partition:
+        """
+        Appends a partition of `size` sectors at `start` (default: aligned after the last partition).
+        Without a `size`, the partition extends to the last usable sector.
+        """
+        if start is None:
+            start = self.align(max([p.end() for p in self.partitions] + [self.first_usable_sector()]))
+        if size is None:
+            size = self.last_usable_sector() + 1 - start
+        kwargs.setdefault('type', GPT_TYPE_LINUX if self.type == GPT else f'{MBR_TYPE_LINUX:02x}')
+        if self.type == GPT and 'uuid' not in kwargs:
+            kwargs['uuid'] = str(uuid.uuid4())
+        partition = Partition(max([p.number for p in self.partitions] + [0]) + 1, start, size, **kwargs)
+        self.partitions.append(partition)
+        self.validate()
+        return partition
+
+    def resize_partition(self, number: int, size: int):
+        self.get_partition(number).size = size
+        self.validate()
+
+    def resize_disk(self, sectors: int):
+        """Changes the disk size the table is written for, e.g. after truncating an image. The GPT backup header moves along."""
+        self.sectors = sectors
+        self.validate()
+
+    def validate(self):
+        if self.type == MBR and len(self.partitions) > MBR_PARTITIONS:
+            raise Exception(f'MBR partition tables only support {MBR_PARTITIONS} primary partitions')
+        if self.type == GPT and len(self.partitions) > GPT_ENTRIES:
+            raise Exception(f'Too many partitions for GPT: {len(self.partitions)}')
+        last_end = 0
+        for partition in sorted(self.partitions, key=lambda p: p.start):
+            if partition.size <= 0:
+                raise Exception(f'{partition} is empty')
+            if partition.start < max(last_end, self.first_usable_sector()):
+                raise Exception(f'{partition} overlaps the previous partition or the partition table')
+            if partition.end() - 1 > self.last_usable_sector():
+                raise Exception(f'{partition} exceeds the last usable sector {self.last_usable_sector()}')
+            last_end = partition.end()
+
+    def _pack_mbr(self, old: bytes) -> bytes:
+        """Returns the new first 512 bytes, keeping any boot code from `old`"""
+        entries = []
+        if self.type == GPT:
+            entries.append(MBR_PARTITION.pack(0, b'\x00\x02\x00', MBR_TYPE_GPT_PROTECTIVE, MBR_CHS_DUMMY, 1, min(self.sectors - 1, 0xFFFFFFFF)))
+            disk_id = bytes(4)
+        else:
+            for partition in sorted(self.partitions, key=lambda p: p.number):
+                if partition.start > 0xFFFFFFFF or partition.size > 0xFFFFFFFF:
+                    raise Exception(f'{partition} is out of range for MBR, use GPT instead')
+                entries.append(
+                    MBR_PARTITION.pack(
+                        MBR_BOOTABLE if partition.bootable else 0,
+                        MBR_CHS_DUMMY,
+                        int(partition.type, 16),
+                        MBR_CHS_DUMMY,
+                        partition.start,
+                        partition.size,
+                    ))
+            disk_id = bytes.fromhex(self.disk_id)[::-1]
+        entries += [bytes(MBR_PARTITION.size)] * (MBR_PARTITIONS - len(entries))
+        return old[:MBR_DISK_ID_OFFSET] + disk_id + bytes(2) + b''.join(entries) + MBR_SIGNATURE
+
+    def _pack_gpt(self) -> tuple[bytes, bytes, bytes]:
+        """Returns the primary header, the entries array and the backup header, each padded to full sectors"""
+        entries = bytearray(GPT_ENTRIES * GPT_ENTRY.size)
+        for i, partition in enumerate(sorted(self.partitions, key=lambda p: p.number)):
+            assert partition.uuid
+            GPT_ENTRY.pack_into(
+                entries,
+                i * GPT_ENTRY.size,
+                uuid.UUID(partition.type).bytes_le,
+                uuid.UUID(partition.uuid).bytes_le,
+                partition.start,
+                partition.end() - 1,
+                GPT_ATTR_LEGACY_BOOTABLE if partition.bootable else 0,
+                partition.name.encode('utf-16-le')[:72],
+            )
+        entries_crc = zlib.crc32(entries)
+        entries += bytes(self.gpt_entries_sectors() * self.sector_size - len(entries))
+        last_sector = self.sectors - 1
+
+        def header(current: int, backup: int, entries_lba: int) -> bytes:
+            fields = [
+                GPT_SIGNATURE,
+                GPT_REVISION,
+                GPT_HEADER.size,
+                0,
+                0,
+                current,
+                backup,
+                self.first_usable_sector(),
+                self.last_usable_sector(),
+                uuid.UUID(self.disk_id).bytes_le,
+                entries_lba,
+                GPT_ENTRIES,
+                GPT_ENTRY.size,
+                entries_crc,
+            ]
+            fields[3] = zlib.crc32(GPT_HEADER.pack(*fields))
+            return GPT_HEADER.pack(*fields) + bytes(self.sector_size - GPT_HEADER.size)
+
+        primary = header(1, last_sector, 2)
+        backup = header(last_sector, 1, last_sector - self.gpt_entries_sectors())
+        return primary, bytes(entries), backup
+
+    def write(self, path: str):
+        """Writes the partition table to the image file or block device at `path`, which must already have its final size"""
+        self.validate()
+        fd = os.open(path, os.O_RDWR)
+        try:
+            size = get_fd_size(fd)
+            if size < self.sectors * self.sector_size:
+                raise Exception(f'{path} is smaller than the partition table expects: {size} < {self.sectors * self.sector_size} bytes')
+            os.pwrite(fd, self._pack_mbr(os.pread(fd, 512, 0).ljust(512, b'\x00')), 0)
+            if self.type == GPT:
+                primary, entries, backup = self._pack_gpt()
+                os.pwrite(fd, primary, self.sector_size)
+                os.pwrite(fd, entries, 2 * self.sector_size)
+                os.pwrite(fd, entries, (self.sectors - 1 - self.gpt_entries_sectors()) * self.sector_size)
+                os.pwrite(fd, backup, (self.sectors - 1) * self.sector_size)
+            elif os.pread(fd, len(GPT_SIGNATURE), self.sector_size) == GPT_SIGNATURE:
+                # a stale primary GPT header would take precedence over the MBR
+                os.pwrite(fd, bytes(self.sector_size), self.sector_size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        logging.debug(f'Wrote {self} to {path}')
+
+
+def _read_gpt(fd: int, sector_size: int, sectors: int) -> PartitionTable:
+    raw = os.pread(fd, GPT_HEADER.size, sector_size)
+    fields = list(GPT_HEADER.unpack(raw))
+    signature, _, header_size, header_crc = fields[:4]
+    if signature != GPT_SIGNATURE or header_size != GPT_HEADER.size:
+        raise Exception(f'Invalid GPT header at sector 1 (sector size {sector_size})')
+    fields[3] = 0
+    if zlib.crc32(GPT_HEADER.pack(*fields)) != header_crc:
+        raise Exception('GPT header checksum mismatch')
+    disk_guid, entries_lba, entries_count, entry_size, entries_crc = fields[9:]
+    if entry_size != GPT_ENTRY.size:
+        raise Exception(f'Unsupported GPT entry size {entry_size}')
+    entries = os.pread(fd, entries_count * entry_size, entries_lba * sector_size)
+    if zlib.crc32(entries) != entries_crc:
+        raise Exception('GPT partition entries checksum mismatch')
+    table = PartitionTable(GPT, sector_size, sectors, disk_id=str(uuid.UUID(bytes_le=disk_guid)))
+    for i in range(entries_count):
+        type_guid, part_guid, first, last, attributes, name = GPT_ENTRY.unpack_from(entries, i * entry_size)
+        if type_guid == bytes(16):
+            continue
+        table.partitions.append(
+            Partition(
+                i + 1,
+                first,
+                last - first + 1,
+                type=str(uuid.UUID(bytes_le=type_guid)),
+                bootable=bool(attributes & GPT_ATTR_LEGACY_BOOTABLE),
+                name=name.decode('utf-16-le').rstrip('\x00'),
+                uuid=str(uuid.UUID(bytes_le=part_guid)),
+            ))
+    return table
+
+
+def read_partition_table(path: str, sector_size: int) -> PartitionTable:
+    """Parses the MBR or GPT partition table of the image file or block device at `path`"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sectors = get_fd_size(fd) // sector_size
+        mbr = os.pread(fd, 512, 0)
+        if len(mbr) != 512 or mbr[510:] != MBR_SIGNATURE:
+            raise Exception(f'{path} has no partition table')
+        entries = [MBR_PARTITION.unpack_from(mbr, MBR_PARTITIONS_OFFSET + i * MBR_PARTITION.size) for i in range(MBR_PARTITIONS)]
+        if any(entry[2] == MBR_TYPE_GPT_PROTECTIVE for entry in entries):
+            return _read_gpt(fd, sector_size, sectors)
+        table = PartitionTable(MBR, sector_size, sectors, disk_id=mbr[MBR_DISK_ID_OFFSET:MBR_DISK_ID_OFFSET + 4][::-1].hex())
+        for i, (status, _, part_type, _, start, size) in enumerate(entries):
+            if part_type == 0 or size == 0:
+                continue
+            table.partitions.append(Partition(i + 1, start, size, type=f'{part_type:02x}', bootable=bool(status & MBR_BOOTABLE)))
+        return table
+    finally:
+        os.close(fd)
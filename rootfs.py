@@ -0,0 +1,313 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from glob import glob
+from typing import Optional
+
+from chroot.device import DeviceChroot
+from config import config
+from constants import Arch, BASE_PACKAGES, CHROOT_PATHS, DEVICES, FLAVOURS, NO_EXTRACT_SETS
+from distro.distro import get_kupfer_https, get_kupfer_local
+from utils import mount, umount
+
+LAYER_META = 'meta.json'
+LAYER_UPPER = 'upper'
+LAYER_WORK = 'work'
+
+RSYNC_CMD = ['rsync', '-a', '-H', '-A', '-X', '--numeric-ids', '-q']
+# pseudo filesystems and bind-mounted host directories that must never end up in a rootfs layer
+ROOTFS_EXCLUDES = ['/proc/*', '/sys/*', '/dev/*', '/run/*', '/tmp/*', 'lost+found'] + [path.rstrip('/') for path in CHROOT_PATHS.values()]
+
+
+def get_rootfs_cache_dir(arch: Arch, *joins: str) -> str:
+    return os.path.join(config.get_path('rootfs'), arch, *joins)
+
+
+def get_sync_db_hashes(chroot_path: str) -> dict[str, str]:
+    """Hashes the pacman sync databases of the rootfs at `chroot_path`"""
+    results = {}
+    for db in sorted(glob(os.path.join(chroot_path, 'var/lib/pacman/sync/*.db'))):
+        with open(db, 'rb') as file:
+            results[os.path.basename(db)] = hashlib.sha256(file.read()).hexdigest()
+    return results
+
+
+def get_no_extract_patterns(sets: list[str], locales_keep: list[str] = []) -> list[str]:
+    """Returns the pacman NoExtract patterns for the `NO_EXTRACT_SETS` named in `sets`, re-including the locales in `locales_keep`"""
+    patterns = []
+    for name in sets:
+        if name not in NO_EXTRACT_SETS:
+            raise Exception(f'Unknown no_extract set "{name}", choose from: {", ".join(NO_EXTRACT_SETS.keys())}')
+        patterns += NO_EXTRACT_SETS[name]
+    if 'locales' in sets:
+        for locale in locales_keep:
+            patterns += [f'!usr/share/locale/{locale}/', f'!usr/share/locale/{locale}/*']
+    return patterns
+
+
+def get_disk_usage(path: str) -> tuple[int, int]:
+    """Disk usage of the files under `path` in bytes and their number of inodes, counting hardlinked files once"""
+    size = inodes = 0
+    seen = set[tuple[int, int]]()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            stat = os.lstat(os.path.join(root, name))
+            if stat.st_nlink > 1 and not os.path.isdir(os.path.join(root, name)):
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+            size += stat.st_blocks * 512
+            inodes += 1
+    return size, inodes
+
+
+def rsync_rootfs(source: str, destination: str):
+    cmd = RSYNC_CMD.copy()
+    for exclude in ROOTFS_EXCLUDES:
+        cmd += ['--exclude', exclude]
+    cmd += [f'{source.rstrip("/")}/', f'{destination.rstrip("/")}/']
+    logging.debug(f'running rsync: {cmd}')
+    result = subprocess.run(cmd)
+    if result.returncode != 0:
+        raise Exception(f'Failed to rsync {source} to {destination}')
+
+
+def mount_overlay(lower_dirs: list[str], target: str, upper_dir: Optional[str] = None, work_dir: Optional[str] = None):
+    """Mounts an overlayfs of `lower_dirs` (topmost first) at `target`, read-only unless `upper_dir` and `work_dir` are passed"""
+    options = 'lowerdir=' + ':'.join(lower_dirs)
+    if upper_dir:
+        assert work_dir
+        options += f',upperdir={upper_dir},workdir={work_dir}'
+    os.makedirs(target, exist_ok=True)
+    result = mount('overlay', target, options=[options], fs_type='overlay')
+    if result.returncode != 0:
+        raise Exception(f'Failed to mount overlay at {target}')
+
+
+def umount_overlay(target: str):
+    result = umount(target)
+    if result.returncode != 0:
+        raise Exception(f'Failed to unmount overlay at {target}: {result.stderr.decode().strip()}')
+
+
+class RootfsLayer:
+    """
+    A set of packages installed on top of its `parent` layers, stored as the upper directory of an overlayfs.
+    Layers are keyed by their packages, NoExtract patterns and their parents' keys,
+    so e.g. the base layer is shared by all devices and flavours.
+    """
+    name: str
+    arch: Arch
+    packages: list[str]
+    parent: Optional['RootfsLayer']
+    use_local_repos: bool
+    no_extract: list[str]
+    key: str
+
+    def __init__(
+        self,
+        name: str,
+        arch: Arch,
+        packages: list[str],
+        parent: Optional['RootfsLayer'],
+        use_local_repos: bool,
+        no_extract: list[str] = [],
+    ):
+        self.name = name
+        self.arch = arch
+        self.packages = sorted(set(packages))
+        self.parent = parent
+        self.use_local_repos = use_local_repos
+        self.no_extract = list(no_extract)
+        inputs = {
+            'arch': arch,
+            'packages': self.packages,
+            'local_repos': use_local_repos,
+            'parent': parent.key if parent else None,
+        }
+        if self.no_extract:
+            # keeps the keys of existing full layers
+            inputs['no_extract'] = self.no_extract
+        self.key = f'{name}-{hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]}'
+
+    def __repr__(self):
+        return f'RootfsLayer({self.key})'
+
+    def get_path(self, *joins: str) -> str:
+        return get_rootfs_cache_dir(self.arch, 'layers', self.key, *joins)
+
+    def get_stack(self) -> list['RootfsLayer']:
+        """Returns this layer and its parents, topmost first"""
+        return [self] + (self.parent.get_stack() if self.parent else [])
+
+    def all_packages(self) -> list[str]:
+        return sorted(set(pkg for layer in self.get_stack() for pkg in layer.packages))
+
+    def load_meta(self) -> Optional[dict]:
+        path = self.get_path(LAYER_META)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def is_built(self) -> bool:
+        return self.load_meta() is not None
+
+    def get_chroot(self, path: str) -> DeviceChroot:
+        repos = dict(get_kupfer_local(self.arch).repos if self.use_local_repos else get_kupfer_https(self.arch).repos)
+        chroot = DeviceChroot(
+            f'layer_{self.key}',
+            self.arch,
+            initialize=False,
+            copy_base=False,
+            base_packages=self.packages,
+            extra_repos=repos,
+            path_override=path,
+        )
+        chroot.no_extract = self.no_extract
+        return chroot
+
+    def get_footprint(self) -> tuple[int, int]:
+        """Disk usage and inodes of the rootfs this layer stack flattens into, see `get_disk_usage()`. The layers need to be built."""
+        merged = get_rootfs_cache_dir(self.arch, 'mnt', f'{self.key}-footprint')
+        mount_overlay([layer.get_path(LAYER_UPPER) for layer in self.get_stack()], merged)
+        try:
+            return get_disk_usage(merged)
+        finally:
+            umount_overlay(merged)
+
+    def refresh_db_hashes(self) -> dict[str, str]:
+        """Refreshes the sync databases in a throwaway overlay on top of the (built) layer stack and returns their hashes"""
+        scratch = get_rootfs_cache_dir(self.arch, 'scratch', self.key)
+        merged = os.path.join(scratch, 'merged')
+        upper = os.path.join(scratch, LAYER_UPPER)
+        work = os.path.join(scratch, LAYER_WORK)
+        if os.path.exists(scratch):
+            shutil.rmtree(scratch)
+        os.makedirs(upper)
+        os.makedirs(work)
+        try:
+            mount_overlay([layer.get_path(LAYER_UPPER) for layer in self.get_stack()], merged, upper_dir=upper, work_dir=work)
+            try:
+                chroot = self.get_chroot(merged)
+                chroot.initialized = True
+                chroot.write_pacman_conf()
+                try:
+                    chroot.activate()
+                    result = chroot.run_cmd('pacman -Sy --noconfirm')
+                finally:
+                    chroot.deactivate()
+                assert isinstance(result, subprocess.CompletedProcess)
+                if result.returncode != 0:
+                    raise Exception(f'{chroot.name}: failed to refresh pacman databases')
+                return get_sync_db_hashes(merged)
+            finally:
+                umount_overlay(merged)
+        finally:
+            shutil.rmtree(scratch)
+
+    def build(self, db_hashes: Optional[dict[str, str]] = None) -> bool:
+        """
+        Builds the layer and, recursively, its parents unless they're cached and were built from the sync databases `db_hashes`.
+        Returns whether the layer was (re)built.
+        """
+        parent_built = self.parent.build(db_hashes) if self.parent else False
+        meta = self.load_meta()
+        if meta and not parent_built and (db_hashes is None or meta['db_hashes'] == db_hashes):
+            logging.debug(f'Reusing rootfs layer {self.key}')
+            return False
+        if meta:
+            logging.info(f'Rootfs layer {self.key} is outdated, rebuilding')
+            os.unlink(self.get_path(LAYER_META))
+        upper = self.get_path(LAYER_UPPER)
+        work = self.get_path(LAYER_WORK)
+        for path in [upper, work]:
+            if os.path.exists(path):
+                logging.debug(f'Removing incomplete layer data at {path}')
+                shutil.rmtree(path)
+        os.makedirs(upper)
+        logging.info(f'Building rootfs layer {self.key}: {", ".join(self.packages) or "(no packages)"}')
+        if not self.parent:
+            chroot = self.get_chroot(upper)
+            try:
+                chroot.initialize()
+                built_hashes = get_sync_db_hashes(chroot.path)
+            finally:
+                chroot.deactivate()
+        else:
+            merged = get_rootfs_cache_dir(self.arch, 'mnt', self.key)
+            os.makedirs(work)
+            mount_overlay([layer.get_path(LAYER_UPPER) for layer in self.parent.get_stack()], merged, upper_dir=upper, work_dir=work)
+            try:
+                chroot = self.get_chroot(merged)
+                chroot.initialized = True
+                chroot.write_pacman_conf()
+                # the overlay can only be unmounted once the chroot's mounts inside it are gone
+                try:
+                    chroot.mount_pacman_cache()
+                    chroot.activate()
+                    if self.packages:
+                        # no -y: installing from the parent's sync databases keeps the stack consistent
+                        result = chroot.run_cmd(f"pacman -S --noconfirm --needed --overwrite='/*' {' '.join(self.packages)}")
+                        assert isinstance(result, subprocess.CompletedProcess)
+                        if result.returncode != 0:
+                            raise Exception(f'Failed to install packages into rootfs layer {self.key}: {", ".join(self.packages)}')
+                    built_hashes = get_sync_db_hashes(chroot.path)
+                finally:
+                    chroot.deactivate()
+            finally:
+                umount_overlay(merged)
+            shutil.rmtree(work)
+        with open(self.get_path(LAYER_META), 'w') as file:
+            json.dump({'packages': self.packages, 'parent': self.parent.key if self.parent else None, 'db_hashes': built_hashes}, file)
+        self.prune_siblings()
+        return True
+
+    def prune_siblings(self):
+        """Removes cached layers of the same name with outdated keys"""
+        layers_dir = get_rootfs_cache_dir(self.arch, 'layers')
+        for other in os.listdir(layers_dir):
+            if other != self.key and other.rsplit('-', 1)[0] == self.name:
+                logging.debug(f'Removing outdated rootfs layer {other}')
+                shutil.rmtree(os.path.join(layers_dir, other))
+
+
+def get_rootfs_layers(
+    arch: Arch,
+    device: str,
+    flavour: str,
+    extra_packages: list[str],
+    use_local_repos: bool,
+    no_extract: list[str] = [],
+) -> RootfsLayer:
+    """Returns the topmost layer of the base -> flavour -> device layer stack"""
+    base = RootfsLayer('base', arch, BASE_PACKAGES, None, use_local_repos, no_extract)
+    flavour_layer = RootfsLayer(f'flavour-{flavour}', arch, FLAVOURS[flavour]['packages'], base, use_local_repos, no_extract)
+    return RootfsLayer(f'device-{device}-{flavour}', arch, DEVICES[device] + extra_packages, flavour_layer, use_local_repos, no_extract)
+
+
+def build_rootfs_layers(layer: RootfsLayer):
+    """Builds the layer stack, rebuilding the layers whose sync databases are outdated, parents first"""
+    base = layer.get_stack()[-1]
+    layer.build(base.refresh_db_hashes() if base.is_built() else None)
+
+
+def install_rootfs_layers(chroot: DeviceChroot, layer: RootfsLayer):
+    """
+    Builds the layer stack as needed and flattens it into the (mounted) rootfs at `chroot.path`.
+    Layers built from outdated sync databases get rebuilt instead of upgrading the flattened rootfs, so the cache stays current.
+    """
+    build_rootfs_layers(layer)
+    merged = get_rootfs_cache_dir(chroot.arch, 'mnt', chroot.name)
+    mount_overlay([_layer.get_path(LAYER_UPPER) for _layer in layer.get_stack()], merged)
+    try:
+        logging.info(f'Flattening rootfs layers {", ".join(_layer.key for _layer in layer.get_stack())} into {chroot.path}')
+        rsync_rootfs(merged, chroot.path)
+    finally:
+        umount_overlay(merged)
+    chroot.initialized = True
+    chroot.write_pacman_conf()
+    chroot.activate()
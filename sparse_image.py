@@ -0,0 +1,214 @@
+import logging
+import os
+import struct
+import time
+from typing import IO, Iterator, Optional, Union
+
+from blockcopy import CHUNK_SIZE, CopyStats, align_extents, get_data_extents, get_fd_size
+
+# Android sparse image format, see system/core/libsparse/sparse_format.h in AOSP
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_MAJOR_VERSION = 1
+SPARSE_MINOR_VERSION = 0
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')
+CHUNK_HEADER = struct.Struct('<HHII')
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+SPARSE_BLOCK_SIZE = 4096
+# keep RAW chunks well below the u32 size limit and fastboot's usual max-download-size
+MAX_RAW_CHUNK_SIZE = 64 * 1024 * 1024
+
+# (chunk type, block count, payload): data bytes for RAW, the 4 byte fill value for FILL, None otherwise
+Chunk = tuple[int, int, Optional[bytes]]
+
+
+class SparseHeader:
+    block_size: int
+    total_blocks: int
+    total_chunks: int
+
+    def __init__(self, block_size: int, total_blocks: int, total_chunks: int):
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        self.total_chunks = total_chunks
+
+    def pack(self) -> bytes:
+        return SPARSE_HEADER.pack(
+            SPARSE_HEADER_MAGIC,
+            SPARSE_MAJOR_VERSION,
+            SPARSE_MINOR_VERSION,
+            SPARSE_HEADER.size,
+            CHUNK_HEADER.size,
+            self.block_size,
+            self.total_blocks,
+            self.total_chunks,
+            0,  # image checksum, unused by fastboot
+        )
+
+    @staticmethod
+    def unpack(data: bytes) -> 'SparseHeader':
+        magic, major, _, header_size, chunk_header_size, block_size, total_blocks, total_chunks, _ = SPARSE_HEADER.unpack(data[:SPARSE_HEADER.size])
+        if magic != SPARSE_HEADER_MAGIC:
+            raise Exception(f'Not an android sparse image: bad magic {hex(magic)}')
+        if major != SPARSE_MAJOR_VERSION:
+            raise Exception(f'Unsupported sparse image version {major}')
+        if header_size != SPARSE_HEADER.size or chunk_header_size != CHUNK_HEADER.size:
+            raise Exception(f'Unsupported sparse header sizes: {header_size}, {chunk_header_size}')
+        return SparseHeader(block_size, total_blocks, total_chunks)
+
+
+def _get_fill_value(block: Union[bytes, memoryview]) -> Optional[bytes]:
+    """Returns the 4 byte pattern `block` consists of or None"""
+    pattern = bytes(block[:4])
+    return pattern if pattern * (len(block) // 4) == block else None
+
+
+def _data_chunks(data: bytes, block_size: int) -> Iterator[Chunk]:
+    """splits block-aligned `data` into RAW and FILL chunks"""
+    raw_start = 0
+    fill: Optional[bytes] = None
+    fill_start = 0
+    blocks = len(data) // block_size
+    for i in range(blocks + 1):
+        value = _get_fill_value(data[i * block_size:(i + 1) * block_size]) if i < blocks else None
+        if fill is not None and value != fill:
+            yield (CHUNK_TYPE_FILL, i - fill_start, fill)
+            fill = None
+            raw_start = i
+        if fill is None and (value is not None or i == blocks):
+            if i > raw_start:
+                yield (CHUNK_TYPE_RAW, i - raw_start, data[raw_start * block_size:i * block_size])
+            if value is not None:
+                fill = value
+                fill_start = i
+
+
+def _merge_chunks(chunks: Iterator[Chunk]) -> Iterator[Chunk]:
+    """merges adjacent DONT_CARE and equal FILL chunks, e.g. across data extent boundaries"""
+    last: Optional[Chunk] = None
+    for chunk in chunks:
+        if last and chunk[0] == last[0] and chunk[0] in [CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE] and chunk[2] == last[2]:
+            last = (last[0], last[1] + chunk[1], last[2])
+            continue
+        if last:
+            yield last
+        last = chunk
+    if last:
+        yield last
+
+
+def get_image_chunks(fd: int, block_size: int = SPARSE_BLOCK_SIZE, length: Optional[int] = None) -> Iterator[Chunk]:
+    """
+    Yields sparse chunks for the first `length` bytes of `fd`, turning holes into DONT_CARE and uniform blocks into FILL chunks.
+    `length` may extend past the end of `fd` to pad it to a multiple of `block_size`, the missing bytes read as zeros.
+    """
+    if length is None:
+        length = get_fd_size(fd)
+    if length % block_size:
+        raise Exception(f'Image size {length} is not a multiple of the sparse block size {block_size}')
+    read_size = max(block_size, MAX_RAW_CHUNK_SIZE - (MAX_RAW_CHUNK_SIZE % block_size))
+
+    def chunks() -> Iterator[Chunk]:
+        position = 0
+        for offset, size in align_extents(get_data_extents(fd, 0, length), block_size, limit=length):
+            if offset > position:
+                yield (CHUNK_TYPE_DONT_CARE, (offset - position) // block_size, None)
+            done = 0
+            while done < size:
+                wanted = min(read_size, size - done)
+                data = os.pread(fd, wanted, offset + done)
+                # zero-fill the partial last block
+                data += bytes(wanted - len(data))
+                yield from _data_chunks(data, block_size)
+                done += len(data)
+            position = offset + size
+        if position < length:
+            yield (CHUNK_TYPE_DONT_CARE, (length - position) // block_size, None)
+
+    return _merge_chunks(chunks())
+
+
+def write_sparse_image(input: str, output: str, block_size: int = SPARSE_BLOCK_SIZE) -> CopyStats:
+    """Converts the raw image `input` into an android sparse image at `output`, skipping holes and zero-filled blocks"""
+    start = time.monotonic()
+    fd = os.open(input, os.O_RDONLY)
+    try:
+        size = get_fd_size(fd)
+        padded_size = size + ((-size) % block_size)
+        total_chunks = 0
+        with open(output, 'wb') as file:
+            # the chunk count is only known at the end, so the header gets rewritten then
+            file.write(SparseHeader(block_size, padded_size // block_size, 0).pack())
+            for chunk_type, blocks, payload in get_image_chunks(fd, block_size, padded_size):
+                payload = payload or b''
+                file.write(CHUNK_HEADER.pack(chunk_type, 0, blocks, CHUNK_HEADER.size + len(payload)))
+                file.write(payload)
+                total_chunks += 1
+            file.seek(0)
+            file.write(SparseHeader(block_size, padded_size // block_size, total_chunks).pack())
+    finally:
+        os.close(fd)
+    stats = CopyStats(size=size, copied=os.path.getsize(output), seconds=time.monotonic() - start)
+    logging.info(f'Wrote sparse image {output} with {total_chunks} chunks: {stats}')
+    return stats
+
+
+def read_sparse_chunks(file: IO[bytes]) -> tuple[SparseHeader, Iterator[Chunk]]:
+    """Parses an android sparse image, returning its header and an iterator over its chunks. CRC32 chunks are skipped."""
+    header = SparseHeader.unpack(file.read(SPARSE_HEADER.size))
+
+    def chunks() -> Iterator[Chunk]:
+        blocks = 0
+        for i in range(header.total_chunks):
+            raw = file.read(CHUNK_HEADER.size)
+            if len(raw) != CHUNK_HEADER.size:
+                raise Exception(f'Sparse image truncated in chunk header #{i}')
+            chunk_type, _, chunk_blocks, total_size = CHUNK_HEADER.unpack(raw)
+            payload_size = total_size - CHUNK_HEADER.size
+            payload = file.read(payload_size)
+            if len(payload) != payload_size:
+                raise Exception(f'Sparse image truncated in chunk #{i}')
+            if chunk_type == CHUNK_TYPE_RAW:
+                if payload_size != chunk_blocks * header.block_size:
+                    raise Exception(f'RAW chunk #{i} has {payload_size} bytes for {chunk_blocks} blocks')
+            elif chunk_type == CHUNK_TYPE_FILL:
+                if payload_size != 4:
+                    raise Exception(f'FILL chunk #{i} has an invalid size: {payload_size}')
+            elif chunk_type == CHUNK_TYPE_DONT_CARE:
+                payload = None  # type: ignore[assignment]
+            elif chunk_type == CHUNK_TYPE_CRC32:
+                continue
+            else:
+                raise Exception(f'Unknown sparse chunk type {hex(chunk_type)} in chunk #{i}')
+            blocks += chunk_blocks
+            yield (chunk_type, chunk_blocks, payload)
+        if blocks != header.total_blocks:
+            raise Exception(f'Sparse image chunks cover {blocks} blocks instead of {header.total_blocks}')
+
+    return header, chunks()
+
+
+def unsparse_image(input: str, output: str) -> int:
+    """Converts the android sparse image `input` back into a raw (file system sparse) image at `output`. Returns the raw size."""
+    with open(input, 'rb') as file, open(output, 'wb') as out:
+        header, chunks = read_sparse_chunks(file)
+        position = 0
+        for chunk_type, blocks, payload in chunks:
+            length = blocks * header.block_size
+            if chunk_type == CHUNK_TYPE_RAW:
+                assert payload is not None
+                out.seek(position)
+                out.write(payload)
+            elif chunk_type == CHUNK_TYPE_FILL and payload != bytes(4):
+                assert payload is not None
+                out.seek(position)
+                fill = payload * (min(length, CHUNK_SIZE) // 4)
+                for offset in range(0, length, len(fill)):
+                    out.write(fill[:length - offset])
+            position += length
+        out.truncate(position)
+    return position
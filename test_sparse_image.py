@@ -0,0 +1,47 @@
+import os
+
+from sparse_image import (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_FILL, CHUNK_TYPE_RAW, SPARSE_BLOCK_SIZE, read_sparse_chunks, unsparse_image,
+                          write_sparse_image)
+
+BLOCK = SPARSE_BLOCK_SIZE
+
+
+def test_round_trip(tmp_path):
+    raw_path = str(tmp_path / 'raw.img')
+    sparse_path = str(tmp_path / 'sparse.img')
+    unsparse_path = str(tmp_path / 'unsparse.img')
+    data = os.urandom(2 * BLOCK)
+    fill = b'\xab\xcd\xef\x01' * (2 * BLOCK // 4)
+    tail = os.urandom(100)
+    with open(raw_path, 'wb') as file:
+        file.write(data)
+        # leaves a hole of 4 blocks
+        file.seek(6 * BLOCK)
+        file.write(fill)
+        file.write(bytes(2 * BLOCK))
+        file.write(tail)
+
+    write_sparse_image(raw_path, sparse_path)
+
+    with open(sparse_path, 'rb') as file:
+        header, chunks = read_sparse_chunks(file)
+        chunk_list = list(chunks)
+    assert header.block_size == BLOCK
+    assert header.total_blocks == 11
+    assert header.total_chunks == len(chunk_list)
+    assert [(chunk_type, blocks) for chunk_type, blocks, _ in chunk_list] == [
+        (CHUNK_TYPE_RAW, 2),
+        (CHUNK_TYPE_DONT_CARE, 4),
+        (CHUNK_TYPE_FILL, 2),
+        (CHUNK_TYPE_FILL, 2),
+        (CHUNK_TYPE_RAW, 1),
+    ]
+    assert chunk_list[0][2] == data
+    assert chunk_list[2][2] == fill[:4]
+    assert chunk_list[3][2] == bytes(4)
+    assert chunk_list[4][2] == tail + bytes(BLOCK - len(tail))
+
+    # the partial last block is padded with zeros
+    assert unsparse_image(sparse_path, unsparse_path) == 11 * BLOCK
+    with open(raw_path, 'rb') as raw, open(unsparse_path, 'rb') as unsparse:
+        assert unsparse.read() == raw.read() + bytes(BLOCK - len(tail))
@@ -68,3 +68,24 @@ def log_or_exception(raise_exception: bool, msg: str, exc_class=Exception, log_l
         raise exc_class(msg)
     else:
         logging.log(log_level, msg)
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_size(size: str) -> int:
+    """Parses sizes like `512M` or `10G` (binary units, an optional trailing `B` or `iB` is ignored) to bytes"""
+    value = size.strip().upper().removesuffix('B').removesuffix('I')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise Exception(f'Invalid size "{size}"')
+
+
+def format_size(size: float) -> str:
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return f'{size:.1f}{unit}iB' if unit else f'{int(size)}B'
+        size /= 1024
+    return f'{size:.1f}TiB'